@@ -0,0 +1,74 @@
+"""
+Keyword scoring benchmark for the sentiment analyzer: compiled matcher (Aho-Corasick,
+and the combined-regex fallback) vs per-keyword scans
+
+Usage: python benchmarks/bench_keyword_matcher.py [num_texts]
+"""
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../lambda/shared'))
+
+from unittest.mock import patch
+
+import sentiment_scoring
+from sentiment_scoring import SENTIMENT_KEYWORDS, TEXT_MATCHER, KeywordMatcher, ahocorasick
+
+def make_texts(num_texts, seed=0):
+    """Synthetic KB chunks (60-180 words) drawn from a Zipf-like vocabulary that includes the keywords"""
+    rng = random.Random(seed)
+    vocabulary = [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 9))) for _ in range(8000)]
+    vocabulary += list(SENTIMENT_KEYWORDS['positive']) + list(SENTIMENT_KEYWORDS['negative'])
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    rng.shuffle(weights)
+    return [' '.join(rng.choices(vocabulary, weights, k=rng.randint(60, 180))).capitalize() + '.' for _ in range(num_texts)]
+
+def score_loop(text_lower):
+    """The original per-keyword substring loop"""
+    text_pos_score = 0
+    text_neg_score = 0
+    for word, weight in SENTIMENT_KEYWORDS['positive'].items():
+        if word in text_lower:
+            text_pos_score += weight
+    for word, weight in SENTIMENT_KEYWORDS['negative'].items():
+        if word in text_lower:
+            text_neg_score += weight
+    return [text_pos_score, text_neg_score]
+
+def timed(scorer, texts):
+    start = time.perf_counter()
+    scores = [scorer(text.lower()) for text in texts]
+    return scores, time.perf_counter() - start
+
+def main():
+    num_texts = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    texts = make_texts(num_texts)
+
+    baseline, baseline_elapsed = timed(score_loop, texts)
+    print(f"texts: {num_texts}")
+    print(f"per-keyword loop: {baseline_elapsed:.2f}s ({num_texts / baseline_elapsed:,.0f} texts/s)")
+    for backend in ([ahocorasick] if ahocorasick else []) + [None]:
+        with patch.object(sentiment_scoring, 'ahocorasick', backend):
+            matcher = KeywordMatcher(SENTIMENT_KEYWORDS)
+        compiled, compiled_elapsed = timed(matcher.score, texts)
+        assert compiled == baseline, "compiled matcher disagrees with the substring loop"
+        print(f"{'aho-corasick' if backend else 'combined regex'}: {compiled_elapsed:.2f}s "
+              f"({num_texts / compiled_elapsed:,.0f} texts/s), speedup {baseline_elapsed / compiled_elapsed:.2f}x")
+
+    # Every table at once, as analyze_text scans each text
+    words = list(TEXT_MATCHER.entries)
+    _, loop_elapsed = timed(lambda text_lower: {word for word in words if word in text_lower}, texts)
+    with patch.object(sentiment_scoring, 'ahocorasick', None):
+        regex_matcher = KeywordMatcher({'all': dict.fromkeys(words, 1)})
+    _, regex_elapsed = timed(regex_matcher.find, texts)
+    print(f"all {len(words)} keywords, combined regex vs per-keyword loop: speedup {loop_elapsed / regex_elapsed:.2f}x")
+
+    start = time.perf_counter()
+    KeywordMatcher(SENTIMENT_KEYWORDS)
+    print(f"matcher build: {(time.perf_counter() - start) * 1000:.2f}ms (once per container)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Throughput benchmark for the data cleaner MinHash/LSH near-duplicate stage
+
+Usage: python benchmarks/bench_near_duplicates.py [num_records]
+"""
+import os
+import random
+import string
+import sys
+import time
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../lambda/data-cleaner'))
+
+with patch('boto3.client'):
+    from lambda_function import NearDuplicateFilter
+
+def make_records(num_records, duplicate_rate=0.1, seed=0):
+    """Synthetic Reddit-like posts (~60 words) with a share of lightly edited reposts"""
+    rng = random.Random(seed)
+    vocabulary = [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 9))) for _ in range(5000)]
+    records = []
+    for i in range(num_records):
+        if records and rng.random() < duplicate_rate:
+            original = rng.choice(records)
+            body = original['body'] + ' edit: typo'
+            records.append({'title': original['title'], 'body': body})
+        else:
+            records.append({
+                'title': ' '.join(rng.choice(vocabulary) for _ in range(6)),
+                'body': ' '.join(rng.choice(vocabulary) for _ in range(55))
+            })
+    return records
+
+def main():
+    num_records = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    records = make_records(num_records)
+
+    near_filter = NearDuplicateFilter()
+    stats = {'near_duplicates_removed': 0}
+    start = time.perf_counter()
+    kept = sum(1 for _ in near_filter.filter(iter(records), stats))
+    elapsed = time.perf_counter() - start
+
+    print(f"records: {num_records}, kept: {kept}, near duplicates removed: {stats['near_duplicates_removed']}")
+    print(f"bands x rows: {near_filter.bands} x {near_filter.rows}, threshold: {near_filter.threshold}")
+    print(f"elapsed: {elapsed:.2f}s, throughput: {num_records / elapsed:,.0f} records/s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Property scoring benchmark for the sentiment analyzer: per-record path vs hit-matrix engine
+
+Usage: python benchmarks/bench_scoring_engines.py [num_texts]
+"""
+import contextlib
+import io
+import os
+import random
+import sys
+import time
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../lambda/sentiment-analyzer'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../lambda/shared'))
+
+from sentiment_scoring import SENTIMENT_KEYWORDS, STREAMING_PROPERTIES, GENERAL_STREAMING_TERMS, THEME_PATTERNS
+
+with patch('boto3.client'):
+    from lambda_function import aggregate_feedback_texts, results_from_aggregates
+
+def make_feedback(num_texts, seed=0):
+    """Synthetic KB chunks (5-60 words) where ~10% of words come from the keyword tables"""
+    rng = random.Random(seed)
+    keywords = list(SENTIMENT_KEYWORDS['positive']) + list(SENTIMENT_KEYWORDS['negative']) + GENERAL_STREAMING_TERMS
+    keywords += [v for variations in STREAMING_PROPERTIES.values() for v in variations]
+    keywords += [k for theme_keywords in THEME_PATTERNS.values() for k in theme_keywords]
+    filler = "the a and it was is my i we they show episode watch on to of for really".split()
+    return [{'content': ' '.join(rng.choice(keywords) if rng.random() < 0.1 else rng.choice(filler)
+                                 for _ in range(rng.randint(5, 60)))} for _ in range(num_texts)]
+
+def run_engine(feedback, scoring_engine):
+    aggregates, _, _ = aggregate_feedback_texts((item['content'] for item in feedback), scoring_engine)
+    return results_from_aggregates(aggregates)
+
+def main():
+    num_texts = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    feedback = make_feedback(num_texts)
+
+    timings = {}
+    outputs = {}
+    for name in ('records', 'matrix'):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            outputs[name] = run_engine(feedback, name)
+        timings[name] = time.perf_counter() - start
+        for result in outputs[name]:
+            result.pop('processed_at')
+
+    assert outputs['records'] == outputs['matrix'], "engines disagree"
+    print(f"texts: {num_texts}, properties: {len(outputs['matrix'])}")
+    for name, elapsed in timings.items():
+        print(f"{name:>8}: {elapsed:.2f}s ({num_texts / elapsed:,.0f} texts/s)")
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,44 @@
 # Code to clean raw data from Social Gist json files and save to S3 bucket for use in Knowledge Base.
 import json
 import boto3
+import contextlib
+import gzip
+import hashlib
+import itertools
 import logging
+import sys
+import tempfile
+import textwrap
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 import os
+from botocore.exceptions import ClientError
+
+# Shared with the sentiment analyzer; deployment packages bundle lambda/shared at their root
+SHARED_MODULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared')
+if os.path.isdir(SHARED_MODULES_PATH):  # running from the repository
+    sys.path.append(SHARED_MODULES_PATH)
+from fingerprint_index import FingerprintIndex
+from json_stream import JsonStreamReader
+import sentiment_scoring
+
+try:
+    import numpy as np
+except ImportError:  # optional: only needed for the near-duplicate stage
+    np = None
+
+try:
+    import zstandard
+except ImportError:  # optional: only needed for OUTPUT_FORMAT=jsonl.zst
+    zstandard = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional: only needed for OUTPUT_FORMAT=parquet
+    pa = None
+    pq = None
 
 # Set up logging
 logger = logging.getLogger()
@@ -11,13 +46,722 @@ logger.setLevel(logging.INFO)
 
 s3 = boto3.client('s3')
 
+# Configuration
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', str(1024 * 1024)))  # bytes read per S3 body read
+MATCH_PATH = ('response', 'Matches', 'Match')
+EXECUTION_MODE = os.environ.get('EXECUTION_MODE', 'thread')  # sequential, thread or process
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '8'))
+CHECKPOINT_KEY = os.environ.get('CHECKPOINT_KEY', 'socialgist-state/batch-checkpoint.json')
+CHECKPOINT_PATH = os.environ.get('CHECKPOINT_PATH')  # local file instead of S3, e.g. for backfills run off-Lambda
+CHECKPOINT_EVERY = int(os.environ.get('CHECKPOINT_EVERY', '16'))  # files processed between checkpoint saves
+INCREMENTAL = os.environ.get('INCREMENTAL', 'false').lower() == 'true'  # skip raw files unchanged since their last run
+MANIFEST_KEY = os.environ.get('MANIFEST_KEY', 'socialgist-state/processed-manifest.json')
+MANIFEST_PATH = os.environ.get('MANIFEST_PATH')
+GLOBAL_DEDUP = os.environ.get('GLOBAL_DEDUP', 'false').lower() == 'true'  # dedup against every file seen in earlier runs
+DEDUP_INDEX_KEY = os.environ.get('DEDUP_INDEX_KEY', 'socialgist-state/fingerprint-index.bin')
+DEDUP_INDEX_PATH = os.environ.get('DEDUP_INDEX_PATH')
+DEDUP_CAPACITY = int(os.environ.get('DEDUP_CAPACITY', '10000000'))  # expected distinct records
+DEDUP_FALSE_POSITIVE_RATE = float(os.environ.get('DEDUP_FALSE_POSITIVE_RATE', '0.001'))
+DEDUP_MAX_BYTES = int(os.environ.get('DEDUP_MAX_BYTES', str(64 * 1024 * 1024)))  # memory ceiling for the index
+DEDUP_FILE_DIGESTS_PREFIX = os.environ.get('DEDUP_FILE_DIGESTS_PREFIX', 'socialgist-state/dedup-files/')  # digests each raw file kept
+DEDUP_FILE_DIGESTS_PATH = os.environ.get('DEDUP_FILE_DIGESTS_PATH')  # local directory instead of S3
+MULTIPART_CHUNK_SIZE = int(os.environ.get('MULTIPART_CHUNK_SIZE', str(8 * 1024 * 1024)))  # S3 requires >= 5 MB parts
+OUTPUT_INDENT = int(os.environ.get('OUTPUT_INDENT', '2') or 0) or None  # indent of cleaned JSON; 0 or empty for compact
+OUTPUT_FORMAT = os.environ.get('OUTPUT_FORMAT', 'json')  # json, jsonl.gz, jsonl.zst or parquet
+PARQUET_ROW_GROUP_SIZE = int(os.environ.get('PARQUET_ROW_GROUP_SIZE', '50000'))  # records per Parquet row group
+KB_SHARDING = os.environ.get('KB_SHARDING', 'false').lower() == 'true'  # pack KB-ready records from many files into shards
+KB_SHARD_MAX_BYTES = int(os.environ.get('KB_SHARD_MAX_BYTES', str(40 * 1024 * 1024)))
+KB_SHARD_MAX_RECORDS = int(os.environ.get('KB_SHARD_MAX_RECORDS', '0'))  # 0: limit by size only
+KB_SHARD_MANIFEST_KEY = os.environ.get('KB_SHARD_MANIFEST_KEY', 'socialgist-state/kb-shards.json')  # shards of the last completed batch
+KB_SHARD_MANIFEST_PATH = os.environ.get('KB_SHARD_MANIFEST_PATH')
+NEAR_DEDUP = os.environ.get('NEAR_DEDUP', 'false').lower() == 'true'  # MinHash/LSH near-duplicate removal (needs numpy)
+NEAR_DEDUP_THRESHOLD = float(os.environ.get('NEAR_DEDUP_THRESHOLD', '0.8'))  # estimated Jaccard similarity
+NEAR_DEDUP_NUM_PERM = int(os.environ.get('NEAR_DEDUP_NUM_PERM', '64'))
+NEAR_DEDUP_SHINGLE_SIZE = int(os.environ.get('NEAR_DEDUP_SHINGLE_SIZE', '3'))  # words per shingle
+NEAR_DEDUP_BATCH_SIZE = int(os.environ.get('NEAR_DEDUP_BATCH_SIZE', '1024'))
+INLINE_SCORING = os.environ.get('INLINE_SCORING', 'false').lower() == 'true'  # score records in-stream into per-file partial aggregates
+PARTIAL_AGGREGATE_FORMAT = os.environ.get('PARTIAL_AGGREGATE_FORMAT', 'binary')  # binary or json
+TIME_BUFFER_MS = int(os.environ.get('TIME_BUFFER_MS', '60000'))  # stop starting new files this close to the timeout
+
+# Cleaned output formats: file extension and S3 content type
+OUTPUT_FORMATS = {
+    'json': ('.json', 'application/json'),
+    'jsonl.gz': ('.jsonl.gz', 'application/gzip'),
+    'jsonl.zst': ('.jsonl.zst', 'application/zstd'),
+    'parquet': ('.parquet', 'application/vnd.apache.parquet')
+}
+
+def iter_match_records(stream, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield items of response.Matches.Match one at a time from a raw Socialgist file stream"""
+    reader = JsonStreamReader(stream, chunk_size)
+    if not reader.find_path(MATCH_PATH) or reader.peek() != '[':
+        return
+
+    yield from reader.iter_array('Match array')
+
+def fingerprint_digest(title, body):
+    """Fixed-width (128-bit) digest of a record's title::body fingerprint"""
+    return hashlib.blake2b(f"{title}::{body}".encode('utf-8'), digest_size=16).digest()
+
+def iter_cleaned_records(records, input_key, stats, dedup_index=None, seen=None, claimed=None, own_digests=None):
+    """Validate and de-duplicate raw matches, yielding cleaned records and updating `stats` counters.
+
+    Fingerprint digests of every valid record are added to `seen`. Records already in
+    the cross-run `dedup_index`, or claimed there by a file processed concurrently,
+    are dropped, except those in `own_digests` (kept by this file in an earlier run);
+    digests this file claims are appended to `claimed` so the caller can commit them
+    on success or release them on failure.
+    """
+    seen = set() if seen is None else seen
+    claimed = [] if claimed is None else claimed
+    own_digests = own_digests or set()
+
+    for item in records:
+        stats['total_input_records'] += 1
+        title = item.get("Title")
+        body = item.get("Data", {}).get("Body")
+
+        if not title:
+            stats['skipped_no_title'] += 1
+            continue
+        if not body:
+            stats['skipped_no_body'] += 1
+            continue
+
+        title = title.strip()
+        body = body.strip()
+        digest = fingerprint_digest(title, body)
+
+        if digest in seen:
+            stats['duplicates_removed'] += 1
+            continue
+        seen.add(digest)
+
+        if dedup_index is not None:
+            if not dedup_index.claim(digest, digest in own_digests):
+                stats['global_duplicates_removed'] += 1
+                continue
+            claimed.append(digest)
+
+        yield {
+            "title": title,
+            "body": body,
+            "source_file": input_key,
+            "processed_at": datetime.utcnow().isoformat()
+        }
+
+def optimal_lsh_params(threshold, num_perm):
+    """Pick (bands, rows) minimizing false positive plus false negative probability mass around `threshold`"""
+    def area(fn, lo, hi, steps=100):
+        width = (hi - lo) / steps
+        return sum(fn(lo + (i + 0.5) * width) for i in range(steps)) * width
+
+    best = None
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        if bands * rows != num_perm:
+            continue
+        false_positive = area(lambda s: 1 - (1 - s ** rows) ** bands, 0.0, threshold)
+        false_negative = area(lambda s: (1 - s ** rows) ** bands, threshold, 1.0)
+        error = false_positive + false_negative
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+class NearDuplicateFilter:
+    """MinHash/LSH filter dropping records whose word-shingle Jaccard similarity to a kept record reaches `threshold`.
+
+    Signatures are computed with NumPy a batch at a time; band buckets and the
+    signatures of kept records are held for the lifetime of the filter (one file).
+    """
+
+    HASH_BASE = 0x100000001B3  # odd, so invertible modulo 2**64
+
+    def __init__(self, threshold=NEAR_DEDUP_THRESHOLD, num_perm=NEAR_DEDUP_NUM_PERM,
+                 shingle_size=NEAR_DEDUP_SHINGLE_SIZE, batch_size=NEAR_DEDUP_BATCH_SIZE, seed=1):
+        if np is None:
+            raise ImportError("numpy is required for near-duplicate detection (NEAR_DEDUP=true)")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.batch_size = batch_size
+        self.bands, self.rows = optimal_lsh_params(threshold, num_perm)
+
+        rng = np.random.default_rng(seed)
+        self.shingle_weights = rng.integers(1, 2 ** 63, shingle_size, dtype=np.uint64) | np.uint64(1)
+        self.band_weights = rng.integers(1, 2 ** 63, self.rows, dtype=np.uint64) | np.uint64(1)
+        self.band_offsets = rng.integers(1, 2 ** 63, self.bands, dtype=np.uint64)
+        # (a * x + b) mod 2**32 with odd a is a permutation of the 32-bit hash space
+        self.perm_a = (rng.integers(0, 2 ** 32, num_perm, dtype=np.uint64) | np.uint64(1)).astype(np.uint32)
+        self.perm_b = rng.integers(0, 2 ** 32, num_perm, dtype=np.uint64).astype(np.uint32)
+
+        self.base_powers = np.ones(0, dtype=np.uint64)
+        self.inverse_powers = np.ones(0, dtype=np.uint64)
+
+        self.buckets = {}
+
+    def powers(self, length):
+        """HASH_BASE**-i and HASH_BASE**i (mod 2**64) for i < length, grown on demand"""
+        if len(self.base_powers) < length:
+            size = max(length, 2 * len(self.base_powers))
+            inverse = pow(self.HASH_BASE, -1, 2 ** 64)
+            self.inverse_powers = np.cumprod(np.full(size, inverse, dtype=np.uint64)) * np.uint64(self.HASH_BASE)
+            self.base_powers = np.cumprod(np.full(size, self.HASH_BASE, dtype=np.uint64)) * np.uint64(inverse)
+        return self.inverse_powers[:length], self.base_powers[:length]
+
+    def compute_signatures(self, texts):
+        """MinHash signatures (len(texts) x num_perm, uint32) over lowercase word shingles"""
+        encoded = [text.encode('utf-8') for text in texts]
+        record_ends = np.cumsum(np.fromiter((len(e) + 1 for e in encoded), dtype=np.int64, count=len(encoded)))
+        data = np.frombuffer(b'\n'.join(encoded), dtype=np.uint8)
+
+        # Words are runs of bytes above ASCII space; whitespace and control bytes separate them
+        is_word = data > 32
+        starts = np.flatnonzero(is_word[1:] & ~is_word[:-1]) + 1
+        if len(data) and is_word[0]:
+            starts = np.concatenate(([0], starts))
+
+        # Position-independent polynomial hash of each word: with separators zeroed, each
+        # segment sum is sum(c[j] * B**-j for j in word), and B**start shifts it to sum(c[j] * B**(j - start))
+        inverse_powers, base_powers = self.powers(len(data))
+        weighted = (data * is_word).astype(np.uint64) * inverse_powers
+        word_hashes = np.add.reduceat(weighted, starts) * base_powers[starts]
+        word_hashes = (word_hashes ^ (word_hashes >> np.uint64(31))) * np.uint64(0x9E3779B97F4A7C15)
+
+        # Pad records shorter than one shingle so every record has at least one
+        k = self.shingle_size
+        record_of_word = np.searchsorted(record_ends, starts, side='right')
+        word_counts = np.bincount(record_of_word, minlength=len(texts))
+        padding = np.maximum(k - word_counts, 0)
+        if padding.any():
+            insert_at = np.repeat(np.cumsum(word_counts), padding)
+            word_hashes = np.insert(word_hashes, insert_at, np.uint64(0))
+            record_of_word = np.insert(record_of_word, insert_at, np.repeat(np.arange(len(texts)), padding))
+            word_counts = word_counts + padding
+
+        # Combine consecutive words into shingles, keeping only those inside a single record
+        num_windows = len(word_hashes) - k + 1
+        shingles = np.zeros(num_windows, dtype=np.uint64)
+        for j in range(k):
+            shingles += word_hashes[j:j + num_windows] * self.shingle_weights[j]
+        valid = record_of_word[:num_windows] == record_of_word[k - 1:]
+        shingles = (shingles[valid] * np.uint64(0xBF58476D1CE4E5B9) >> np.uint64(32)).astype(np.uint32)
+
+        segment_starts = np.concatenate(([0], np.cumsum(word_counts - k + 1)[:-1]))
+        signatures = np.empty((len(texts), self.num_perm), dtype=np.uint32)
+        for p in range(self.num_perm):
+            signatures[:, p] = np.minimum.reduceat(self.perm_a[p] * shingles + self.perm_b[p], segment_starts)
+        return signatures
+
+    def band_keys(self, signatures):
+        """One bucket key per (record, band), distinct across bands.
+
+        Keys are truncated to 30 bits so they stay single-digit Python ints; the
+        occasional bucket collision is harmless because candidates are verified.
+        """
+        banded = signatures.reshape(len(signatures), self.bands, self.rows).astype(np.uint64)
+        keys = (banded * self.band_weights).sum(axis=2, dtype=np.uint64) + self.band_offsets
+        return (keys >> np.uint64(34)).tolist()
+
+    def filter_batch(self, batch, stats):
+        """Signature one batch and check each record against the LSH buckets in input order"""
+        texts = [f"{record['title']} {record['body']}".lower() for record in batch]
+        signatures = self.compute_signatures(texts)
+        min_matches = self.threshold * self.num_perm
+        buckets = self.buckets
+        get_bucket = buckets.get
+
+        for index, (record, keys) in enumerate(zip(batch, self.band_keys(signatures))):
+            candidates = [bucket for bucket in map(get_bucket, keys) if bucket]
+            if candidates:
+                signature = signatures[index]
+                if any(np.count_nonzero(kept[row] == signature) >= min_matches
+                       for kept, row in itertools.chain.from_iterable(candidates)):
+                    stats['near_duplicates_removed'] += 1
+                    continue
+
+            # Kept records are referenced as (batch signatures, row) to avoid per-record array views
+            entry = (signatures, index)
+            for key in keys:
+                bucket = get_bucket(key)
+                if bucket is None:
+                    buckets[key] = [entry]
+                else:
+                    bucket.append(entry)
+            yield record
+
+    def filter(self, records, stats):
+        """Yield records that are not near-duplicates of an earlier record, counting removals in `stats`"""
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                yield from self.filter_batch(batch, stats)
+                batch = []
+        if batch:
+            yield from self.filter_batch(batch, stats)
+
+class S3StreamWriter:
+    """Write-only file-like object that streams to S3 with a multipart upload.
+
+    Data is buffered up to `part_size` and uploaded part by part, so memory stays
+    O(part_size) regardless of object size. Objects smaller than one part are
+    written with a single put_object. Used as a context manager, an exception
+    aborts the upload instead of completing it.
+    """
+
+    def __init__(self, bucket, key, content_type='application/json', part_size=None):
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.part_size = part_size or MULTIPART_CHUNK_SIZE
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.bytes_written = 0
+        self.closed = False
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.bytes_written
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.buffer += data
+        self.bytes_written += len(data)
+        if len(self.buffer) >= self.part_size:
+            self.upload_part()
+        return len(data)
+
+    def flush(self):
+        """Parts are uploaded as they fill; nothing to do until close"""
+
+    def upload_part(self):
+        if self.upload_id is None:
+            response = s3.create_multipart_upload(Bucket=self.bucket, Key=self.key, ContentType=self.content_type)
+            self.upload_id = response['UploadId']
+        part_number = len(self.parts) + 1
+        response = s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=bytes(self.buffer)
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = bytearray()
+
+    def close(self):
+        """Upload the remaining buffer and finish the object"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.upload_id is None:
+            s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), ContentType=self.content_type)
+        else:
+            if self.buffer:
+                self.upload_part()
+            s3.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': self.parts}
+            )
+        self.buffer = bytearray()
+
+    def abort(self):
+        """Discard uploaded parts so a failed file leaves no partial object or orphaned parts"""
+        self.closed = True
+        if self.upload_id is not None:
+            s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        self.buffer = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+class JsonArrayWriter:
+    """Incrementally write records as a JSON array, byte-identical to json.dumps(records, indent=indent)"""
+
+    def __init__(self, stream, indent=None):
+        self.stream = stream
+        self.indent = indent
+        self.count = 0
+
+    def write(self, record):
+        if self.indent is None:
+            text = json.dumps(record)
+            separator = ', ' if self.count else '['
+        else:
+            text = textwrap.indent(json.dumps(record, indent=self.indent), ' ' * self.indent)
+            separator = ',\n' if self.count else '[\n'
+        self.stream.write(separator + text)
+        self.count += 1
+
+    def close(self):
+        if self.count == 0:
+            self.stream.write('[]')
+        else:
+            self.stream.write(']' if self.indent is None else '\n]')
+
+class JsonLinesWriter:
+    """Write one JSON document per line as UTF-8, newline-separated without a trailing newline.
+
+    With `close_stream`, close() also closes `stream` (e.g. to finish a compression frame).
+    """
+
+    def __init__(self, stream, close_stream=False):
+        self.stream = stream
+        self.close_stream = close_stream
+        self.count = 0
+
+    def write(self, document):
+        self.stream.write((('\n' if self.count else '') + json.dumps(document)).encode('utf-8'))
+        self.count += 1
+
+    def close(self):
+        if self.close_stream:
+            self.stream.close()
+
+class ParquetRecordWriter:
+    """Buffer cleaned records into Parquet row groups of `row_group_size` records"""
+
+    def __init__(self, stream, row_group_size=None):
+        if pq is None:
+            raise ImportError("pyarrow is required for OUTPUT_FORMAT=parquet")
+        self.schema = pa.schema([
+            ('title', pa.string()),
+            ('body', pa.string()),
+            ('source_file', pa.string()),
+            ('processed_at', pa.timestamp('us'))
+        ])
+        self.writer = pq.ParquetWriter(stream, self.schema, compression='zstd')
+        self.row_group_size = row_group_size or PARQUET_ROW_GROUP_SIZE
+        self.rows = {name: [] for name in self.schema.names}
+        self.count = 0
+
+    def write(self, record):
+        for name, values in self.rows.items():
+            values.append(record[name])
+        self.count += 1
+        if len(self.rows['title']) >= self.row_group_size:
+            self.write_row_group()
+
+    def write_row_group(self):
+        columns = [
+            pa.array(self.rows['title'], pa.string()),
+            pa.array(self.rows['body'], pa.string()),
+            pa.array(self.rows['source_file'], pa.string()),
+            pa.array(self.rows['processed_at'], pa.string()).cast(pa.timestamp('us'))
+        ]
+        self.writer.write_table(pa.Table.from_arrays(columns, schema=self.schema))
+        self.rows = {name: [] for name in self.schema.names}
+
+    def close(self):
+        if self.rows['title']:
+            self.write_row_group()
+        self.writer.close()
+
+class KBShardWriter:
+    """Pack KB-ready JSONL lines from many files into size-bounded shards named ready-{batch_id}-{index:05d}.jsonl.
+
+    One writer serves the whole invocation and worker threads share it. Each file's
+    lines are appended contiguously under a lock and never split across shards: the
+    open shard is rolled over first when the file would push it past `max_bytes` or
+    `max_records` (a file larger than that gets a shard of its own). A file becomes
+    durable only when the shard holding it is closed; its dedup claims are committed
+    then, or released if the shard is aborted, so it is reprocessed instead.
+    """
+
+    def __init__(self, bucket, batch_id, next_index=0, max_bytes=None, max_records=None, dedup_index=None):
+        self.bucket = bucket
+        self.batch_id = batch_id
+        self.next_index = next_index
+        self.max_bytes = max_bytes or KB_SHARD_MAX_BYTES
+        self.max_records = KB_SHARD_MAX_RECORDS if max_records is None else max_records
+        self.dedup_index = dedup_index
+        self.lock = threading.Lock()
+        self.current = None
+        self.current_records = 0
+        self.current_files = []  # (input_key, claimed digests) of files in the open shard
+        self.durable_files = []  # input keys whose shard has closed, drained by take_durable()
+        self.shards = []
+
+    def shard_key(self, index):
+        return f'socialgist-kb/ready-{self.batch_id}-{index:05d}.jsonl'
+
+    def append_file(self, input_key, lines, size, line_count, claimed=()):
+        """Append one file's JSONL lines (bytes, newline-terminated or bare) as a unit.
+
+        `size` and `line_count` describe the whole file so the shard can be rolled over
+        before it rather than in its middle. If writing fails, the open shard and every
+        file in it are abandoned.
+        """
+        with self.lock:
+            if self.current is not None and self.current_records:
+                full = self.max_records and self.current_records + line_count > self.max_records
+                if full or self.current.bytes_written + 1 + size > self.max_bytes:
+                    self.close_current()
+            if size > self.max_bytes:
+                logger.warning(f"{input_key} alone exceeds KB_SHARD_MAX_BYTES, writing it to one oversized shard")
+            try:
+                for line in lines:
+                    line = line.rstrip(b'\n')
+                    if line:
+                        self.write_line(line)
+            except Exception:
+                self.abort_current()
+                raise
+            self.current_files.append((input_key, claimed))
+
+    def write_line(self, line):
+        if self.current is None:
+            self.current = S3StreamWriter(self.bucket, self.shard_key(self.next_index))
+            self.next_index += 1
+        self.current.write(b'\n' + line if self.current_records else line)
+        self.current_records += 1
+
+    def close_current(self):
+        if self.current is not None:
+            self.current.close()
+            self.shards.append(f's3://{self.bucket}/{self.current.key}')
+        for input_key, claimed in self.current_files:
+            if self.dedup_index is not None:
+                self.dedup_index.commit(claimed)
+            self.durable_files.append(input_key)
+        self.current = None
+        self.current_records = 0
+        self.current_files = []
+
+    def abort_current(self):
+        if self.current is not None:
+            self.current.abort()
+        for input_key, claimed in self.current_files:
+            logger.warning(f"KB shard aborted, {input_key} will be reprocessed")
+            if self.dedup_index is not None:
+                self.dedup_index.release(claimed)
+        self.current = None
+        self.current_records = 0
+        self.current_files = []
+
+    def take_durable(self):
+        """Input keys whose lines became durable since the last call"""
+        with self.lock:
+            durable, self.durable_files = self.durable_files, []
+            return durable
+
+    def close(self):
+        """Finish the open shard, making every appended file durable"""
+        with self.lock:
+            self.close_current()
+
+    def abort(self):
+        """Abandon the open shard"""
+        with self.lock:
+            self.abort_current()
+
+def retire_previous_shards(bucket, kb_shards, keep_previous=False):
+    """Record a completed batch's shards and delete those of earlier batches, which the new shards supersede.
+
+    With `keep_previous` (some files failed this batch, so their records only live in
+    older shards) nothing is deleted: the new shards are listed next to the old ones
+    and a later batch without failures retires them all.
+    """
+    current = [kb_shards.shard_key(index) for index in range(kb_shards.next_index)]
+    previous = load_json_state(bucket, KB_SHARD_MANIFEST_KEY, KB_SHARD_MANIFEST_PATH, default={})
+    if keep_previous:
+        shards = previous.get('shards', []) + [key for key in current if key not in previous.get('shards', [])]
+        save_json_state(bucket, KB_SHARD_MANIFEST_KEY,
+                        {'batch_id': kb_shards.batch_id, 'shards': shards, 'retiring': previous.get('retiring', [])},
+                        KB_SHARD_MANIFEST_PATH)
+        logger.warning("Batch had failed files, keeping the KB shards of earlier batches until a clean batch replaces them")
+        return
+    retiring = [key for key in previous.get('shards', []) + previous.get('retiring', []) if key not in current]
+    # Listed before deleting, so an interrupted cleanup is finished by the next completed batch
+    save_json_state(bucket, KB_SHARD_MANIFEST_KEY, {'batch_id': kb_shards.batch_id, 'shards': current, 'retiring': retiring},
+                    KB_SHARD_MANIFEST_PATH)
+    for key in retiring:
+        s3.delete_object(Bucket=bucket, Key=key)
+    save_json_state(bucket, KB_SHARD_MANIFEST_KEY, {'batch_id': kb_shards.batch_id, 'shards': current, 'retiring': []},
+                    KB_SHARD_MANIFEST_PATH)
+    logger.info(f"Retired {len(retiring)} KB shards of earlier batches")
+
+def create_record_writer(stream, output_format):
+    """Record writer producing the cleaned output in `output_format` on `stream`"""
+    if output_format == 'json':
+        return JsonArrayWriter(stream, OUTPUT_INDENT)
+    if output_format == 'jsonl.gz':
+        return JsonLinesWriter(gzip.GzipFile(fileobj=stream, mode='wb'), close_stream=True)
+    if output_format == 'jsonl.zst':
+        if zstandard is None:
+            raise ImportError("zstandard is required for OUTPUT_FORMAT=jsonl.zst")
+        return JsonLinesWriter(zstandard.ZstdCompressor().stream_writer(stream, closefd=False), close_stream=True)
+    if output_format == 'parquet':
+        return ParquetRecordWriter(stream)
+    raise ValueError(f"Unsupported output format: {output_format}")
+
+def read_state_bytes(bucket, key, local_path=None):
+    """Read a state object from `local_path` if set, otherwise from S3. Returns None when missing."""
+    if local_path:
+        if not os.path.exists(local_path):
+            return None
+        with open(local_path, 'rb') as f:
+            return f.read()
+    try:
+        return s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+
+def write_state_bytes(bucket, key, data, local_path=None, content_type='application/octet-stream'):
+    """Write a state object to `local_path` if set, otherwise to S3"""
+    if local_path:
+        tmp_path = f"{local_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, local_path)
+        return
+    s3.put_object(Bucket=bucket, Key=key, Body=data, ContentType=content_type)
+
+def load_json_state(bucket, key, local_path=None, default=None):
+    """Load a JSON state document, returning `default` when it does not exist yet"""
+    data = read_state_bytes(bucket, key, local_path)
+    return json.loads(data.decode('utf-8')) if data is not None else default
+
+def save_json_state(bucket, key, state, local_path=None):
+    """Persist a JSON state document"""
+    body = json.dumps(state, indent=2).encode('utf-8')
+    write_state_bytes(bucket, key, body, local_path, content_type='application/json')
+
+def delete_state(bucket, key, local_path=None):
+    """Remove a state object if present"""
+    if local_path:
+        if os.path.exists(local_path):
+            os.remove(local_path)
+        return
+    s3.delete_object(Bucket=bucket, Key=key)
+
+def iter_raw_files(bucket, prefix):
+    """Lazily yield raw JSON objects (Key, ETag, Size, LastModified) under `prefix`, following continuation tokens"""
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].lower().endswith('.json') and obj['Key'] != prefix:
+                yield obj
+
+def load_checkpoint(bucket):
+    """Load the in-progress batch checkpoint, or start a new one"""
+    checkpoint = load_json_state(bucket, CHECKPOINT_KEY, CHECKPOINT_PATH)
+    if checkpoint:
+        logger.info(f"Resuming batch {checkpoint['batch_id']}: {len(checkpoint['completed'])} files already done")
+        return checkpoint
+
+    now = datetime.utcnow()
+    return {
+        'batch_id': now.strftime('%Y%m%dT%H%M%SZ'),
+        'started_at': now.isoformat(),
+        'completed': {}
+    }
+
+def save_checkpoint(bucket, checkpoint):
+    """Persist batch progress so a timed-out invocation can resume"""
+    checkpoint['updated_at'] = datetime.utcnow().isoformat()
+    save_json_state(bucket, CHECKPOINT_KEY, checkpoint, CHECKPOINT_PATH)
+
+def source_signature(obj):
+    """Version identity of a raw object as recorded in the incremental manifest"""
+    last_modified = obj.get('LastModified')
+    return {
+        'etag': obj['ETag'],
+        'size': obj.get('Size'),
+        'last_modified': last_modified.isoformat() if hasattr(last_modified, 'isoformat') else last_modified
+    }
+
+def load_manifest(bucket):
+    """Load the manifest of raw files already cleaned by earlier runs"""
+    manifest = load_json_state(bucket, MANIFEST_KEY, MANIFEST_PATH, default={'files': {}})
+    logger.info(f"Incremental mode: manifest lists {len(manifest['files'])} processed files")
+    return manifest
+
+def save_manifest(bucket, manifest):
+    """Persist the incremental manifest"""
+    manifest['updated_at'] = datetime.utcnow().isoformat()
+    save_json_state(bucket, MANIFEST_KEY, manifest, MANIFEST_PATH)
+
+def is_unchanged(manifest, obj):
+    """Check whether a raw object matches its manifest entry (same ETag, size and last-modified)"""
+    entry = manifest['files'].get(obj['Key'])
+    if entry is None:
+        return False
+    signature = source_signature(obj)
+    return all(entry.get(field) == value for field, value in signature.items())
+
+def load_dedup_index(bucket):
+    """Load the cross-run fingerprint index, or create an empty one sized from configuration"""
+    data = read_state_bytes(bucket, DEDUP_INDEX_KEY, DEDUP_INDEX_PATH)
+    if data is None:
+        return FingerprintIndex.for_capacity(DEDUP_CAPACITY, DEDUP_FALSE_POSITIVE_RATE, DEDUP_MAX_BYTES)
+    index = FingerprintIndex.from_bytes(data)
+    logger.info(f"Loaded fingerprint index with {index.count} records ({len(index.bits)} bytes)")
+    if index.count > DEDUP_CAPACITY:
+        logger.warning(f"Fingerprint index holds {index.count} records, above DEDUP_CAPACITY={DEDUP_CAPACITY}")
+    return index
+
+def file_digests_location(input_key):
+    """State key and local path of the digests a raw file kept under global dedup"""
+    name = hashlib.blake2b(input_key.encode('utf-8'), digest_size=16).hexdigest() + '.bin'
+    local_path = os.path.join(DEDUP_FILE_DIGESTS_PATH, name) if DEDUP_FILE_DIGESTS_PATH else None
+    return DEDUP_FILE_DIGESTS_PREFIX + name, local_path
+
+def load_file_digests(bucket, input_key):
+    """Digests of the records a raw file kept when it was last processed"""
+    data = read_state_bytes(bucket, *file_digests_location(input_key))
+    if not data:
+        return set()
+    return {data[offset:offset + 16] for offset in range(0, len(data), 16)}
+
+def save_file_digests(bucket, input_key, digests):
+    """Record the digests a raw file kept, so reprocessing it is not deduped against itself"""
+    key, local_path = file_digests_location(input_key)
+    if local_path:
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    write_state_bytes(bucket, key, b''.join(digests), local_path)
+
+def save_dedup_index(bucket, index):
+    """Persist the fingerprint index if it changed"""
+    if index.dirty:
+        write_state_bytes(bucket, DEDUP_INDEX_KEY, index.to_bytes(), DEDUP_INDEX_PATH)
+        index.dirty = False
+
+def out_of_time(context):
+    """Check whether the invocation is too close to its timeout to start more files"""
+    get_remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    return get_remaining is not None and get_remaining() < TIME_BUFFER_MS
+
 def extract_base_filename(s3_key):
     """Extract base filename without path and extension"""
     filename = os.path.basename(s3_key)
     return os.path.splitext(filename)[0]
 
-def process_single_file(bucket, input_key):
+def create_inline_scorer():
+    """Per-file streaming aggregator using the analyzer's shared scoring"""
+    return sentiment_scoring.StreamingAggregator()
+
+def process_single_file(bucket, input_key, dedup_index=None, kb_shards=None):
     """Process a single JSON file"""
+    claimed = []  # digests this file took in the shared dedup index
+    handed_off = False  # claims belong to the shard writer once the file's KB lines are appended
+    kb_spool = None
     try:
         logger.info(f"Processing file: {input_key}")
         
@@ -26,81 +770,84 @@ def process_single_file(bucket, input_key):
         timestamp = datetime.utcnow().strftime('%m%d%Y-%H%M%S')
         
         # Define output paths with original filename
-        cleaned_key = f'socialgist-processed/clean-{base_filename}.json'
+        extension, content_type = OUTPUT_FORMATS[OUTPUT_FORMAT]
+        cleaned_key = f'socialgist-processed/clean-{base_filename}{extension}'
         summary_key = f'socialgist-processed/summary-{base_filename}.json'
         kb_jsonl_key = f'socialgist-kb/ready-{base_filename}.jsonl'
+        aggregate_key = f"socialgist-processed/aggregate-{base_filename}.{'json' if PARTIAL_AGGREGATE_FORMAT == 'json' else 'bin'}"
         
-        # Load input file
+        # Stream input file: records are parsed one at a time straight off the S3 body
         response = s3.get_object(Bucket=bucket, Key=input_key)
-        file_content = response['Body'].read().decode('utf-8')
-        raw_data = json.loads(file_content)
-
-        records = raw_data.get("response", {}).get("Matches", {}).get("Match", [])
-        logger.info(f"Found {len(records)} records in {input_key}")
+        records = iter_match_records(response['Body'])
 
+        stats = {
+            'total_input_records': 0,
+            'duplicates_removed': 0,
+            'skipped_no_title': 0,
+            'skipped_no_body': 0,
+            'global_duplicates_removed': 0,
+            'near_duplicates_removed': 0
+        }
         seen = set()
-        cleaned = []
-        jsonl_lines = []
-        skipped_no_title = 0
-        skipped_no_body = 0
-        duplicates_removed = 0
-
-        for item in records:
-            title = item.get("Title")
-            body = item.get("Data", {}).get("Body")
-
-            if not title:
-                skipped_no_title += 1
-                continue
-            if not body:
-                skipped_no_body += 1
-                continue
+        scorer = create_inline_scorer() if INLINE_SCORING else None
+        # Records this file kept last time are in the index because of it, not because of another file
+        own_digests = load_file_digests(bucket, input_key) if dedup_index is not None else None
 
-            fingerprint = f"{title.strip()}::{body.strip()}"
+        cleaned_records = iter_cleaned_records(records, input_key, stats, dedup_index, seen, claimed, own_digests)
+        if NEAR_DEDUP:
+            cleaned_records = NearDuplicateFilter().filter(cleaned_records, stats)
 
-            if fingerprint not in seen:
-                seen.add(fingerprint)
-                record = {
-                    "title": title.strip(),
-                    "body": body.strip(),
-                    "source_file": input_key,
-                    "processed_at": datetime.utcnow().isoformat()
-                }
-                cleaned.append(record)
+        # With sharding, KB lines are spooled locally and handed to the shard writer once the file succeeds
+        if kb_shards is not None:
+            kb_jsonl_key = None
+            kb_spool = tempfile.SpooledTemporaryFile(max_size=MULTIPART_CHUNK_SIZE)
+            kb_output = contextlib.nullcontext(kb_spool)
+        else:
+            kb_output = S3StreamWriter(bucket, kb_jsonl_key)
 
-                # Add to KB jsonl list
+        # Stream cleaned JSON and KB-ready JSONL to S3 as records are produced
+        with S3StreamWriter(bucket, cleaned_key, content_type) as cleaned_out, kb_output as kb_out:
+            cleaned_writer = create_record_writer(cleaned_out, OUTPUT_FORMAT)
+            kb_writer = JsonLinesWriter(kb_out)
+
+            for record in cleaned_records:
+                cleaned_writer.write(record)
+
+                # Add to KB jsonl output
                 jsonl_text = f"Title: {record['title']}\nBody: {record['body']}"
-                jsonl_lines.append(json.dumps({"text": jsonl_text}))
-            else:
-                duplicates_removed += 1
+                kb_writer.write({"text": jsonl_text})
+                if scorer is not None:
+                    scorer.add(jsonl_text)
 
-        # Save cleaned JSON
-        s3.put_object(
-            Bucket=bucket,
-            Key=cleaned_key,
-            Body=json.dumps(cleaned, indent=2),
-            ContentType='application/json'
-        )
+            cleaned_writer.close()
 
-        # Save KB-ready JSONL
-        s3.put_object(
-            Bucket=bucket,
-            Key=kb_jsonl_key,
-            Body="\n".join(jsonl_lines),
-            ContentType='application/json'
-        )
+        logger.info(f"Found {stats['total_input_records']} records in {input_key}")
+
+        # Partial sentiment aggregates scored from exactly the text the KB would ingest
+        if scorer is not None:
+            partial = scorer.to_partial(f's3://{bucket}/{input_key}')
+            if PARTIAL_AGGREGATE_FORMAT == 'json':
+                body, partial_content_type = json.dumps(partial), 'application/json'
+            else:
+                body, partial_content_type = sentiment_scoring.serialize_partial(partial), 'application/octet-stream'
+            s3.put_object(Bucket=bucket, Key=aggregate_key, Body=body, ContentType=partial_content_type)
 
         # Create summary
         summary = {
             'processing_timestamp': timestamp,
             'input_file': f's3://{bucket}/{input_key}',
             'output_file': f's3://{bucket}/{cleaned_key}',
-            'kb_jsonl_file': f's3://{bucket}/{kb_jsonl_key}',
-            'total_input_records': len(records),
-            'cleaned_records': len(cleaned),
-            'duplicates_removed': duplicates_removed,
-            'skipped_no_title': skipped_no_title,
-            'skipped_no_body': skipped_no_body
+            'output_format': OUTPUT_FORMAT,
+            'kb_jsonl_file': f's3://{bucket}/{kb_jsonl_key}' if kb_jsonl_key else None,
+            'kb_sharded': kb_shards is not None,
+            'total_input_records': stats['total_input_records'],
+            'cleaned_records': cleaned_writer.count,
+            'duplicates_removed': stats['duplicates_removed'],
+            'skipped_no_title': stats['skipped_no_title'],
+            'skipped_no_body': stats['skipped_no_body'],
+            'global_duplicates_removed': stats['global_duplicates_removed'],
+            'near_duplicates_removed': stats['near_duplicates_removed'],
+            'partial_aggregate_file': f's3://{bucket}/{aggregate_key}' if scorer is not None else None
         }
 
         # Save summary
@@ -111,24 +858,107 @@ def process_single_file(bucket, input_key):
             ContentType='application/json'
         )
 
+        if dedup_index is not None:
+            save_file_digests(bucket, input_key, claimed)
+
+        # Sharded KB lines go in last, as one unit, once everything else about the file succeeded
+        if kb_shards is not None:
+            kb_size = kb_spool.tell()
+            kb_spool.seek(0)
+            kb_shards.append_file(input_key, kb_spool, kb_size, kb_writer.count, claimed)
+            handed_off = True
+        # Only files that were fully written contribute to the cross-run index, so a retry is not deduped against itself
+        elif dedup_index is not None:
+            dedup_index.commit(claimed)
+
         return summary
 
     except Exception as e:
         logger.error(f"Error processing {input_key}: {str(e)}")
+        if dedup_index is not None and not handed_off:
+            dedup_index.release(claimed)
         raise
 
+    finally:
+        if kb_spool is not None:
+            kb_spool.close()
+
+def init_worker_process():
+    """Give each worker process its own S3 client instead of the forked parent connection pool"""
+    global s3
+    s3 = boto3.client('s3')
+
+def run_single_file(bucket, file_key, dedup_index=None, kb_shards=None):
+    """Process one file, returning (summary, error) so failures cross pool boundaries as plain strings"""
+    try:
+        return process_single_file(bucket, file_key, dedup_index, kb_shards), None
+    except Exception as e:
+        return None, str(e)
+
+def create_executor(mode, max_workers):
+    """Create the worker pool for the requested execution mode"""
+    if mode == 'process':
+        try:
+            return ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker_process)
+        except (OSError, NotImplementedError) as e:
+            # Lambda has no /dev/shm, so multiprocessing primitives are unavailable there
+            logger.warning(f"Process pool unavailable ({str(e)}), falling back to threads")
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+def process_files(bucket, file_keys, mode=None, max_workers=None, dedup_index=None, kb_shards=None):
+    """Process files sequentially or on a bounded worker pool.
+
+    Returns (processed_summaries, failed_files) in the order of `file_keys`.
+    """
+    mode = mode or EXECUTION_MODE
+    max_workers = max_workers or MAX_WORKERS
+
+    if mode == 'sequential' or max_workers <= 1 or len(file_keys) <= 1:
+        outcomes = (run_single_file(bucket, file_key, dedup_index, kb_shards) for file_key in file_keys)
+        return collect_outcomes(file_keys, outcomes)
+
+    if mode == 'process' and (dedup_index is not None or kb_shards is not None):
+        # The fingerprint index and shard writer live in this process's memory and cannot be shared with worker processes
+        logger.warning("Global dedup and KB sharding need shared state, using threads instead of processes")
+        mode = 'thread'
+
+    logger.info(f"Processing {len(file_keys)} files in {mode} mode with {max_workers} workers")
+    with create_executor(mode, max_workers) as executor:
+        futures = [executor.submit(run_single_file, bucket, file_key, dedup_index, kb_shards) for file_key in file_keys]
+        return collect_outcomes(file_keys, (future.result() for future in futures))
+
+def collect_outcomes(file_keys, outcomes):
+    """Split per-file (summary, error) outcomes into summaries and failed_files entries"""
+    processed_summaries = []
+    failed_files = []
+
+    for file_key, (summary, error) in zip(file_keys, outcomes):
+        if error is None:
+            processed_summaries.append(summary)
+            logger.info(f"Successfully processed: {file_key}")
+        else:
+            failed_files.append({
+                'file': file_key,
+                'error': error
+            })
+            logger.error(f"Failed to process {file_key}: {error}")
+
+    return processed_summaries, failed_files
+
 def lambda_handler(event, context):
     # Configuration
     bucket = 'YOUR S3 BUCKET'
     raw_folder = 'YOUR S3 RAW FOLDER'
+    kb_shards = None
     
     try:
         logger.info(f"Starting batch processing from folder: {raw_folder}")
         
-        # List all files in the raw folder
-        response = s3.list_objects_v2(Bucket=bucket, Prefix=raw_folder)
+        # List files lazily; pages beyond the first 1,000 keys are fetched on demand
+        raw_files = iter_raw_files(bucket, raw_folder)
+        first_file = next(raw_files, None)
         
-        if 'Contents' not in response:
+        if first_file is None:
             logger.warning(f"No files found in {raw_folder}")
             return {
                 'statusCode': 200,
@@ -138,42 +968,120 @@ def lambda_handler(event, context):
                 })
             }
         
-        # Filter for JSON files only
-        json_files = [
-            obj['Key'] for obj in response['Contents'] 
-            if obj['Key'].lower().endswith('.json') and obj['Key'] != raw_folder
-        ]
+        checkpoint = load_checkpoint(bucket)
+        completed = checkpoint['completed']
+        manifest = load_manifest(bucket) if INCREMENTAL else None
+        dedup_index = load_dedup_index(bucket) if GLOBAL_DEDUP else None
+        if GLOBAL_DEDUP and not INCREMENTAL:
+            logger.warning("GLOBAL_DEDUP without INCREMENTAL rescans every raw file on each run; "
+                           "set INCREMENTAL=true so only new or changed files are deduplicated")
+        if KB_SHARDING and INCREMENTAL:
+            # A changed file's new lines would land in a new shard while its old lines stay in older ones
+            logger.warning("KB sharding is not supported with INCREMENTAL, writing per-file KB outputs instead")
+        kb_shards = None
+        if KB_SHARDING and not INCREMENTAL:
+            kb_shards = KBShardWriter(bucket, checkpoint['batch_id'], checkpoint.get('next_kb_shard', 0),
+                                      dedup_index=dedup_index)
+        awaiting_shard = {}  # processed files whose KB lines are still in the open shard
         
-        logger.info(f"Found {len(json_files)} JSON files to process")
+        def mark_completed(objs):
+            for obj in objs:
+                completed[obj['Key']] = obj['ETag']
+                if manifest is not None:
+                    manifest['files'][obj['Key']] = dict(source_signature(obj), processed_at=datetime.utcnow().isoformat())
+        
+        def take_durable():
+            return [awaiting_shard.pop(key) for key in kb_shards.take_durable() if key in awaiting_shard]
         
         processed_summaries = []
         failed_files = []
+        files_skipped_checkpoint = 0
+        files_skipped_unchanged = 0
+        batch_complete = True
         
-        # Process each file
-        for file_key in json_files:
-            try:
-                summary = process_single_file(bucket, file_key)
-                processed_summaries.append(summary)
-                logger.info(f"Successfully processed: {file_key}")
-            except Exception as e:
-                failed_files.append({
-                    'file': file_key,
-                    'error': str(e)
-                })
-                logger.error(f"Failed to process {file_key}: {str(e)}")
+        all_files = itertools.chain([first_file], raw_files)
+        while True:
+            chunk = list(itertools.islice(all_files, CHECKPOINT_EVERY))
+            if not chunk:
+                break
+            
+            # Skip keys finished by an earlier invocation of this batch, unless they changed since
+            pending = []
+            for obj in chunk:
+                if completed.get(obj['Key']) == obj['ETag']:
+                    files_skipped_checkpoint += 1
+                elif manifest is not None and is_unchanged(manifest, obj):
+                    files_skipped_unchanged += 1
+                else:
+                    pending.append(obj)
+            
+            if not pending:
+                continue
+            
+            if out_of_time(context):
+                logger.warning(f"Approaching timeout, stopping batch {checkpoint['batch_id']} for resume")
+                batch_complete = False
+                break
+            
+            logger.info(f"Processing {len(pending)} JSON files")
+            summaries, failures = process_files(bucket, [obj['Key'] for obj in pending], dedup_index=dedup_index, kb_shards=kb_shards)
+            processed_summaries.extend(summaries)
+            failed_files.extend(failures)
+            
+            failed_keys = {failure['file'] for failure in failures}
+            succeeded = [obj for obj in pending if obj['Key'] not in failed_keys]
+            # Sharded files only count as completed once their shard has closed, so the
+            # checkpoint never covers KB lines that are still in an open upload
+            if kb_shards is not None:
+                awaiting_shard.update((obj['Key'], obj) for obj in succeeded)
+                succeeded = take_durable()
+                checkpoint['next_kb_shard'] = kb_shards.next_index
+            mark_completed(succeeded)
+            # The index is saved before the checkpoint so resumed batches never skip files missing from it
+            if dedup_index is not None:
+                save_dedup_index(bucket, dedup_index)
+            save_checkpoint(bucket, checkpoint)
+            if manifest is not None:
+                save_manifest(bucket, manifest)
+        
+        # The one shard writer of this invocation is finished last, making the files left in it durable
+        if kb_shards is not None:
+            kb_shards.close()
+            mark_completed(take_durable())
+            checkpoint['next_kb_shard'] = kb_shards.next_index
+            if awaiting_shard:
+                # Their shard was aborted: leave the batch open so a resumed invocation redoes them
+                batch_complete = False
+            if dedup_index is not None:
+                save_dedup_index(bucket, dedup_index)
+            save_checkpoint(bucket, checkpoint)
+        
+        # A finished batch starts over on the next invocation
+        if batch_complete:
+            delete_state(bucket, CHECKPOINT_KEY, CHECKPOINT_PATH)
+            if kb_shards is not None:
+                retire_previous_shards(bucket, kb_shards, keep_previous=bool(failed_files))
         
         # Create overall summary
         total_input_records = sum(s['total_input_records'] for s in processed_summaries)
         total_cleaned_records = sum(s['cleaned_records'] for s in processed_summaries)
+        total_global_duplicates = sum(s.get('global_duplicates_removed', 0) for s in processed_summaries)
         
         result = {
             'statusCode': 200,
             'body': json.dumps({
-                'message': f'Batch processing completed',
+                'message': 'Batch processing completed' if batch_complete else 'Batch paused for resume',
                 'files_processed': len(processed_summaries),
                 'files_failed': len(failed_files),
+                'files_skipped_checkpoint': files_skipped_checkpoint,
+                'files_skipped_unchanged': files_skipped_unchanged,
+                'incremental': INCREMENTAL,
+                'batch_id': checkpoint['batch_id'],
+                'batch_complete': batch_complete,
                 'total_input_records': total_input_records,
                 'total_cleaned_records': total_cleaned_records,
+                'total_global_duplicates_removed': total_global_duplicates,
+                'kb_shards': kb_shards.shards if kb_shards is not None else [],
                 'failed_files': failed_files,
                 'processed_summaries': processed_summaries
             })
@@ -184,6 +1092,8 @@ def lambda_handler(event, context):
 
     except Exception as e:
         logger.error(f"Error during batch processing: {str(e)}")
+        if kb_shards is not None:
+            kb_shards.abort()
         return {
             'statusCode': 500,
             'body': json.dumps({
@@ -1,7 +1,10 @@
 # Code to ingest data from S3 bucket to Bedrock Knowledge Base with conflict handling
 import json
 import boto3
+import fcntl
 import logging
+import os
+import random
 import uuid
 import time
 from botocore.exceptions import ClientError
@@ -10,6 +13,7 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 bedrock = boto3.client("bedrock-agent")
+s3 = boto3.client("s3")
 
 # Configuration
 KB_ID = "YOUR KNOWLEDGEBASE ID"
@@ -17,6 +21,26 @@ DATA_SOURCE_ID = "YOUR SOURCE ID"
 MAX_RETRIES = 3
 RETRY_DELAY = 30  # seconds
 WAIT_FOR_COMPLETION = False  # Set to True if you want to wait for job completion
+COALESCE_INGESTION = os.environ.get('COALESCE_INGESTION', 'false').lower() == 'true'  # one ingestion job per burst of uploads
+DEBOUNCE_SECONDS = float(os.environ.get('DEBOUNCE_SECONDS', '15'))  # window collecting events before the job starts
+STATE_BUCKET = os.environ.get('S3_BUCKET', '')
+STATE_KEY = os.environ.get('INGESTION_STATE_KEY', 'socialgist-state/kb-ingestion-state.json')
+STATE_PATH = os.environ.get('INGESTION_STATE_PATH')  # local file instead of S3, e.g. for testing off-Lambda
+ASYNC_JOB_TRACKING = os.environ.get('ASYNC_JOB_TRACKING', 'false').lower() == 'true'  # never sleep on conflicts or poll in-process
+POLL_BASE_SECONDS = float(os.environ.get('POLL_BASE_SECONDS', '15'))  # first poll / retry delay, doubled per attempt
+POLL_MAX_SECONDS = float(os.environ.get('POLL_MAX_SECONDS', '600'))
+JOB_HISTORY_SIZE = int(os.environ.get('JOB_HISTORY_SIZE', '100'))  # completed jobs kept in the state object
+STALE_WINDOW_SECONDS = float(os.environ.get('STALE_WINDOW_SECONDS', '900'))  # windows older than this lost their owner
+# Conditional writes lost to concurrent updates before giving up; sized so a burst of a few hundred
+# events settles, with jittered waits doubling up to STATE_WRITE_MAX_DELAY (about 20 seconds in all)
+STATE_WRITE_RETRIES = int(os.environ.get('STATE_WRITE_RETRIES', '40'))
+STATE_WRITE_MAX_DELAY = float(os.environ.get('STATE_WRITE_MAX_DELAY', '1.0'))
+
+class StateWriteError(Exception):
+    """The ingestion state object could not be read or updated; the invocation must fail so Lambda retries it"""
+
+class StateConflict(StateWriteError):
+    """The ingestion state object changed between our read and our conditional write"""
 
 def check_existing_jobs(kb_id):
     """Check if there are any running ingestion jobs"""
@@ -66,10 +90,10 @@ def wait_for_job_completion(kb_id, job_id, timeout=300):
     logger.warning(f"Job {job_id} did not complete within {timeout} seconds")
     return "TIMEOUT"
 
-def start_ingestion_with_retry(kb_id, data_source_id, s3_key):
+def start_ingestion_with_retry(kb_id, data_source_id, s3_key, max_retries=MAX_RETRIES):
     """Start ingestion job with retry logic for conflicts"""
     
-    for attempt in range(MAX_RETRIES):
+    for attempt in range(max_retries):
         try:
             # Check for existing jobs first
             running_jobs = check_existing_jobs(kb_id)
@@ -77,7 +101,7 @@ def start_ingestion_with_retry(kb_id, data_source_id, s3_key):
             if running_jobs:
                 logger.info(f"Attempt {attempt + 1}: Found {len(running_jobs)} running jobs")
                 
-                if attempt < MAX_RETRIES - 1:  # Not the last attempt
+                if attempt < max_retries - 1:  # Not the last attempt
                     logger.info(f"Waiting {RETRY_DELAY} seconds before retry...")
                     time.sleep(RETRY_DELAY)
                     continue
@@ -119,7 +143,7 @@ def start_ingestion_with_retry(kb_id, data_source_id, s3_key):
             if error_code == 'ConflictException':
                 logger.warning(f"Attempt {attempt + 1}: ConflictException - KB already in use")
                 
-                if attempt < MAX_RETRIES - 1:
+                if attempt < max_retries - 1:
                     logger.info(f"Retrying in {RETRY_DELAY} seconds...")
                     time.sleep(RETRY_DELAY)
                     continue
@@ -151,10 +175,304 @@ def start_ingestion_with_retry(kb_id, data_source_id, s3_key):
         'reason': 'max_retries_exceeded'
     }
 
+def empty_ingestion_state():
+    return {'window': None, 'pending_files': [], 'last_job': None, 'pending_since': None, 'start_attempts': 0,
+            'next_attempt_at': 0, 'tracked_jobs': [], 'completed_jobs': []}
+
+def read_ingestion_state():
+    """
+    Read the ingestion state object and its version: the S3 ETag, or None while
+    the object does not exist yet (always None for STATE_PATH)
+    """
+    try:
+        if STATE_PATH:
+            if not os.path.exists(STATE_PATH):
+                return empty_ingestion_state(), None
+            with open(STATE_PATH) as f:
+                return dict(empty_ingestion_state(), **json.load(f)), None
+        response = s3.get_object(Bucket=STATE_BUCKET, Key=STATE_KEY)
+        return dict(empty_ingestion_state(), **json.loads(response['Body'].read())), response['ETag']
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return empty_ingestion_state(), None
+        raise
+
+def load_ingestion_state():
+    """Read the ingestion state object from STATE_PATH if set, otherwise from S3"""
+    return read_ingestion_state()[0]
+
+def save_ingestion_state(state, version=None):
+    """
+    Write the ingestion state object to STATE_PATH if set, otherwise to S3. The
+    S3 put is conditional on the version read: it creates the object only if it
+    still does not exist, or replaces it only if its ETag is unchanged, and
+    raises StateConflict when another invocation wrote in between.
+    """
+    body = json.dumps(state, indent=2)
+    if STATE_PATH:
+        # Replace atomically so a crash mid-write never leaves a truncated state file
+        temp_path = f"{STATE_PATH}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(body)
+        os.replace(temp_path, STATE_PATH)
+        return
+    condition = {'IfMatch': version} if version else {'IfNoneMatch': '*'}
+    try:
+        s3.put_object(Bucket=STATE_BUCKET, Key=STATE_KEY, Body=body, ContentType='application/json', **condition)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            raise StateConflict(f"{STATE_KEY} changed concurrently") from e
+        raise
+
+def update_ingestion_state(mutate):
+    """
+    Read-modify-write of the state object that never loses a concurrent update:
+    ``mutate(state)`` edits the state in place and returns a result, and runs
+    again on a fresh read whenever the conditional write loses, so it must not
+    have side effects. STATE_PATH updates are serialized with a file lock.
+    """
+    if STATE_PATH:
+        with open(f"{STATE_PATH}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = load_ingestion_state()
+            result = mutate(state)
+            save_ingestion_state(state)
+            return result
+    
+    for attempt in range(STATE_WRITE_RETRIES):
+        try:
+            state, version = read_ingestion_state()
+            result = mutate(state)
+            save_ingestion_state(state, version)
+            return result
+        except StateConflict:
+            logger.info(f"Ingestion state changed concurrently, retrying update (attempt {attempt + 1})")
+            time.sleep(random.uniform(0, min(STATE_WRITE_MAX_DELAY, 0.05 * (2 ** attempt))))
+        except ClientError as e:
+            raise StateWriteError(f"Could not update {STATE_KEY}: {str(e)}") from e
+    raise StateConflict(f"Gave up updating {STATE_KEY} after {STATE_WRITE_RETRIES} conflicting writes")
+
+def add_pending_files(state, s3_keys):
+    """Append new keys to the state's pending list, keeping upload order"""
+    pending = state['pending_files']
+    if s3_keys and not pending:
+        state['pending_since'] = time.time()
+    pending.extend(key for key in s3_keys if key not in pending)
+
+def backoff_delay(attempt):
+    """Exponential delay for the given attempt (0-based), capped and jittered to between half and all of it"""
+    delay = min(POLL_MAX_SECONDS, POLL_BASE_SECONDS * (2 ** attempt))
+    return random.uniform(delay / 2, delay)
+
+def job_duration_seconds(job, tracked):
+    """Ingestion duration from the job's own timestamps, falling back to the time we started tracking it"""
+    started_at, updated_at = job.get('startedAt'), job.get('updatedAt')
+    if started_at and updated_at:
+        return round((updated_at - started_at).total_seconds(), 1)
+    return round(time.time() - tracked['started_at'], 1)
+
+def window_is_open(state, now):
+    """True while a coalescing window is open and its owner is presumed alive"""
+    window = state['window']
+    return bool(window) and now - window['opened_at'] < STALE_WINDOW_SECONDS
+
+def fetch_due_jobs(state, now):
+    """Ask Bedrock for the status of tracked jobs whose next poll is due"""
+    polls = {}
+    for tracked in state['tracked_jobs']:
+        if tracked['next_poll_at'] > now:
+            continue
+        try:
+            polls[tracked['job_id']] = bedrock.get_ingestion_job(
+                knowledgeBaseId=KB_ID,
+                dataSourceId=DATA_SOURCE_ID,
+                ingestionJobId=tracked['job_id']
+            )['ingestionJob']
+        except Exception as e:
+            logger.error(f"Error checking job {tracked['job_id']}: {str(e)}")
+            polls[tracked['job_id']] = {'status': 'UNKNOWN'}
+    return polls
+
+def apply_job_polls(state, polls, now):
+    """Fold poll results into the tracked jobs; finished jobs move to the completed history"""
+    still_running = []
+    for tracked in state['tracked_jobs']:
+        job = polls.get(tracked['job_id'])
+        if job is None or tracked['next_poll_at'] > now:
+            # Not polled, or another invocation recorded a poll since we read the state
+            still_running.append(tracked)
+            continue
+        
+        if job['status'] in ('COMPLETE', 'FAILED', 'STOPPED'):
+            completed = {
+                'job_id': tracked['job_id'],
+                'status': job['status'],
+                'files': tracked['files'],
+                'duration_seconds': job_duration_seconds(job, tracked),
+                'latency_seconds': round(now - tracked['queued_at'], 1),  # first queued upload to observed completion
+                'completed_at': now
+            }
+            state['completed_jobs'] = (state['completed_jobs'] + [completed])[-JOB_HISTORY_SIZE:]
+            logger.info(f"Ingestion job finished: {json.dumps(completed)}")
+            continue
+        
+        tracked['polls'] += 1
+        tracked['next_poll_at'] = now + backoff_delay(tracked['polls'])
+        still_running.append(tracked)
+    state['tracked_jobs'] = still_running
+
+def mark_batch_started(state, batch, job_id, now):
+    """Record a started job and drop its batch from the pending list; keys queued since stay pending"""
+    state['last_job'] = {'job_id': job_id, 'started_at': now, 'files': len(batch)}
+    state['pending_files'] = [key for key in state['pending_files'] if key not in batch]
+    state.update(start_attempts=0, next_attempt_at=0)
+    if not state['pending_files']:
+        state['pending_since'] = None
+
+def mark_start_failed(state, result, now):
+    """Leave the batch pending and back off before the next start attempt"""
+    state['next_attempt_at'] = now + backoff_delay(state['start_attempts'])
+    state['start_attempts'] += 1
+    logger.info(f"Ingestion not started ({result['reason']}), next attempt in "
+                f"{state['next_attempt_at'] - now:.0f} seconds")
+
+def track_ingestion(s3_keys):
+    """
+    Non-blocking step of the async tracking mode, also run by the scheduled
+    sweep: queue keys, poll due jobs, then start one job for all pending files
+    if none is running, no coalescing window is open (its owner starts the job)
+    and the retry backoff elapsed. A conflict only pushes next_attempt_at out,
+    so no invocation ever sleeps. Bedrock calls happen between conditional
+    state updates, and a start is claimed by pushing next_attempt_at past it,
+    so concurrent sweeps neither lose each other's writes nor start twice.
+    """
+    now = time.time()
+    polls = fetch_due_jobs(load_ingestion_state(), now)
+    
+    def queue_and_claim(state):
+        add_pending_files(state, s3_keys)
+        apply_job_polls(state, polls, now)
+        if (not state['pending_files'] or state['tracked_jobs'] or window_is_open(state, now)
+                or now < state['next_attempt_at']):
+            return None
+        state['next_attempt_at'] = now + RETRY_DELAY + 10
+        return list(state['pending_files']), state['pending_since'] or now
+    
+    claim = update_ingestion_state(queue_and_claim)
+    started = None
+    if claim:
+        batch, queued_at = claim
+        result = start_ingestion_with_retry(KB_ID, DATA_SOURCE_ID, f"{len(batch)} queued files", max_retries=1)
+        
+        def record_start(state):
+            now = time.time()
+            if not result['success']:
+                mark_start_failed(state, result, now)
+                return
+            state['tracked_jobs'].append({
+                'job_id': result['job_id'],
+                'files': len(batch),
+                'queued_at': queued_at,
+                'started_at': now,
+                'polls': 0,
+                'next_poll_at': now + backoff_delay(0)
+            })
+            mark_batch_started(state, batch, result['job_id'], now)
+        
+        update_ingestion_state(record_start)
+        started = result.get('job_id')
+    
+    state = load_ingestion_state()
+    return {
+        'success': True,
+        'status': 'started' if started else 'pending',
+        'job_id': started,
+        'pending_files': len(state['pending_files']),
+        'tracked_jobs': [tracked['job_id'] for tracked in state['tracked_jobs']]
+    }
+
+def coalesce_ingestion(s3_keys, context=None):
+    """
+    Debounced ingestion: every event queues its keys with a conditional update
+    of the state object. The one update that finds no open window (or a stale
+    one) opens it and makes its invocation the owner; all others only queue and
+    return, never touching the window. The owner sleeps out the window, closes
+    it, and starts a single ingestion job for everything queued. Keys leave the
+    pending list only once a job started for them, so a failed start leaves the
+    batch for the scheduled sweep to retry.
+    """
+    token = getattr(context, 'aws_request_id', None) or str(uuid.uuid4())
+    
+    def queue_or_open(state):
+        add_pending_files(state, s3_keys)
+        if window_is_open(state, time.time()):
+            return state['window']['owner']
+        state['window'] = {'owner': token, 'opened_at': time.time()}
+        return token
+    
+    owner = update_ingestion_state(queue_or_open)
+    if owner != token:
+        logger.info(f"Queued {len(s3_keys)} files into the open ingestion window of {owner}")
+        return {'success': True, 'status': 'queued', 'window_owner': owner}
+    
+    delay = DEBOUNCE_SECONDS
+    if context is not None:
+        # Leave room for the ingestion call itself
+        delay = max(0, min(delay, context.get_remaining_time_in_millis() / 1000 - 10))
+    logger.info(f"Opened ingestion window, collecting events for {delay:.0f} seconds")
+    time.sleep(delay)
+    
+    # Conflict retries sleep RETRY_DELAY each, so only as many as the invocation has time for
+    retries = MAX_RETRIES
+    if context is not None:
+        retries = max(1, min(MAX_RETRIES, int((context.get_remaining_time_in_millis() / 1000 - 10) // RETRY_DELAY) + 1))
+    
+    def close_window(state):
+        window = state['window']
+        if not window or window['owner'] != token:
+            return None
+        # Close before starting, so uploads landing during ingestion open the next window
+        state['window'] = None
+        if not ASYNC_JOB_TRACKING:
+            # Hold the sweep off until the start below has had its retries
+            state['next_attempt_at'] = max(state['next_attempt_at'], time.time() + retries * RETRY_DELAY + 10)
+        return list(state['pending_files'])
+    
+    batch = update_ingestion_state(close_window)
+    if batch is None:
+        # The window went stale and another invocation took it over with everything queued
+        logger.warning("Lost the ingestion window to a newer owner")
+        return {'success': True, 'status': 'queued', 'window_owner': None}
+    if ASYNC_JOB_TRACKING:
+        return track_ingestion([])
+    
+    logger.info(f"Starting one ingestion job for {len(batch)} coalesced files")
+    result = start_ingestion_with_retry(KB_ID, DATA_SOURCE_ID, f"{len(batch)} coalesced files", retries)
+    
+    def record_start(state):
+        if result['success']:
+            mark_batch_started(state, batch, result['job_id'], time.time())
+        else:
+            # The batch stays pending: the scheduled sweep retries it with backoff
+            mark_start_failed(state, result, time.time())
+    
+    update_ingestion_state(record_start)
+    return dict(result, status='started' if result['success'] else 'failed', files=batch)
+
 def lambda_handler(event, context):
     try:
         processed_files = []
         skipped_files = []
+        queued_files = []
+        
+        # Scheduled sweep (e.g. an EventBridge rule): advance tracked jobs and retry pending files
+        if event.get('sweep') or event.get('source') == 'aws.events':
+            result = track_ingestion([])
+            logger.info(f"Sweep result: {json.dumps(result)}")
+            return {
+                "statusCode": 200,
+                "body": json.dumps({"message": "Ingestion sweep completed", "result": result})
+            }
         
         # Handle manual testing vs actual S3 events
         if "Records" not in event:
@@ -186,6 +504,9 @@ def lambda_handler(event, context):
             # Trigger only for content added to the KB folder
             if s3_key.startswith("socialgist-kb/") and s3_key.endswith(".jsonl"):
                 logger.info(f"Valid KB file detected: {s3_key}")
+                if COALESCE_INGESTION or ASYNC_JOB_TRACKING:
+                    queued_files.append(s3_key)
+                    continue
                 
                 # Start ingestion with retry logic
                 result = start_ingestion_with_retry(KB_ID, DATA_SOURCE_ID, s3_key)
@@ -207,6 +528,20 @@ def lambda_handler(event, context):
                 logger.info(f"Skipping file - does not match KB pattern: {s3_key}")
                 skipped_files.append(s3_key)
 
+        # One debounced or tracked ingestion for every KB file in this event
+        if queued_files:
+            if COALESCE_INGESTION:
+                result = coalesce_ingestion(queued_files, context)
+            else:
+                result = track_ingestion(queued_files)
+            for s3_key in queued_files:
+                processed_files.append({
+                    'file': s3_key,
+                    'job_id': result.get('job_id'),
+                    'status': result['status'],
+                    'reason': result.get('reason')
+                })
+
         # Summary response
         response_body = {
             "message": "S3 event processing completed",
@@ -223,6 +558,10 @@ def lambda_handler(event, context):
             "body": json.dumps(response_body)
         }
 
+    except StateWriteError as e:
+        # Queued keys only live in the state object: fail the invocation so Lambda's async retry redelivers them
+        logger.error(f"Ingestion state update failed: {str(e)}")
+        raise
     except Exception as e:
         logger.error(f"Lambda handler error: {str(e)}")
         return {
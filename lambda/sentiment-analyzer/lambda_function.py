@@ -1,24 +1,213 @@
-def generate_executive_summary(results):
-    """
-    Enhanced executive summary for business stakeholders
-    """
-    if not results:
-        return "No streaming properties analyzed - insufficient data in Knowledge Base."
-    
-    total_mentions = sum(r['total_mentions'] for r in results)
-    total_properties = len(results)
-    
-    # Business insights
-    high_priority = [r for r in results if 'Action Needed' in r.get('priority_level', '')]
-    positive_trending = [# Enhanced Streaming Service Bulk Sentiment Analyzer with QuickSight optimizations
+# Enhanced Streaming Service Bulk Sentiment Analyzer with QuickSight optimizations
 import json
+import base64
+import gzip
 import boto3
+import hashlib
+import io
+import math
 import re
-from collections import defaultdict
+import sys
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import queue
 import datetime
+import itertools
+import multiprocessing
 from typing import Dict, List
 import uuid
 import os
+import random
+import threading
+import time
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectTimeoutError, ReadTimeoutError
+
+# Shared with the data cleaner; deployment packages bundle lambda/shared at their root
+SHARED_MODULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared')
+if os.path.isdir(SHARED_MODULES_PATH):  # running from the repository
+    sys.path.append(SHARED_MODULES_PATH)
+from fingerprint_index import FingerprintIndex
+from json_stream import JsonStreamReader
+from sentiment_scoring import (
+    PARTIAL_AGGREGATE_VERSION, PARTIAL_AGGREGATE_MAGIC, STREAMING_PROPERTIES, GENERAL_STREAMING, THEME_PATTERNS,
+    TEXT_MATCHER, analyze_text, aggregate_property_records, make_partial, merge_partials, serialize_partial,
+    deserialize_partial, merge_property_aggregates, subtract_property_aggregates)
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:  # optional: SCORING_ENGINE=matrix
+    np = None
+    sparse = None
+
+try:
+    import zstandard
+except ImportError:  # optional: only needed to read *.jsonl.zst cleaned output
+    zstandard = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional: only needed to read *.parquet cleaned output
+    pa = None
+    pq = None
+
+# Cleaned data-cleaner outputs the batch analysis source reads (object basename prefixes and extensions)
+SOURCE_FILE_PREFIXES = ('clean-', 'ready-')
+SOURCE_FILE_EXTENSIONS = ('.json', '.jsonl', '.jsonl.gz', '.jsonl.zst', '.parquet')
+
+# Generic streaming service search terms (no specific brand references), by priority tier
+SEARCH_TERM_TIERS = {
+    # Core streaming services (high priority)
+    'high': ['streaming service reviews', 'video streaming platform', 'subscription streaming',
+             'on demand content', 'streaming app feedback'],
+    
+    # Content categories (medium priority)
+    'medium': ['original series streaming', 'movie streaming service', 'live TV streaming',
+               'sports streaming platform', 'news streaming service'],
+    
+    # Technical aspects (lower priority but comprehensive) and general streaming sentiment
+    'low': ['streaming quality issues', 'buffering problems', 'app crashes',
+            'streaming device compatibility', 'streaming subscription cost',
+            'cord cutting experience', 'streaming vs cable',
+            'streaming platform comparison', 'binge watching experience']
+}
+STREAMING_SEARCH_TERMS = [term for terms in SEARCH_TERM_TIERS.values() for term in terms]
+
+# Layout version of the persisted incremental-analysis state (3: seen digests in a fixed-size Bloom filter)
+INCREMENTAL_STATE_VERSION = 3
+
+# Bedrock error codes worth retrying with backoff
+THROTTLING_ERROR_CODES = {'ThrottlingException', 'TooManyRequestsException', 'ServiceUnavailableException'}
+
+class HitMatrixEngine:
+    """
+    Batch scorer over a sparse texts x keywords hit matrix.
+
+    Texts are scanned once with the shared matcher; weighted scores,
+    classification, confidence and per-property aggregates are then
+    computed with NumPy/SciPy matrix products. Property and theme order
+    follow first appearance so results match the per-record path.
+    """
+
+    def __init__(self, matcher=None):
+        if np is None or sparse is None:
+            raise ImportError("numpy and scipy are required for SCORING_ENGINE=matrix")
+        self.matcher = matcher or TEXT_MATCHER
+        self.keywords = list(self.matcher.entries)
+        self.keyword_index = {word: i for i, word in enumerate(self.keywords)}
+        self.properties = list(STREAMING_PROPERTIES) + [GENERAL_STREAMING]
+        self.themes = [theme.replace('_', ' ') for theme in THEME_PATTERNS]
+        property_index = {name: i for i, name in enumerate(self.properties)}
+        theme_index = {theme: i for i, theme in enumerate(THEME_PATTERNS)}
+
+        num_keywords = len(self.keywords)
+        self.sentiment_weights = np.zeros((num_keywords, 2))
+        property_cells = ([], [])
+        theme_cells = ([], [])
+        for word, entries in self.matcher.entries.items():
+            row = self.keyword_index[word]
+            for (kind, name), weight in entries:
+                if kind == 'sentiment':
+                    self.sentiment_weights[row, 0 if name == 'positive' else 1] += weight
+                elif kind == 'property':
+                    property_cells[0].append(row)
+                    property_cells[1].append(property_index[name])
+                elif kind == 'theme':
+                    theme_cells[0].append(row)
+                    theme_cells[1].append(theme_index[name])
+        self.property_map = self._binary((num_keywords, len(self.properties)), *property_cells)
+        self.theme_map = self._binary((num_keywords, len(self.themes)), *theme_cells)
+
+    @staticmethod
+    def _binary(shape, rows, cols):
+        data = np.ones(len(rows), dtype=np.int32)
+        return sparse.csr_matrix((data, (rows, cols)), shape=shape)
+
+    def encode(self, texts):
+        """Return the CSR hit matrix (texts x keywords) for an iterable of texts."""
+        indices = []
+        indptr = [0]
+        if self.matcher.automaton is not None:
+            # Repeated keywords become duplicate entries, collapsed below
+            keyword_index = self.keyword_index
+            automaton = self.matcher.automaton
+            for text in texts:
+                indices.extend(keyword_index[word] for _, word in automaton.iter(text.lower()))
+                indptr.append(len(indices))
+        else:
+            for text in texts:
+                indices.extend(self.keyword_index[word] for word in self.matcher.find(text.lower()))
+                indptr.append(len(indices))
+        data = np.ones(len(indices), dtype=np.int32)
+        hits = sparse.csr_matrix((data, np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int64)),
+                                 shape=(len(indptr) - 1, len(self.keywords)))
+        hits.sum_duplicates()
+        hits.data[:] = 1
+        return hits
+
+    def score(self, hits):
+        """Weighted scores, classification masks and per-text confidence."""
+        scores = hits @ self.sentiment_weights
+        positive, negative = scores[:, 0], scores[:, 1]
+        is_positive = positive > negative
+        is_negative = negative > positive
+        denominator = positive + negative + 0.1
+        confidence = np.where(is_positive, positive / denominator, np.where(is_negative, negative / denominator, 0.1))
+        return is_positive, is_negative, confidence
+
+    def memberships(self, hits):
+        """Boolean texts x properties matrix, General Streaming only as a fallback."""
+        matched = (hits @ self.property_map) > 0
+        specific = np.asarray(matched[:, :-1].sum(axis=1)).ravel() > 0
+        fallback = sparse.diags((~specific).astype(np.int32), dtype=np.int32) @ matched[:, -1:]
+        return sparse.hstack([matched[:, :-1], fallback], format='csc').astype(np.int32), specific
+
+    def aggregate(self, texts):
+        """
+        Return (aggregates, matched_count, text_count) where aggregates lists dicts
+        with property, positive, negative, neutral, total, confidence_sum and theme_mentions.
+        """
+        hits = self.encode(texts)
+        is_positive, is_negative, confidence = self.score(hits)
+        membership, specific = self.memberships(hits)
+        membership.sort_indices()
+        theme_hits = ((hits @ self.theme_map) > 0).astype(np.int32).tocsr()
+
+        totals = np.asarray(membership.sum(axis=0)).ravel()
+        positives = membership.T @ is_positive.astype(np.int64)
+        negatives = membership.T @ is_negative.astype(np.int64)
+        confidence_sums = membership.T @ confidence
+
+        aggregates = []
+        for column in range(len(self.properties)):
+            rows = membership.indices[membership.indptr[column]:membership.indptr[column + 1]]
+            if not len(rows):
+                continue
+            aggregates.append((rows[0], column, {
+                'property': self.properties[column],
+                'positive': int(positives[column]),
+                'negative': int(negatives[column]),
+                'neutral': int(totals[column] - positives[column] - negatives[column]),
+                'total': int(totals[column]),
+                'confidence_sum': float(confidence_sums[column]),
+                'theme_mentions': self._theme_mentions(theme_hits[rows])
+            }))
+        aggregates.sort(key=lambda item: item[:2])
+        return [item[2] for item in aggregates], int(specific.sum()), hits.shape[0]
+
+    def _theme_mentions(self, theme_hits):
+        """Theme counts for one property, keyed in first-seen order."""
+        theme_hits = theme_hits.tocsc()
+        theme_hits.sort_indices()
+        first_seen = []
+        for column in range(len(self.themes)):
+            start, end = theme_hits.indptr[column], theme_hits.indptr[column + 1]
+            if end > start:
+                first_seen.append((theme_hits.indices[start], column, end - start))
+        first_seen.sort()
+        return {self.themes[column]: int(count) for _, column, count in first_seen}
 
 def lambda_handler(event, context):
     """
@@ -27,48 +216,134 @@ def lambda_handler(event, context):
     """
     print("🚀 Starting Streaming Service Bulk Sentiment Analysis (Enhanced Edition)...")
     
-    # Initialize clients
-    bedrock_agent_client = boto3.client('bedrock-agent-runtime')
-    s3_client = boto3.client('s3')
-    
     # Configuration from environment variables
     config = {
         'knowledge_base_id': os.environ.get('KNOWLEDGE_BASE_ID', 'YOUR_KB_ID_HERE'),
         's3_bucket': os.environ.get('S3_BUCKET', 'your-streaming-sentiment-bucket'),
         's3_output_key': 'sentiment-trend-analyzer/sentiment-trends.json',
         'min_mentions_threshold': int(os.environ.get('MIN_MENTIONS_THRESHOLD', '3')),
-        'max_results_per_search': 30  # Increased for better coverage
+        'scoring_engine': os.environ.get('SCORING_ENGINE', 'records').lower(),
+        'max_results_per_search': int(os.environ.get('RETRIEVE_PAGE_SIZE', '30')),  # Page size per retrieve call
+        'term_budgets': {
+            'high': int(os.environ.get('TERM_BUDGET_HIGH', '300')),
+            'medium': int(os.environ.get('TERM_BUDGET_MEDIUM', '150')),
+            'low': int(os.environ.get('TERM_BUDGET_LOW', '60'))
+        },
+        'max_total_documents': int(os.environ.get('MAX_TOTAL_DOCUMENTS', '10000')),
+        'retrieve_buffer_pages': int(os.environ.get('RETRIEVE_BUFFER_PAGES', '2')),
+        'retrieve_concurrency': int(os.environ.get('RETRIEVE_CONCURRENCY', '8')),
+        'retrieve_timeout': float(os.environ.get('RETRIEVE_TIMEOUT', '30')),
+        'retrieve_max_retries': int(os.environ.get('RETRIEVE_MAX_RETRIES', '4')),
+        'data_source_id': os.environ.get('DATA_SOURCE_ID', ''),
+        # Cached pages are only safe when keyed on the KB ingestion version, which needs the data source
+        'retrieve_cache_size': int(os.environ.get('RETRIEVE_CACHE_SIZE', '512' if os.environ.get('DATA_SOURCE_ID') else '0')),
+        'retrieve_cache_ttl': float(os.environ.get('RETRIEVE_CACHE_TTL', '3600')),
+        'retrieve_cache_key': os.environ.get('RETRIEVE_CACHE_KEY', ''),
+        'retrieve_cache_path': os.environ.get('RETRIEVE_CACHE_PATH', ''),
+        'incremental': os.environ.get('INCREMENTAL_ANALYSIS', 'false').lower() == 'true',
+        'state_key': os.environ.get('ANALYZER_STATE_KEY', 'sentiment-trend-analyzer/state/incremental-state.json'),
+        'state_path': os.environ.get('ANALYZER_STATE_PATH', ''),
+        'seen_capacity': int(os.environ.get('SEEN_DIGEST_CAPACITY', '1000000')),  # expected distinct documents
+        'seen_false_positive_rate': float(os.environ.get('SEEN_DIGEST_FALSE_POSITIVE_RATE', '0.001')),
+        'seen_max_bytes': int(os.environ.get('SEEN_DIGEST_MAX_BYTES', str(16 * 1024 * 1024))),
+        'trend_granularities': [g.strip() for g in os.environ.get('TREND_GRANULARITIES', '').split(',') if g.strip()],
+        'trend_prefix': os.environ.get('TREND_PREFIX', 'sentiment-trend-analyzer/trends/'),
+        'trend_path': os.environ.get('TREND_PATH', ''),
+        'trend_series_buckets': int(os.environ.get('TREND_SERIES_BUCKETS', '24')),
+        'trend_rolling_window': int(os.environ.get('TREND_ROLLING_WINDOW', '3')),
+        'trend_compact_grace': float(os.environ.get('TREND_COMPACT_GRACE_SECONDS', '900')),  # covers runs still finishing
+        'anomaly_detection': os.environ.get('ANOMALY_DETECTION', 'false').lower() == 'true',
+        'anomaly_state_key': os.environ.get('ANOMALY_STATE_KEY', 'sentiment-trend-analyzer/state/anomaly-state.json'),
+        'anomaly_state_path': os.environ.get('ANOMALY_STATE_PATH', ''),
+        'anomaly_alpha': float(os.environ.get('ANOMALY_EWMA_ALPHA', '0.3')),
+        'anomaly_z_threshold': float(os.environ.get('ANOMALY_Z_THRESHOLD', '3')),
+        'anomaly_min_delta': float(os.environ.get('ANOMALY_MIN_DELTA', '10')),
+        'anomaly_warmup': int(os.environ.get('ANOMALY_WARMUP_BATCHES', '3')),
+        'anomaly_min_mentions': int(os.environ.get('ANOMALY_MIN_MENTIONS', '5')),
+        'analysis_workers': int(os.environ.get('ANALYSIS_WORKERS', '1')),
+        'analysis_chunk_size': int(os.environ.get('ANALYSIS_CHUNK_SIZE', '5000')),
+        'analysis_source': (event or {}).get('analysis_source', os.environ.get('ANALYSIS_SOURCE', 'kb')).lower(),
+        'source_bucket': os.environ.get('ANALYSIS_SOURCE_BUCKET', os.environ.get('S3_BUCKET', 'your-streaming-sentiment-bucket')),
+        'source_prefixes': [p.strip() for p in os.environ.get('ANALYSIS_SOURCE_PREFIXES', 'socialgist-processed/clean-').split(',') if p.strip()],
+        'source_path': os.environ.get('ANALYSIS_SOURCE_PATH', ''),
+        'source_concurrency': int(os.environ.get('ANALYSIS_SOURCE_CONCURRENCY', '8')),
+        'source_prefetch_bytes': int(os.environ.get('ANALYSIS_SOURCE_PREFETCH_BYTES', str(64 * 1024 * 1024))),
+        'aggregate_prefixes': [p.strip() for p in os.environ.get('PARTIAL_AGGREGATE_PREFIXES', 'socialgist-processed/aggregate-').split(',') if p.strip()]
     }
     
+    scoring_stats = {'requested': config['analysis_workers'], 'started': 0, 'fallback': None}
+    scoring_workers = []
+    
+    # Initialize clients
+    bedrock_agent_client = create_bedrock_agent_client(config)
+    s3_client = boto3.client('s3')
+    
     try:
-        # Step 1: Get all feedback data from Knowledge Base
-        print("📥 Step 1: Retrieving feedback data from Knowledge Base...")
-        all_feedback_data = get_streaming_feedback_data(bedrock_agent_client, config)
-        print(f"✅ Retrieved {len(all_feedback_data)} feedback records")
-        
-        if not all_feedback_data:
-            return create_response(400, {'error': 'No data retrieved from Knowledge Base'})
-        
-        # Step 2: Group by streaming properties
-        print("🏷️  Step 2: Grouping feedback by streaming properties...")
-        streaming_property_groups = group_by_streaming_properties(all_feedback_data, config['min_mentions_threshold'])
-        print(f"✅ Found {len(streaming_property_groups)} streaming properties: {list(streaming_property_groups.keys())}")
+        # Step 1: Stream feedback data from Knowledge Base (or cleaned S3/local files) straight into grouping
+        if config['analysis_source'] not in ('kb', 'files', 'aggregates'):
+            raise ValueError(f"Unsupported ANALYSIS_SOURCE: {config['analysis_source']} (expected kb, files or aggregates)")
+        if config['analysis_workers'] > 1 and config['analysis_source'] != 'aggregates':
+            # Fork now, before the retrieval cache, state loads or any pool can start a thread
+            scoring_workers = start_scoring_workers(config['scoring_engine'], config['analysis_workers'], scoring_stats)
+        batch_source = config['analysis_source'] != 'kb'
+        retrieval_cache = None
+        if batch_source:
+            print(f"📥 Step 1: Streaming cleaned {config['analysis_source']} from {config['source_path'] or 's3://' + config['source_bucket']}...")
+        else:
+            print("📥 Step 1: Retrieving feedback data from Knowledge Base (paginated, streamed)...")
+            retrieval_cache = get_retrieval_cache(s3_client, config)
+            if retrieval_cache is not None:
+                config['ingestion_version'] = get_ingestion_version(config)
+                if config['ingestion_version'] is None:
+                    # Without it, entries would survive KB re-ingestion and serve stale pages
+                    print("⚠️  KB ingestion version unknown, retrieval cache disabled for this run")
+                    retrieval_cache = None
+        run_timestamp = datetime.datetime.now()
+        run_id = f"{run_timestamp.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        analysis_date = run_timestamp.strftime('%Y-%m-%d')
+        incremental_state = load_incremental_state(s3_client, config) if config['incremental'] else None
+        seen_digests = incremental_state['seen_digests'] if incremental_state else set()
+        retrieval_stats = {}
+        retractions = []
+        if config['analysis_source'] == 'aggregates':
+            # Steps 2-3 already ran in the data cleaner: merge its per-file partial aggregates
+            property_aggregates, retractions = load_partial_aggregates(
+                s3_client, config, retrieval_stats, seen_digests,
+                incremental_state['aggregate_files'] if incremental_state else None, analysis_date,
+                run_timestamp.isoformat())
+        else:
+            if batch_source:
+                feedback_stream = iter_source_feedback(s3_client, config, retrieval_stats, seen_digests)
+            else:
+                feedback_stream = iter_streaming_feedback(bedrock_agent_client, config, retrieval_stats, retrieval_cache,
+                                                          seen_digests)
+            
+            # Steps 2-3: Group and score feedback into per-property aggregates
+            print(f"📊 Steps 2-3: Scoring feedback by streaming property ({config['scoring_engine']} engine)...")
+            property_aggregates = score_feedback_aggregates(feedback_stream, config['scoring_engine'],
+                                                            config['analysis_workers'], config['analysis_chunk_size'],
+                                                            scoring_workers)
+        new_aggregates = property_aggregates
         
-        # Step 3: Analyze each streaming property
-        print("📊 Step 3: Analyzing sentiment for each property...")
-        analysis_results = []
+        print(f"✅ Retrieved {retrieval_stats['unique']} new feedback records")
+        if retrieval_cache is not None:
+            print(f"🗄️  Retrieval cache: {retrieval_cache.hits} hits, {retrieval_cache.misses} misses")
+            save_retrieval_cache(s3_client, retrieval_cache, config)
+        if incremental_state:
+            daily_aggregates = dict(incremental_state['daily_aggregates'])
+            for fold_date, retracted, _ in retractions:
+                # Files adopted from before version tracking have no fold date: retract from today
+                fold_date = fold_date or analysis_date
+                daily_aggregates[fold_date] = subtract_property_aggregates(daily_aggregates.get(fold_date, []), retracted)
+            daily_aggregates, property_aggregates = fold_daily_aggregates(daily_aggregates, analysis_date, property_aggregates)
+            print(f"🔁 Incremental: folded into {analysis_date}, {len(daily_aggregates)} days and "
+                  f"{incremental_state['documents']} previously analyzed documents in state")
+        if not property_aggregates and not retrieval_stats['unique']:
+            source = f"cleaned {config['analysis_source']}" if batch_source else 'Knowledge Base'
+            return create_response(400, {'error': f'No data retrieved from {source}'})
         
-        for i, (property_name, feedback_texts) in enumerate(streaming_property_groups.items(), 1):
-            print(f"   Processing {i}/{len(streaming_property_groups)}: {property_name} ({len(feedback_texts)} mentions)")
-            
-            try:
-                result = analyze_streaming_property_sentiment(property_name, feedback_texts)
-                analysis_results.append(result)
-                print(f"   ✅ {property_name}: {result['sentiment_trend']} ({result['total_mentions']} mentions)")
-                
-            except Exception as e:
-                print(f"   ❌ Error analyzing {property_name}: {str(e)}")
-                continue
+        analysis_results = results_from_aggregates(property_aggregates, config['min_mentions_threshold'])
+        print(f"✅ Analyzed {len(analysis_results)} streaming properties: {[r['topic'] for r in analysis_results]}")
         
         # Step 4: Sort and enhance results
         analysis_results.sort(key=lambda x: x['total_mentions'], reverse=True)
@@ -78,9 +353,30 @@ def lambda_handler(event, context):
             result['ranking_by_mentions'] = i
             result['market_share_percentage'] = round((result['total_mentions'] / sum(r['total_mentions'] for r in analysis_results)) * 100, 2)
         
+        # Flag spikes in this batch against each property's running baseline
+        spike_alerts = []
+        if config['anomaly_detection']:
+            spike_detector = create_spike_detector(s3_client, config)
+            spike_alerts = spike_detector.observe(new_aggregates, run_timestamp)
+            attach_spike_alerts(analysis_results, spike_alerts)
+            print(f"🚨 Spike detection: {len(spike_alerts)} alerts")
+        
         # Step 5: Save to S3 with enhanced structure
         print("💾 Step 4: Saving results to S3...")
         save_results_to_s3(s3_client, analysis_results, config)
+        if config['anomaly_detection']:
+            save_spike_alerts(s3_client, config, spike_detector, spike_alerts)
+        if incremental_state:
+            save_daily_rows(s3_client, daily_aggregates, config)
+            documents = incremental_state['documents'] + retrieval_stats['unique']
+            save_incremental_state(s3_client, config, seen_digests, daily_aggregates, documents,
+                                   incremental_state['aggregate_files'])
+            if config['trend_granularities']:
+                append_trend_run(s3_client, config, run_timestamp, run_id, new_aggregates, retrieval_stats['unique'])
+                append_trend_retractions(s3_client, config, run_timestamp, run_id, retractions)
+                save_trend_series(s3_client, config, run_timestamp)
+        elif config['trend_granularities']:
+            print("⚠️  TREND_GRANULARITIES needs INCREMENTAL_ANALYSIS=true (runs must not re-count documents); skipping trend series")
         
         # Generate summary
         summary = generate_executive_summary(analysis_results)
@@ -92,7 +388,12 @@ def lambda_handler(event, context):
         return create_response(200, {
             'message': f'Streaming service sentiment analysis completed successfully',
             'properties_analyzed': len(analysis_results),
-            'total_feedback_entries': len(all_feedback_data),
+            'total_feedback_entries': retrieval_stats['unique'],
+            'incremental': config['incremental'],
+            'analysis_source': config['analysis_source'],
+            'spike_alerts': len(spike_alerts),
+            'retrieval_cache': retrieval_cache.stats() if retrieval_cache is not None else None,
+            'scoring_workers': scoring_stats,
             's3_location': f"s3://{config['s3_bucket']}/{config['s3_output_key']}",
             'top_properties': [r['topic'] for r in analysis_results[:5]],
             'executive_summary': summary,
@@ -103,245 +404,821 @@ def lambda_handler(event, context):
     except Exception as e:
         print(f"💥 Critical error: {str(e)}")
         return create_response(500, {'error': str(e), 'timestamp': datetime.datetime.now().isoformat()})
+    finally:
+        stop_scoring_workers(scoring_workers)
 
-def get_streaming_feedback_data(bedrock_agent_client, config):
+class AdaptiveBackoff:
+    """
+    Retry delay shared by concurrent retrieve calls: doubles on every
+    throttle, halves on every success, jittered per sleep.
+    """
+
+    def __init__(self, base_delay=0.5, max_delay=20.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.delay = base_delay
+        self.lock = threading.Lock()
+
+    def throttled(self):
+        """Record a throttle and return how long the caller should sleep."""
+        with self.lock:
+            self.delay = min(self.delay * 2, self.max_delay)
+            return random.uniform(self.delay / 2, self.delay)
+
+    def succeeded(self):
+        with self.lock:
+            self.delay = max(self.base_delay, self.delay / 2)
+
+class RetrievalCache:
+    """
+    LRU cache of per-search-term retrieval results with a TTL.
+
+    Kept in a module global so it survives warm invocations; optionally
+    persisted as JSON so cold starts can reuse it. Keys include the KB
+    ingestion version, so a new ingestion invalidates every entry.
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, max_entries=512, ttl_seconds=3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+
+    @staticmethod
+    def make_key(knowledge_base_id, query, number_of_results, page_size, ingestion_version):
+        return json.dumps([knowledge_base_id, query, number_of_results, page_size, ingestion_version])
+
+    def get(self, key):
+        """Return cached results or None, counting the hit or miss."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] <= self.ttl_seconds:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+                self.dirty = True
+            self.misses += 1
+            return None
+
+    def put(self, key, results, stored_at=None):
+        with self.lock:
+            self.entries[key] = (stored_at or time.time(), results)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.dirty = True
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+    def to_state(self):
+        """JSON-serializable snapshot, least recently used first."""
+        with self.lock:
+            return {
+                'version': self.FORMAT_VERSION,
+                'entries': [[key, stored_at, results] for key, (stored_at, results) in self.entries.items()]
+            }
+
+    def load_state(self, state):
+        """Merge a persisted snapshot, skipping expired entries."""
+        if not state or state.get('version') != self.FORMAT_VERSION:
+            return
+        now = time.time()
+        for key, stored_at, results in state['entries']:
+            if now - stored_at <= self.ttl_seconds and key not in self.entries:
+                self.put(key, results, stored_at)
+        self.dirty = False
+
+# Survives warm invocations of the same container
+RETRIEVAL_CACHE = None
+
+def get_retrieval_cache(s3_client, config):
+    """
+    Return the process-wide retrieval cache (None when disabled), loading the
+    persisted copy on first use
     """
-    Enhanced data retrieval with better error handling and coverage
+    global RETRIEVAL_CACHE
+    if config['retrieve_cache_size'] <= 0:
+        return None
+    if RETRIEVAL_CACHE is None:
+        RETRIEVAL_CACHE = RetrievalCache(config['retrieve_cache_size'], config['retrieve_cache_ttl'])
+        if config['retrieve_cache_key'] or config['retrieve_cache_path']:
+            try:
+                RETRIEVAL_CACHE.load_state(load_json_state(
+                    s3_client, config['s3_bucket'], config['retrieve_cache_key'], config['retrieve_cache_path']))
+                print(f"🗄️  Loaded {len(RETRIEVAL_CACHE.entries)} cached retrieval entries")
+            except Exception as e:
+                print(f"⚠️  Could not load retrieval cache: {str(e)}")
+    RETRIEVAL_CACHE.max_entries = config['retrieve_cache_size']
+    RETRIEVAL_CACHE.ttl_seconds = config['retrieve_cache_ttl']
+    RETRIEVAL_CACHE.reset_stats()
+    return RETRIEVAL_CACHE
+
+def save_retrieval_cache(s3_client, cache, config):
+    """Persist the retrieval cache if it changed and persistence is configured"""
+    if cache is None or not cache.dirty or not (config['retrieve_cache_key'] or config['retrieve_cache_path']):
+        return
+    save_json_state(s3_client, config['s3_bucket'], config['retrieve_cache_key'], cache.to_state(),
+                    config['retrieve_cache_path'])
+    cache.dirty = False
+
+def get_ingestion_version(config):
+    """
+    Identify the latest completed ingestion job for the KB data source, so cache
+    entries from before it are never served. None when it cannot be determined.
+    """
+    if not config['data_source_id']:
+        return None
+    try:
+        response = boto3.client('bedrock-agent').list_ingestion_jobs(
+            knowledgeBaseId=config['knowledge_base_id'],
+            dataSourceId=config['data_source_id'],
+            filters=[{'attribute': 'STATUS', 'operator': 'EQ', 'values': ['COMPLETE']}],
+            sortBy={'attribute': 'STARTED_AT', 'order': 'DESCENDING'},
+            maxResults=1
+        )
+        jobs = response.get('ingestionJobSummaries', [])
+        if not jobs:
+            return 'none'
+        return f"{jobs[0]['ingestionJobId']}@{jobs[0]['updatedAt']}"
+    except Exception as e:
+        print(f"⚠️  Could not determine KB ingestion version: {str(e)}")
+        return None
+
+def create_bedrock_agent_client(config):
     """
-    all_data = []
+    Bedrock agent runtime client sized for concurrent retrieval, with the
+    per-call timeout applied. Throttling retries are handled by AdaptiveBackoff.
+    """
+    return boto3.client('bedrock-agent-runtime', config=Config(
+        connect_timeout=config['retrieve_timeout'],
+        read_timeout=config['retrieve_timeout'],
+        max_pool_connections=max(10, config['retrieve_concurrency']),
+        retries={'max_attempts': 1}
+    ))
+
+def retrieve_search_term(bedrock_agent_client, config, search_term, backoff, number_of_results=None, next_token=None):
+    """
+    Retrieve one page for a search term, retrying throttles and timeouts with
+    adaptive backoff. Returns (results, next_token).
+    """
+    request = {
+        'knowledgeBaseId': config['knowledge_base_id'],
+        'retrievalQuery': {'text': search_term},
+        'retrievalConfiguration': {
+            'vectorSearchConfiguration': {
+                'numberOfResults': number_of_results or config['max_results_per_search']
+            }
+        }
+    }
+    if next_token:
+        request['nextToken'] = next_token
     
-    # Generic streaming service search terms (no specific brand references)
-    streaming_search_terms = [
-        # Core streaming services (high priority)
-        'streaming service reviews', 'video streaming platform', 'subscription streaming',
-        'on demand content', 'streaming app feedback',
-        
-        # Content categories (medium priority)
-        'original series streaming', 'movie streaming service', 'live TV streaming',
-        'sports streaming platform', 'news streaming service',
-        
-        # Technical aspects (lower priority but comprehensive)
-        'streaming quality issues', 'buffering problems', 'app crashes',
-        'streaming device compatibility', 'streaming subscription cost',
-        
-        # General streaming sentiment
-        'cord cutting experience', 'streaming vs cable', 
-        'streaming platform comparison', 'binge watching experience'
-    ]
+    for attempt in range(config['retrieve_max_retries'] + 1):
+        try:
+            response = bedrock_agent_client.retrieve(**request)
+            backoff.succeeded()
+            return response['retrievalResults'], response.get('nextToken')
+        except (ClientError, ConnectTimeoutError, ReadTimeoutError) as e:
+            retryable = not isinstance(e, ClientError) or e.response['Error']['Code'] in THROTTLING_ERROR_CODES
+            if not retryable or attempt == config['retrieve_max_retries']:
+                raise
+            delay = backoff.throttled()
+            print(f"   ⏳ '{search_term}' throttled or timed out (attempt {attempt + 1}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+# Marks the end of a search term's pages on its queue
+_END_OF_TERM = object()
+
+def put_unless_stopped(pages, item, stop):
+    """Blocking put that gives up once ``stop`` is set"""
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def retrieve_term_pages(bedrock_agent_client, config, search_term, budget, backoff, pages, stop, cache=None):
+    """
+    Page through one search term with nextToken until its result budget or the
+    last page, handing each page to ``pages``; ends with _END_OF_TERM or the error.
+    Completed terms are served from / stored in ``cache`` when given.
+    """
+    cache_key = None
+    if cache is not None:
+        cache_key = RetrievalCache.make_key(config['knowledge_base_id'], search_term, budget,
+                                            config['max_results_per_search'], config.get('ingestion_version'))
+        cached_results = cache.get(cache_key)
+        if cached_results is not None:
+            if put_unless_stopped(pages, cached_results, stop):
+                put_unless_stopped(pages, _END_OF_TERM, stop)
+            return
     
-    successful_searches = 0
-    failed_searches = 0
+    retrieved = 0
+    term_results = []
+    next_token = None
+    try:
+        while retrieved < budget and not stop.is_set():
+            results, next_token = retrieve_search_term(
+                bedrock_agent_client, config, search_term, backoff,
+                min(config['max_results_per_search'], budget - retrieved), next_token
+            )
+            results = results[:budget - retrieved]
+            retrieved += len(results)
+            if cache is not None:
+                term_results.extend(results)
+            if not put_unless_stopped(pages, results, stop) or not next_token or not results:
+                break
+        if put_unless_stopped(pages, _END_OF_TERM, stop) and cache is not None:
+            cache.put(cache_key, term_results)
+    except Exception as e:
+        put_unless_stopped(pages, e, stop)
+
+def content_digest(content):
+    """
+    Stable 128-bit digest of whitespace- and case-normalized content
+    """
+    normalized = ' '.join(content.lower().split())
+    return hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).digest()
+
+def iter_streaming_feedback(bedrock_agent_client, config, stats=None, cache=None, seen_digests=None):
+    """
+    Yield unique feedback records across all search terms.
+    Terms are paged concurrently within their tier budgets but yielded in term
+    order; each term buffers at most a couple of pages, so memory stays bounded.
+    Stops early once max_total_documents unique records have been yielded.
+    Whole search terms are served from ``cache`` when a fresh entry exists.
+    Documents whose content digest is already in ``seen_digests`` (e.g. from
+    prior runs) are skipped; new digests are added to it.
+    """
+    stats = stats if stats is not None else {}
+    stats.update({'successful_searches': 0, 'failed_searches': 0, 'retrieved': 0, 'unique': 0})
+    backoff = AdaptiveBackoff()
+    stop = threading.Event()
+    seen_content = seen_digests if seen_digests is not None else set()
+    executor = ThreadPoolExecutor(max_workers=max(1, config['retrieve_concurrency']))
     
     try:
-        for search_term in streaming_search_terms:
-            try:
-                response = bedrock_agent_client.retrieve(
-                    knowledgeBaseId=config['knowledge_base_id'],
-                    retrievalQuery={'text': search_term},
-                    retrievalConfiguration={
-                        'vectorSearchConfiguration': {
-                            'numberOfResults': config['max_results_per_search']
-                        }
-                    }
-                )
+        term_pages = []
+        for tier, search_terms in SEARCH_TERM_TIERS.items():
+            for search_term in search_terms:
+                pages = queue.Queue(maxsize=config['retrieve_buffer_pages'])
+                executor.submit(retrieve_term_pages, bedrock_agent_client, config, search_term,
+                                config['term_budgets'][tier], backoff, pages, stop, cache)
+                term_pages.append((search_term, pages))
+        
+        for search_term, pages in term_pages:
+            term_results = 0
+            while True:
+                page = pages.get()
+                if page is _END_OF_TERM:
+                    stats['successful_searches'] += 1
+                    print(f"   📥 '{search_term}': {term_results} results")
+                    break
+                if isinstance(page, Exception):
+                    stats['failed_searches'] += 1
+                    print(f"   ⚠️  Search term '{search_term}' failed after {term_results} results: {str(page)}")
+                    break
                 
-                for result in response['retrievalResults']:
+                for result in page:
                     content = result['content']['text']
+                    term_results += 1
+                    stats['retrieved'] += 1
+                    
+                    digest = content_digest(content)
+                    if digest in seen_content:
+                        continue
+                    seen_content.add(digest)
+                    
+                    stats['unique'] += 1
                     # Enhanced metadata
-                    all_data.append({
+                    yield {
                         'content': content,
+                        'content_digest': digest.hex(),
                         'relevance_score': result.get('score', 0),
                         'search_term': search_term,
                         'content_length': len(content),
                         'retrieved_at': datetime.datetime.now().isoformat()
-                    })
-                
-                successful_searches += 1
-                print(f"   📥 '{search_term}': {len(response['retrievalResults'])} results")
-                
-            except Exception as e:
-                failed_searches += 1
-                print(f"   ⚠️  Search term '{search_term}' failed: {str(e)}")
-                continue
-        
-        print(f"📊 Search summary: {successful_searches} successful, {failed_searches} failed")
-        
-        # Enhanced deduplication
-        unique_data = []
-        seen_content = set()
-        
-        for item in all_data:
-            # Use longer hash for better deduplication
-            content_hash = hash(item['content'][:500])
-            if content_hash not in seen_content:
-                seen_content.add(content_hash)
-                unique_data.append(item)
-        
-        print(f"📊 Deduplication: {len(all_data)} -> {len(unique_data)} unique entries")
-        return unique_data
+                    }
+                    if stats['unique'] >= config['max_total_documents']:
+                        print(f"   🛑 Overall budget of {config['max_total_documents']} documents reached")
+                        return
+    finally:
+        stop.set()
+        # Wait for in-flight calls so no retrieval thread outlives the run (and blocks forking on a warm container)
+        executor.shutdown(wait=True, cancel_futures=True)
+        print(f"📊 Search summary: {stats['successful_searches']} successful, {stats['failed_searches']} failed")
+        print(f"📊 Deduplication: {stats['retrieved']} -> {stats['unique']} unique entries")
+
+def get_streaming_feedback_data(bedrock_agent_client, config):
+    """
+    Enhanced data retrieval with better error handling and coverage.
+    Materializes iter_streaming_feedback; the handler streams it instead.
+    """
+    try:
+        return list(iter_streaming_feedback(bedrock_agent_client, config))
         
     except Exception as e:
         print(f"❌ Critical error in data retrieval: {str(e)}")
         return []
 
-def group_by_streaming_properties(feedback_data, min_mentions_threshold=3):
+def is_source_file(name):
+    """True for cleaned outputs (clean-*, ready-*) in a format the analyzer can read"""
+    base = name.rsplit('/', 1)[-1]
+    return base.startswith(SOURCE_FILE_PREFIXES) and base.endswith(SOURCE_FILE_EXTENSIONS)
+
+def is_partial_aggregate_file(name):
+    """True for per-file partial aggregates written by the data cleaner (aggregate-*.bin or .json)"""
+    base = name.rsplit('/', 1)[-1]
+    return base.startswith('aggregate-') and base.endswith(('.bin', '.json'))
+
+# One file to analyze: S3 key or local path, its stored size in bytes, and a
+# version that changes whenever the file is rewritten (ETag, or size and mtime locally)
+SourceFile = namedtuple('SourceFile', ['name', 'size', 'version'])
+
+def list_source_files(s3_client, config, prefixes=None, accept=is_source_file):
     """
-    Enhanced property grouping with better categorization for generic streaming services
+    Sorted SourceFiles to analyze: local files under ``source_path`` when set,
+    otherwise S3 keys under each of ``prefixes`` (default ``source_prefixes``)
     """
-    # Generic streaming properties mapping (no specific brand names)
-    streaming_properties = {
-        # Tier 1: Major Streaming Categories
-        'Premium Streaming Service': ['premium streaming', 'subscription service', 'streaming platform', 'video service'],
-        'Movie Streaming Platform': ['movie streaming', 'film streaming', 'cinema streaming', 'movie platform'],
-        'TV Streaming Service': ['tv streaming', 'television streaming', 'tv shows online', 'series streaming'],
-        
-        # Tier 2: Content Categories
-        'Sports Streaming': ['sports streaming', 'live sports', 'sports content', 'athletic events streaming'],
-        'News Streaming': ['news streaming', 'live news', 'news content', 'breaking news streaming'],
-        'Kids Content Streaming': ['kids streaming', 'children shows', 'family content', 'cartoon streaming'],
-        'Documentary Streaming': ['documentary streaming', 'educational content', 'documentary platform'],
-        
-        # Tier 3: Specialized Services
-        'Live TV Streaming': ['live tv streaming', 'live television', 'broadcast streaming', 'tv channels online'],
-        'Music Streaming': ['music streaming', 'audio streaming', 'music platform', 'song streaming'],
-        'Gaming Streaming': ['game streaming', 'gaming content', 'esports streaming', 'gaming platform'],
+    if config['source_path']:
+        paths = []
+        for root, _, files in os.walk(config['source_path']):
+            paths.extend(os.path.join(root, name) for name in files if accept(name))
+        files = []
+        for path in sorted(paths):
+            info = os.stat(path)
+            files.append(SourceFile(path, info.st_size, f"{info.st_size}-{info.st_mtime_ns}"))
+        return files
+    
+    files = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for prefix in prefixes or config['source_prefixes']:
+        for page in paginator.paginate(Bucket=config['source_bucket'], Prefix=prefix):
+            files.extend(SourceFile(obj['Key'], obj['Size'], obj['ETag'])
+                         for obj in page.get('Contents', []) if accept(obj['Key']))
+    return sorted(files)
+
+def open_source_file(s3_client, config, name):
+    """Binary stream over one source file, from local disk or S3"""
+    if config['source_path']:
+        return open(name, 'rb')
+    return s3_client.get_object(Bucket=config['source_bucket'], Key=name)['Body']
+
+def read_source_file(s3_client, config, name):
+    """Raw bytes of one source file; runs on the reader threads"""
+    stream = open_source_file(s3_client, config, name)
+    try:
+        return stream.read()
+    finally:
+        stream.close()
+
+def iter_source_streams(s3_client, config, files):
+    """
+    Yield (name, stream, error) for each SourceFile in order. Reader threads
+    prefetch up to ``source_concurrency`` files ahead while their stored bytes
+    stay within ``source_prefetch_bytes``; a file larger than that budget is not
+    prefetched but streamed from its source when its turn comes. Each stream is
+    closed once the consumer moves on.
+    """
+    budget = config['source_prefetch_bytes']
+    window = max(1, config['source_concurrency'])
+    pending = deque()  # (SourceFile, future), future None when the file is streamed directly
+    in_flight = 0
+    next_index = 0
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        while True:
+            while next_index < len(files) and len(pending) < window:
+                source = files[next_index]
+                if source.size > budget:
+                    pending.append((source, None))
+                elif in_flight + source.size <= budget:
+                    pending.append((source, executor.submit(read_source_file, s3_client, config, source.name)))
+                    in_flight += source.size
+                else:
+                    break
+                next_index += 1
+            if not pending:
+                return
+            
+            source, future = pending.popleft()
+            try:
+                try:
+                    stream = io.BytesIO(future.result()) if future else open_source_file(s3_client, config, source.name)
+                except Exception as e:
+                    yield source.name, None, e
+                    continue
+                try:
+                    yield source.name, stream, None
+                finally:
+                    stream.close()
+            finally:
+                if future:
+                    in_flight -= source.size
+
+def iter_stream_lines(stream, chunk_size=1024 * 1024):
+    """Yield the lines of a binary stream without their newlines, reading ``chunk_size`` bytes at a time"""
+    pending = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
+
+def feedback_text(record):
+    """KB-ready lines carry ``text``; cleaned records are rendered the same way the KB sees them"""
+    if 'text' in record:
+        return record['text']
+    return f"Title: {record['title']}\nBody: {record['body']}"
+
+def parse_source_texts(name, stream):
+    """
+    Decode one cleaned-output file stream into its feedback texts, by extension,
+    one record at a time: JSONL line by line and JSON arrays item by item
+    """
+    if name.endswith('.parquet'):
+        if pq is None:
+            raise ImportError("pyarrow is required to read Parquet cleaned output")
+        if not (hasattr(stream, 'seekable') and stream.seekable()):
+            stream = io.BytesIO(stream.read())  # the Parquet footer needs random access
+        for batch in pq.ParquetFile(stream).iter_batches(columns=['title', 'body']):
+            for title, body in zip(batch.column(0).to_pylist(), batch.column(1).to_pylist()):
+                yield f"Title: {title}\nBody: {body}"
+        return
+    if name.endswith('.gz'):
+        stream = gzip.GzipFile(fileobj=stream)
+    elif name.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError("zstandard is required to read *.jsonl.zst cleaned output")
+        stream = zstandard.ZstdDecompressor().stream_reader(stream)
+    if name.endswith('.json'):
+        records = JsonStreamReader(stream).iter_array('cleaned records')
+    else:
+        records = (json.loads(line) for line in iter_stream_lines(stream) if line.strip())
+    for record in records:
+        yield feedback_text(record)
+
+def iter_source_feedback(s3_client, config, stats=None, seen_digests=None):
+    """
+    Yield unique feedback records from cleaned outputs (S3 or local) instead of
+    KB retrieval. Files are prefetched within a byte budget but yielded in
+    sorted order, and each is decoded record by record as it is consumed.
+    Duplicates are dropped by content digest exactly as in
+    iter_streaming_feedback, so incremental mode works the same for both sources.
+    A file that fails partway keeps the records read before the failure.
+    """
+    stats = stats if stats is not None else {}
+    stats.update({'source_files': 0, 'failed_files': 0, 'retrieved': 0, 'unique': 0})
+    seen_content = seen_digests if seen_digests is not None else set()
+    files = list_source_files(s3_client, config)
+    print(f"   📂 {len(files)} cleaned files to analyze")
+    
+    for name, stream, error in iter_source_streams(s3_client, config, files):
+        try:
+            if error is not None:
+                raise error
+            for content in parse_source_texts(name, stream):
+                stats['retrieved'] += 1
+                digest = content_digest(content)
+                if digest in seen_content:
+                    continue
+                seen_content.add(digest)
+                
+                stats['unique'] += 1
+                yield {
+                    'content': content,
+                    'content_digest': digest.hex(),
+                    'source_file': name,
+                    'content_length': len(content),
+                    'retrieved_at': datetime.datetime.now().isoformat()
+                }
+        except Exception as e:
+            stats['failed_files'] += 1
+            print(f"   ⚠️  Could not read {name}: {str(e)}")
+            continue
+        stats['source_files'] += 1
+    print(f"   📥 {stats['source_files']} files read ({stats['failed_files']} failed), "
+          f"{stats['retrieved']} records, {stats['unique']} unique")
+
+def parse_partial_aggregate(name, data):
+    """Decode one partial aggregate file, rejecting layouts newer than this analyzer understands"""
+    if name.endswith('.bin'):
+        return deserialize_partial(data)
+    partial = json.loads(data)
+    if partial.get('format_version', 0) > PARTIAL_AGGREGATE_VERSION:
+        raise ValueError(f"unsupported partial aggregate format_version {partial.get('format_version')}")
+    return partial
+
+def load_partial_aggregates(s3_client, config, stats=None, seen_digests=None, folded_files=None, fold_date=None,
+                            folded_at=None):
+    """
+    Merge the data cleaner's per-file partial aggregates, in sorted file order,
+    into one aggregate list. Documents are not re-digested: the cleaner drops
+    duplicates within each file, but across files only with GLOBAL_DEDUP=true,
+    so without it a record repeated in several files counts once per file.
+    
+    Incremental runs pass ``folded_files`` (name -> version, fold date and time,
+    records and aggregates of each file folded so far), updated in place. A file
+    already folded at its current version is skipped without being read; a
+    rewritten file is merged again and its earlier contribution returned for
+    retraction. Returns (aggregates, [(fold date, retracted aggregates, fold time)]).
+    """
+    stats = stats if stats is not None else {}
+    stats.update({'source_files': 0, 'failed_files': 0, 'retrieved': 0, 'unique': 0})
+    files = list_source_files(s3_client, config, config['aggregate_prefixes'], is_partial_aggregate_file)
+    print(f"   📂 {len(files)} partial aggregate files")
+    retractions = []
+    if folded_files is not None:
+        unchanged = {source.name for source in files if folded_files.get(source.name, {}).get('version') == source.version}
+        stats['retrieved'] += sum(folded_files[name]['records'] for name in unchanged)
+        files = [source for source in files if source.name not in unchanged]
+    versions = {source.name: source.version for source in files}
+    
+    merged = make_partial([], 0, 0)
+    for name, stream, error in iter_source_streams(s3_client, config, files):
+        if error is None:
+            try:
+                partial = parse_partial_aggregate(name, stream.read())
+            except Exception as e:
+                error = e
+        if error is not None:
+            stats['failed_files'] += 1
+            print(f"   ⚠️  Could not read {name}: {str(error)}")
+            continue
         
-        # Tier 4: Technical Categories
-        'Mobile Streaming': ['mobile streaming', 'smartphone streaming', 'tablet streaming', 'mobile app'],
-        'Smart TV Streaming': ['smart tv streaming', 'tv app', 'television app', 'streaming on tv'],
-        'Free Streaming Service': ['free streaming', 'ad-supported streaming', 'free content platform'],
+        stats['source_files'] += 1
+        stats['retrieved'] += partial['records']
+        if folded_files is not None:
+            previous = folded_files.get(name)
+            if previous is None and seen_digests is not None and content_digest(f"partial-aggregate:{name}") in seen_digests:
+                # Folded before files were tracked by version: adopt it as is rather than count it again
+                folded_files[name] = {'version': versions[name], 'date': None, 'records': partial['records'],
+                                      'aggregates': partial['aggregates']}
+                continue
+            if previous is not None:
+                retractions.append((previous['date'], previous['aggregates'], previous.get('folded_at')))
+                stats['unique'] -= previous['records']
+            folded_files[name] = {'version': versions[name], 'date': fold_date, 'folded_at': folded_at,
+                                  'records': partial['records'], 'aggregates': partial['aggregates']}
         
-        # Tier 5: Generic Categories
-        'International Content': ['international streaming', 'foreign content', 'global streaming', 'international shows'],
-        'Original Content Platform': ['original content', 'exclusive shows', 'original series', 'platform originals']
-    }
-    
+        stats['unique'] += partial['records']
+        merged = merge_partials(merged, partial)
+    print(f"   📥 {stats['source_files']} partials read ({stats['failed_files']} failed), "
+          f"{stats['unique']} new of {stats['retrieved']} records, {len(retractions)} rewritten files replaced")
+    return merged['aggregates'], retractions
+
+def group_feedback_texts(texts):
+    """
+    Analyze texts into per-property TextAnalysis groups without logging.
+    Returns (groups, matched_count, text_count).
+    """
     property_groups = defaultdict(list)
     feedback_matched = 0
+    feedback_count = 0
     
-    for feedback_item in feedback_data:
-        content = feedback_item['content'].lower()
-        matched_properties = set()
+    for text in texts:
+        record = analyze_text(text)
+        feedback_count += 1
         
-        # Check each streaming property with weighted scoring
-        for property_name, variations in streaming_properties.items():
-            match_score = 0
-            for variation in variations:
-                if variation.lower() in content:
-                    match_score += 1
-            
-            if match_score > 0:
-                matched_properties.add(property_name)
-        
-        # Add to groups
-        if matched_properties:
+        if record.properties and record.properties != (GENERAL_STREAMING,):
             feedback_matched += 1
-            for prop in matched_properties:
-                property_groups[prop].append({
-                    'content': content,
-                    'metadata': feedback_item
-                })
-        else:
-            # Generic streaming fallback with stricter criteria
-            streaming_terms = ['streaming service', 'video platform', 'subscription service']
-            if any(term in content for term in streaming_terms):
-                property_groups['General Streaming'].append({
-                    'content': content,
-                    'metadata': feedback_item
-                })
+        for prop in record.properties:
+            property_groups[prop].append(record)
+    
+    return property_groups, feedback_matched, feedback_count
+
+def group_by_streaming_properties(feedback_data, min_mentions_threshold=3):
+    """
+    Enhanced property grouping with better categorization for generic streaming services.
+    Groups hold TextAnalysis records so each text is scanned only once.
+    """
+    property_groups, feedback_matched, feedback_count = group_feedback_texts(
+        feedback_item['content'] for feedback_item in feedback_data)
     
-    print(f"📊 Property matching: {feedback_matched}/{len(feedback_data)} feedback items matched to streaming properties")
+    print(f"📊 Property matching: {feedback_matched}/{feedback_count} feedback items matched to streaming properties")
     
     # Filter by minimum mentions threshold
     filtered_groups = {}
     for k, v in property_groups.items():
         if len(v) >= min_mentions_threshold:
-            # Extract just the content for analysis
-            filtered_groups[k] = [item['content'] for item in v]
+            filtered_groups[k] = v
         else:
             print(f"   ⚠️  Excluded {k}: only {len(v)} mentions (below threshold of {min_mentions_threshold})")
     
     return filtered_groups
 
-def analyze_streaming_property_sentiment(property_name, feedback_texts):
+def extract_themes_from_text(text):
     """
-    Enhanced sentiment analysis with confidence scoring for streaming properties
+    Enhanced theme extraction for streaming service context
     """
-    # Refined sentiment keywords with weights
-    sentiment_keywords = {
-        'positive': {
-            # High confidence positive (weight 2)
-            'love': 2, 'amazing': 2, 'excellent': 2, 'fantastic': 2, 'perfect': 2,
-            'best': 2, 'outstanding': 2, 'brilliant': 2, 'incredible': 2,
-            
-            # Medium confidence positive (weight 1.5)
-            'great': 1.5, 'good': 1.5, 'awesome': 1.5, 'wonderful': 1.5,
-            'recommend': 1.5, 'favorite': 1.5, 'satisfied': 1.5,
-            
-            # Streaming-specific positive (weight 1.5)
-            'binge watch': 1.5, 'addicted': 1.5, 'must watch': 1.5,
-            'quality content': 1.5, 'worth it': 1.5, 'impressed': 1.5,
-            
-            # Basic positive (weight 1)
-            'like': 1, 'enjoy': 1, 'fine': 1, 'decent': 1, 'okay': 1
-        },
+    return list(analyze_text(text).themes)
+
+def analyze_streaming_property_sentiment(property_name, feedback_records):
+    """
+    Enhanced sentiment analysis with confidence scoring for streaming properties.
+    Accepts TextAnalysis records from group_by_streaming_properties or raw texts.
+    """
+    return finalize_property_aggregate(aggregate_property_records(property_name, feedback_records))
+
+def finalize_property_aggregate(aggregate):
+    """Build the result record for one per-property aggregate"""
+    sentiment_scores = {'positive': aggregate['positive'], 'negative': aggregate['negative']}
+    return build_property_result(aggregate['property'], sentiment_scores, aggregate['total'],
+                                 aggregate['confidence_sum'], aggregate['theme_mentions'])
+
+def results_from_aggregates(aggregates, min_mentions_threshold=3):
+    """
+    Finalize every aggregate that meets the mentions threshold
+    """
+    results = []
+    for aggregate in aggregates:
+        property_name = aggregate['property']
+        if aggregate['total'] < min_mentions_threshold:
+            print(f"   ⚠️  Excluded {property_name}: only {aggregate['total']} mentions (below threshold of {min_mentions_threshold})")
+            continue
         
-        'negative': {
-            # High confidence negative (weight 2)
-            'hate': 2, 'terrible': 2, 'awful': 2, 'horrible': 2, 'worst': 2,
-            'pathetic': 2, 'garbage': 2, 'sucks': 2, 'disappointing': 2,
+        try:
+            result = finalize_property_aggregate(aggregate)
+            results.append(result)
+            print(f"   ✅ {property_name}: {result['sentiment_trend']} ({result['total_mentions']} mentions)")
             
-            # Medium confidence negative (weight 1.5)
-            'frustrating': 1.5, 'annoying': 1.5, 'bad': 1.5, 'poor': 1.5,
-            'waste of money': 1.5, 'overpriced': 1.5, 'cancel': 1.5,
-            
-            # Technical issues (weight 1.5)
-            'buffering': 1.5, 'crashes': 1.5, 'slow': 1.5, 'broken': 1.5,
-            'error': 1.5, 'glitchy': 1.5, 'loading problems': 1.5,
-            
-            # Basic negative (weight 1)
-            'dislike': 1, 'meh': 1, 'boring': 1, 'limited': 1
-        }
-    }
+        except Exception as e:
+            print(f"   ❌ Error analyzing {property_name}: {str(e)}")
+            continue
+    
+    return results
+
+def aggregate_feedback_texts(texts, scoring_engine='records'):
+    """
+    Score texts into unfiltered per-property aggregates without logging.
+    Returns (aggregates, matched_count, text_count); used per chunk by workers.
+    """
+    if scoring_engine == 'matrix':
+        return HitMatrixEngine().aggregate(texts)
     
-    # Enhanced analysis
-    sentiment_scores = {'positive': 0, 'negative': 0}
-    theme_mentions = defaultdict(int)
-    confidence_scores = []
+    property_groups, feedback_matched, feedback_count = group_feedback_texts(texts)
+    aggregates = [aggregate_property_records(name, records) for name, records in property_groups.items()]
+    return aggregates, feedback_matched, feedback_count
+
+def score_texts_partial(texts, scoring_engine='records'):
+    """Score texts into one partial aggregate"""
+    aggregates, feedback_matched, feedback_count = aggregate_feedback_texts(texts, scoring_engine)
+    return make_partial(aggregates, feedback_count, feedback_matched)
+
+# Seconds to wait for a scoring worker to exit before it is terminated
+WORKER_JOIN_TIMEOUT = 30
+
+def _score_chunk_worker(connection, scoring_engine):
+    """
+    Worker process loop: score each JSON-encoded chunk received and reply with its
+    serialized partial (or an error message), until an empty message or EOF
+    """
+    try:
+        while True:
+            data = connection.recv_bytes()
+            if not data:
+                break
+            try:
+                reply = serialize_partial(score_texts_partial(json.loads(data), scoring_engine))
+            except Exception as e:
+                reply = str(e).encode('utf-8')
+            connection.send_bytes(reply)
+    except EOFError:
+        pass
+    finally:
+        connection.close()
+
+def start_scoring_workers(scoring_engine, workers, stats=None):
+    """
+    Fork up to ``workers`` scoring processes as [(process, connection)]; empty when
+    forking is unsafe or unavailable. Forking while other threads run can leave a
+    child holding a lock (logging, SSL, boto3) that no thread will ever release.
+    ``stats`` records how many workers started and why scoring fell back in-process.
+    """
+    stats = stats if stats is not None else {}
+    stats.update(requested=workers, started=0, fallback=None)
+    if threading.active_count() > 1:
+        stats['fallback'] = f"{threading.active_count() - 1} other threads running"
+        print(f"⚠️  {stats['fallback']}, scoring in-process instead of forking {workers} workers")
+        return []
+    context = multiprocessing.get_context('fork')
+    started = []
+    try:
+        for _ in range(workers):
+            connection, child_connection = context.Pipe()
+            process = context.Process(target=_score_chunk_worker, args=(child_connection, scoring_engine))
+            process.start()
+            child_connection.close()
+            started.append((process, connection))
+    except OSError as e:
+        stats['fallback'] = f"worker process unavailable: {str(e)}"
+        print(f"⚠️  Worker process unavailable ({str(e)}), scoring in-process")
+        stop_scoring_workers(started)
+        return []
+    stats['started'] = len(started)
+    return started
+
+def stop_scoring_workers(started, timeout=WORKER_JOIN_TIMEOUT):
+    """Ask workers to exit and reap them, terminating any that do not exit within ``timeout``"""
+    for process, connection in started:
+        try:
+            connection.send_bytes(b'')
+        except (OSError, ValueError):
+            pass
+        connection.close()
+    for process, _ in started:
+        process.join(timeout)
+        if process.is_alive():
+            print(f"⚠️  Scoring worker {process.pid} did not exit, terminating it")
+            process.terminate()
+            process.join(1)
+
+def iter_chunk_partials(texts, scoring_engine, workers, chunk_size, started=None):
+    """
+    Score chunks of ``texts`` in up to ``workers`` forked processes, yielding
+    partial aggregates in chunk order. Workers are forked before ``texts`` is
+    first read, so a lazily started producer's thread pool never exists at fork
+    time; ``started`` passes workers forked earlier, which the caller stops.
+    Uses Process + Pipe rather than a pool: Lambda has no /dev/shm, so pools
+    and queues cannot start there.
+    """
+    text_iter = iter(texts)
+    owned = started is None
+    if owned:
+        started = start_scoring_workers(scoring_engine, workers)
+    idle = [connection for _, connection in started]
+    running = []  # connections with a chunk outstanding, oldest first
     
-    for text in feedback_texts:
-        text_lower = text.lower()
-        text_pos_score = 0
-        text_neg_score = 0
-        
-        # Calculate weighted sentiment scores
-        for word, weight in sentiment_keywords['positive'].items():
-            if word in text_lower:
-                text_pos_score += weight
-        
-        for word, weight in sentiment_keywords['negative'].items():
-            if word in text_lower:
-                text_neg_score += weight
-        
-        # Classify with confidence
-        if text_pos_score > text_neg_score:
-            sentiment_scores['positive'] += 1
-            confidence_scores.append(text_pos_score / (text_pos_score + text_neg_score + 0.1))
-        elif text_neg_score > text_pos_score:
-            sentiment_scores['negative'] += 1
-            confidence_scores.append(text_neg_score / (text_pos_score + text_neg_score + 0.1))
-        else:
-            confidence_scores.append(0.1)  # Low confidence for neutral
-        
-        # Extract themes
-        themes = extract_themes_from_text(text_lower)
-        for theme in themes:
-            theme_mentions[theme] += 1
+    def receive(connection):
+        data = connection.recv_bytes()
+        idle.append(connection)
+        if not data.startswith(PARTIAL_AGGREGATE_MAGIC):
+            raise RuntimeError(f"Scoring worker failed: {data.decode('utf-8', 'replace')}")
+        return deserialize_partial(data)
     
+    try:
+        while True:
+            chunk = list(itertools.islice(text_iter, chunk_size))
+            if not chunk:
+                break
+            if not started:
+                yield score_texts_partial(chunk, scoring_engine)
+                continue
+            # Drain the oldest chunk once all workers are busy
+            if not idle:
+                yield receive(running.pop(0))
+            connection = idle.pop()
+            connection.send_bytes(json.dumps(chunk).encode('utf-8'))
+            running.append(connection)
+        while running:
+            yield receive(running.pop(0))
+    finally:
+        if owned:
+            stop_scoring_workers(started)
+
+def score_feedback_aggregates(feedback_data, scoring_engine='records', workers=1, chunk_size=5000, started=None):
+    """
+    Score a stream of feedback items into unfiltered per-property aggregates
+    with the configured engine. With workers > 1, chunks of texts are scored
+    in parallel processes (``started`` ones if given) and their partial
+    aggregates merged in chunk order, which keeps property and theme order
+    identical to the serial run.
+    """
+    texts = (item['content'] for item in feedback_data)
+    if workers <= 1:
+        partial = score_texts_partial(texts, scoring_engine)
+    else:
+        partial = make_partial([], 0, 0)
+        for chunk_partial in iter_chunk_partials(texts, scoring_engine, workers, chunk_size, started):
+            partial = merge_partials(partial, chunk_partial)
+    print(f"📊 Property matching: {partial['matched']}/{partial['records']} feedback items matched to streaming properties")
+    return partial['aggregates']
+
+def build_property_result(property_name, sentiment_scores, total_mentions, confidence_sum, theme_mentions):
+    """
+    Turn per-property aggregates into the QuickSight-ready result record.
+    theme_mentions must be in first-seen order; it breaks ties between themes.
+    """
     # Calculate metrics
-    total_mentions = len(feedback_texts)
     neutral_count = total_mentions - sentiment_scores['positive'] - sentiment_scores['negative']
-    avg_confidence = sum(confidence_scores) / len(confidence_scores) if confidence_scores else 0
+    avg_confidence = confidence_sum / total_mentions if total_mentions else 0
     
     # Enhanced trend determination
     sentiment_trend = determine_sentiment_trend_enhanced(sentiment_scores, neutral_count, avg_confidence)
@@ -439,30 +1316,6 @@ def requires_action(sentiment_scores, total_mentions):
     neg_percentage = (sentiment_scores['negative'] / total_mentions) * 100
     return neg_percentage >= 40
 
-def extract_themes_from_text(text):
-    """
-    Enhanced theme extraction for streaming service context
-    """
-    theme_patterns = {
-        'content_quality': ['content quality', 'show quality', 'programming', 'originals', 'exclusive content'],
-        'pricing_value': ['price', 'cost', 'expensive', 'value', 'subscription', 'worth it', 'money'],
-        'user_experience': ['app experience', 'interface', 'navigation', 'search function', 'ease of use'],
-        'technical_performance': ['streaming quality', 'buffering', 'video quality', 'loading speed', 'connectivity'],
-        'content_variety': ['content selection', 'variety', 'catalog size', 'library', 'options'],
-        'customer_service': ['customer support', 'help', 'service', 'response time'],
-        'competitor_comparison': ['vs netflix', 'compared to disney', 'better than hulu', 'amazon prime'],
-        'advertising': ['ads', 'commercials', 'interruptions', 'ad-free'],
-        'device_compatibility': ['roku', 'apple tv', 'smart tv', 'mobile app', 'casting'],
-        'content_discovery': ['recommendations', 'finding shows', 'browse', 'categories']
-    }
-    
-    themes_found = []
-    for theme, keywords in theme_patterns.items():
-        if any(keyword in text for keyword in keywords):
-            themes_found.append(theme.replace('_', ' '))
-    
-    return themes_found
-
 def generate_property_summary_enhanced(property_name, sentiment_scores, neutral_count, theme_mentions, total_mentions, confidence):
     """
     Enhanced business summary with confidence metrics
@@ -533,6 +1386,437 @@ def generate_executive_summary(results):
     
     return summary
 
+def load_json_state(s3_client, bucket, key, local_path=None, default=None):
+    """Load a JSON state document from ``local_path`` if set, otherwise S3; ``default`` when missing"""
+    if local_path:
+        if not os.path.exists(local_path):
+            return default
+        with open(local_path, 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return default
+        raise
+    return json.loads(body.decode('utf-8'))
+
+def save_json_state(s3_client, bucket, key, state, local_path=None):
+    """Persist a JSON state document to ``local_path`` if set, otherwise S3"""
+    body = json.dumps(state).encode('utf-8')
+    if local_path:
+        tmp_path = f"{local_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, local_path)
+        return
+    s3_client.put_object(Bucket=bucket, Key=key, Body=body, ContentType='application/json')
+
+def new_seen_index(config):
+    """Empty Bloom filter of seen content digests, sized from configuration"""
+    return FingerprintIndex.for_capacity(config['seen_capacity'], config['seen_false_positive_rate'], config['seen_max_bytes'])
+
+def load_incremental_state(s3_client, config):
+    """
+    Load seen content digests and per-property aggregates keyed by analysis date.
+    Digests live in a fixed-size Bloom filter, so the state stops growing with the
+    document count; a false positive skips a new document at roughly the configured rate.
+    """
+    state = load_json_state(s3_client, config['s3_bucket'], config['state_key'], config['state_path'])
+    if not state or state.get('version') not in (1, 2, INCREMENTAL_STATE_VERSION):
+        return {'seen_digests': new_seen_index(config), 'daily_aggregates': {}, 'documents': 0, 'aggregate_files': {}}
+    if state['version'] == 1:
+        # v1 kept one cumulative list; file it under the day it was written
+        for aggregate in state['aggregates']:
+            aggregate.setdefault('neutral', aggregate['total'] - aggregate['positive'] - aggregate['negative'])
+        state['daily_aggregates'] = {state['updated_at'][:10]: state['aggregates']}
+    if state['version'] < 3:
+        # v1 and v2 stored every digest, packed; fold them into the filter
+        packed = base64.b64decode(state['seen_digests'])
+        seen_index = new_seen_index(config)
+        seen_index.add_all(packed[i:i + 16] for i in range(0, len(packed), 16))
+    else:
+        seen_index = FingerprintIndex.from_bytes(base64.b64decode(state['seen_index']))
+    if seen_index.count > config['seen_capacity']:
+        print(f"⚠️  Seen-digest index holds {seen_index.count} documents, above SEEN_DIGEST_CAPACITY={config['seen_capacity']}")
+    return {
+        'seen_digests': seen_index,
+        'daily_aggregates': state['daily_aggregates'],
+        'documents': state['documents'],
+        'aggregate_files': state.get('aggregate_files', {})
+    }
+
+def save_incremental_state(s3_client, config, seen_digests, daily_aggregates, documents, aggregate_files=None):
+    """
+    Persist digests, aggregates and the partial-aggregate files folded into them
+    as one object so they can never disagree
+    """
+    save_json_state(s3_client, config['s3_bucket'], config['state_key'], {
+        'version': INCREMENTAL_STATE_VERSION,
+        'updated_at': datetime.datetime.now().isoformat(),
+        'documents': documents,
+        'seen_index': base64.b64encode(seen_digests.to_bytes()).decode('ascii'),
+        'daily_aggregates': daily_aggregates,
+        'aggregate_files': aggregate_files or {}
+    }, config['state_path'])
+
+def fold_daily_aggregates(daily_aggregates, analysis_date, new_aggregates):
+    """
+    Fold a run's aggregates into its analysis date; return (daily_aggregates, cumulative)
+    where cumulative merges every date in order
+    """
+    daily_aggregates = dict(daily_aggregates)
+    daily_aggregates[analysis_date] = merge_property_aggregates(daily_aggregates.get(analysis_date, []), new_aggregates)
+    cumulative = []
+    for date in sorted(daily_aggregates):
+        cumulative = merge_property_aggregates(cumulative, daily_aggregates[date])
+    return daily_aggregates, cumulative
+
+def build_daily_rows(daily_aggregates):
+    """
+    Flat per-date, per-property rows for QuickSight trend visuals
+    """
+    rows = []
+    for date in sorted(daily_aggregates):
+        for aggregate in daily_aggregates[date]:
+            total = aggregate['total']
+            rows.append({
+                "analysis_date": date,
+                "property_name": aggregate['property'],
+                "total_mentions": total,
+                "positive_count": aggregate['positive'],
+                "negative_count": aggregate['negative'],
+                "neutral_count": aggregate['neutral'],
+                "positive_percentage": round(aggregate['positive'] / total * 100, 1) if total else 0,
+                "negative_percentage": round(aggregate['negative'] / total * 100, 1) if total else 0,
+                "confidence_score": round(aggregate['confidence_sum'] / total * 100, 1) if total else 0
+            })
+    return rows
+
+def save_daily_rows(s3_client, daily_aggregates, config):
+    """Save the per-date QuickSight table next to the main output"""
+    daily_key = config['s3_output_key'].replace('.json', '-daily.json')
+    s3_client.put_object(
+        Bucket=config['s3_bucket'],
+        Key=daily_key,
+        Body=json.dumps(build_daily_rows(daily_aggregates), indent=2, ensure_ascii=False),
+        ContentType='application/json'
+    )
+    print(f"   📅 Daily: s3://{config['s3_bucket']}/{daily_key}")
+
+def trend_bucket_start(timestamp, granularity):
+    """Start of the hour/day/week bucket containing ``timestamp`` (weeks start on Monday)"""
+    start = timestamp.replace(minute=0, second=0, microsecond=0)
+    if granularity == 'hour':
+        return start
+    start = start.replace(hour=0)
+    if granularity == 'day':
+        return start
+    if granularity == 'week':
+        return start - datetime.timedelta(days=start.weekday())
+    raise ValueError(f"Unsupported trend granularity: {granularity}")
+
+def trend_bucket_id(start, granularity):
+    return start.strftime('%Y-%m-%dT%H') if granularity == 'hour' else start.strftime('%Y-%m-%d')
+
+TREND_BUCKET_STEPS = {'hour': datetime.timedelta(hours=1), 'day': datetime.timedelta(days=1),
+                      'week': datetime.timedelta(weeks=1)}
+
+# Merged form of a closed bucket, stored inside its partition next to the run objects
+TREND_COMPACTED_NAME = '_compacted.json'
+
+def last_trend_bucket_starts(timestamp, granularity, count):
+    """Starts of the ``count`` most recent buckets ending with the current one, oldest first"""
+    start = trend_bucket_start(timestamp, granularity)
+    return [start - TREND_BUCKET_STEPS[granularity] * i for i in range(count - 1, -1, -1)]
+
+def last_trend_buckets(timestamp, granularity, count):
+    """Bucket ids of the ``count`` most recent buckets ending with the current one, oldest first"""
+    return [trend_bucket_id(start, granularity) for start in last_trend_bucket_starts(timestamp, granularity, count)]
+
+def trend_partition(config, granularity, bucket_id):
+    """S3 prefix (or local directory) holding one bucket's append-only run objects"""
+    if config['trend_path']:
+        return os.path.join(config['trend_path'], granularity, bucket_id)
+    return f"{config['trend_prefix']}{granularity}/{bucket_id}/"
+
+def append_trend_run(s3_client, config, timestamp, run_id, aggregates, documents):
+    """
+    Append this run's newly scored aggregates to the current bucket of every
+    configured granularity. Objects are never rewritten; a bucket is the merge
+    of its run objects.
+    """
+    for granularity in config['trend_granularities']:
+        bucket_id = trend_bucket_id(trend_bucket_start(timestamp, granularity), granularity)
+        partition = trend_partition(config, granularity, bucket_id)
+        run_object = {
+            'granularity': granularity,
+            'bucket': bucket_id,
+            'run_id': run_id,
+            'written_at': timestamp.isoformat(),
+            'documents': documents,
+            'aggregates': aggregates
+        }
+        if config['trend_path']:
+            os.makedirs(partition, exist_ok=True)
+            save_json_state(s3_client, None, None, run_object, os.path.join(partition, f"{run_id}.json"))
+        else:
+            save_json_state(s3_client, config['s3_bucket'], f"{partition}{run_id}.json", run_object)
+
+def append_trend_retractions(s3_client, config, timestamp, run_id, retractions):
+    """
+    Append a retraction run object to the bucket each retracted contribution
+    was first counted in (the current one when its fold time is unknown), so
+    rewritten files move the trend series with the cumulative output. A closed
+    bucket's compacted object is dropped so the next read merges it in again.
+    """
+    for granularity in config['trend_granularities']:
+        retracted_by_bucket = {}
+        for fold_date, retracted, folded_at in retractions:
+            folded = datetime.datetime.fromisoformat(folded_at or fold_date) if folded_at or fold_date else timestamp
+            bucket_id = trend_bucket_id(trend_bucket_start(folded, granularity), granularity)
+            retracted_by_bucket[bucket_id] = merge_property_aggregates(retracted_by_bucket.get(bucket_id, []), retracted)
+        
+        for bucket_id, retracted in retracted_by_bucket.items():
+            partition = trend_partition(config, granularity, bucket_id)
+            run_object = {
+                'granularity': granularity,
+                'bucket': bucket_id,
+                'run_id': run_id,
+                'written_at': timestamp.isoformat(),
+                'documents': 0,
+                'aggregates': [],
+                'retracted': retracted
+            }
+            if config['trend_path']:
+                os.makedirs(partition, exist_ok=True)
+                save_json_state(s3_client, None, None, run_object, os.path.join(partition, f"{run_id}-retract.json"))
+                compacted_path = os.path.join(partition, TREND_COMPACTED_NAME)
+                if os.path.exists(compacted_path):
+                    os.remove(compacted_path)
+            else:
+                save_json_state(s3_client, config['s3_bucket'], f"{partition}{run_id}-retract.json", run_object)
+                s3_client.delete_object(Bucket=config['s3_bucket'], Key=partition + TREND_COMPACTED_NAME)
+        if retracted_by_bucket:
+            print(f"   📉 Trend ({granularity}): retracted rewritten files from {sorted(retracted_by_bucket)}")
+
+def load_trend_runs(s3_client, config, granularity, bucket_id):
+    """
+    Merge every run object of one bucket into per-property aggregates, less any
+    retracted contributions; returns (aggregates, run count)
+    """
+    partition = trend_partition(config, granularity, bucket_id)
+    if config['trend_path']:
+        if not os.path.isdir(partition):
+            return [], 0
+        sources = [(None, os.path.join(partition, name)) for name in sorted(os.listdir(partition))
+                   if name.endswith('.json') and name != TREND_COMPACTED_NAME]
+    else:
+        paginator = s3_client.get_paginator('list_objects_v2')
+        sources = [(obj['Key'], None) for page in paginator.paginate(Bucket=config['s3_bucket'], Prefix=partition)
+                   for obj in page.get('Contents', [])
+                   if obj['Key'].endswith('.json') and obj['Key'] != partition + TREND_COMPACTED_NAME]
+    
+    aggregates, retracted = [], []
+    for key, local_path in sources:
+        run_object = load_json_state(s3_client, config['s3_bucket'], key, local_path)
+        if run_object:
+            aggregates = merge_property_aggregates(aggregates, run_object['aggregates'])
+            retracted = merge_property_aggregates(retracted, run_object.get('retracted', []))
+    # Retractions apply once every run is merged: a retraction may sort before the run it cancels
+    return subtract_property_aggregates(aggregates, retracted), len(sources)
+
+def load_trend_bucket(s3_client, config, granularity, bucket_id, closed=False):
+    """
+    Per-property aggregates of one bucket. A closed bucket gets no more runs, so
+    its runs are merged once into a compacted object that later reads use alone;
+    the open bucket is always merged from its run objects.
+    """
+    if not closed:
+        return load_trend_runs(s3_client, config, granularity, bucket_id)[0]
+    
+    partition = trend_partition(config, granularity, bucket_id)
+    key, local_path = (None, os.path.join(partition, TREND_COMPACTED_NAME)) if config['trend_path'] \
+        else (partition + TREND_COMPACTED_NAME, None)
+    compacted = load_json_state(s3_client, config['s3_bucket'], key, local_path)
+    if compacted is not None:
+        return compacted['aggregates']
+    
+    aggregates, runs = load_trend_runs(s3_client, config, granularity, bucket_id)
+    if local_path:
+        os.makedirs(partition, exist_ok=True)
+    save_json_state(s3_client, config['s3_bucket'], key, {
+        'granularity': granularity,
+        'bucket': bucket_id,
+        'runs': runs,
+        'compacted_at': datetime.datetime.now().isoformat(),
+        'aggregates': aggregates
+    }, local_path)
+    return aggregates
+
+def load_trend_series(s3_client, config, granularity, timestamp, count):
+    """
+    Range query for the last ``count`` buckets: closed buckets are read from their
+    compacted object, and only the still-open ones list and read run objects
+    (concurrently). Returns [(bucket_id, aggregates)], oldest first.
+    """
+    grace = datetime.timedelta(seconds=config['trend_compact_grace'])
+    buckets = [(trend_bucket_id(start, granularity), start + TREND_BUCKET_STEPS[granularity] + grace <= timestamp)
+               for start in last_trend_bucket_starts(timestamp, granularity, count)]
+    with ThreadPoolExecutor(max_workers=max(1, min(len(buckets), config['retrieve_concurrency']))) as executor:
+        aggregates = list(executor.map(
+            lambda bucket: load_trend_bucket(s3_client, config, granularity, bucket[0], bucket[1]), buckets))
+    return [(bucket_id, bucket_aggregates) for (bucket_id, _), bucket_aggregates in zip(buckets, aggregates)]
+
+def build_trend_series_rows(series, rolling_window=3):
+    """
+    Flat per-bucket, per-property rows with rolling-window percentages and
+    deltas against the previous bucket, for QuickSight trend visuals
+    """
+    properties = []
+    for _, aggregates in series:
+        for aggregate in aggregates:
+            if aggregate['property'] not in properties:
+                properties.append(aggregate['property'])
+    
+    rows = []
+    for property_name in properties:
+        history = []
+        previous = None
+        for bucket_id, aggregates in series:
+            aggregate = next((a for a in aggregates if a['property'] == property_name), None)
+            counts = {field: aggregate[field] if aggregate else 0 for field in ('positive', 'negative', 'total')}
+            history.append(counts)
+            window = history[-rolling_window:]
+            window_total = sum(c['total'] for c in window)
+            positive_pct = round(counts['positive'] / counts['total'] * 100, 1) if counts['total'] else 0
+            negative_pct = round(counts['negative'] / counts['total'] * 100, 1) if counts['total'] else 0
+            rows.append({
+                "bucket": bucket_id,
+                "property_name": property_name,
+                "total_mentions": counts['total'],
+                "positive_percentage": positive_pct,
+                "negative_percentage": negative_pct,
+                "rolling_total_mentions": window_total,
+                "rolling_positive_percentage": round(sum(c['positive'] for c in window) / window_total * 100, 1) if window_total else 0,
+                "rolling_negative_percentage": round(sum(c['negative'] for c in window) / window_total * 100, 1) if window_total else 0,
+                "delta_mentions": counts['total'] - previous['total_mentions'] if previous else 0,
+                "delta_positive_percentage": round(positive_pct - previous['positive_percentage'], 1) if previous else 0,
+                "delta_negative_percentage": round(negative_pct - previous['negative_percentage'], 1) if previous else 0
+            })
+            previous = rows[-1]
+    return rows
+
+def save_trend_series(s3_client, config, timestamp):
+    """Regenerate the trend series outputs for every configured granularity"""
+    for granularity in config['trend_granularities']:
+        series = load_trend_series(s3_client, config, granularity, timestamp, config['trend_series_buckets'])
+        series_key = config['s3_output_key'].replace('.json', f'-series-{granularity}.json')
+        s3_client.put_object(
+            Bucket=config['s3_bucket'],
+            Key=series_key,
+            Body=json.dumps(build_trend_series_rows(series, config['trend_rolling_window']), indent=2, ensure_ascii=False),
+            ContentType='application/json'
+        )
+        print(f"   📈 Trend series ({granularity}): s3://{config['s3_bucket']}/{series_key}")
+
+class SpikeDetector:
+    """
+    Online spike detector over per-batch aggregates.
+
+    Keeps an EWMA mean and variance of each property's negative_percentage
+    and of every theme's share of mentions, so memory is constant per
+    property. A batch value is flagged once the baseline has warmed up when
+    its z-score and its jump above the baseline both clear their thresholds.
+    """
+
+    STATE_VERSION = 1
+
+    def __init__(self, state=None, alpha=0.3, z_threshold=3.0, min_delta=10.0, warmup=3, min_mentions=5):
+        self.alpha = alpha
+        self.z_threshold = z_threshold
+        self.min_delta = min_delta
+        self.warmup = warmup
+        self.min_mentions = min_mentions
+        self.baselines = {}
+        if state and state.get('version') == self.STATE_VERSION:
+            self.baselines = state['baselines']
+
+    def observe(self, aggregates, detected_at):
+        """Update baselines with one batch; return alert records for its spikes"""
+        alerts = []
+        themes = [theme.replace('_', ' ') for theme in THEME_PATTERNS]
+        for aggregate in aggregates:
+            total = aggregate['total']
+            if total < self.min_mentions:
+                continue
+            metrics = {'negative_percentage': aggregate['negative'] / total * 100}
+            for theme in themes:
+                metrics[f'theme:{theme}'] = aggregate['theme_mentions'].get(theme, 0) / total * 100
+            
+            baselines = self.baselines.setdefault(aggregate['property'], {})
+            for metric, value in metrics.items():
+                alert = self._update(baselines, metric, value)
+                if alert:
+                    alert.update({'property': aggregate['property'], 'mentions': total,
+                                  'detected_at': detected_at.isoformat()})
+                    alerts.append(alert)
+        return alerts
+
+    def _update(self, baselines, metric, value):
+        baseline = baselines.setdefault(metric, {'mean': value, 'var': 0.0, 'n': 0})
+        alert = None
+        if baseline['n'] >= self.warmup:
+            deviation = value - baseline['mean']
+            z_score = deviation / math.sqrt(baseline['var'] + 1.0)  # +1 pct-point^2 keeps flat baselines sane
+            if z_score >= self.z_threshold and deviation >= self.min_delta:
+                alert = {
+                    'metric': metric,
+                    'value': round(value, 1),
+                    'baseline': round(baseline['mean'], 1),
+                    'z_score': round(z_score, 2),
+                    'severity': 'high' if z_score >= 2 * self.z_threshold else 'medium'
+                }
+        
+        # EWMA mean/variance update (the spike itself also moves the baseline)
+        diff = value - baseline['mean']
+        increment = self.alpha * diff
+        baseline['mean'] += increment
+        baseline['var'] = (1 - self.alpha) * (baseline['var'] + diff * increment)
+        baseline['n'] += 1
+        return alert
+
+    def to_state(self):
+        return {'version': self.STATE_VERSION, 'baselines': self.baselines}
+
+def create_spike_detector(s3_client, config):
+    """Spike detector primed with the persisted baselines"""
+    state = load_json_state(s3_client, config['s3_bucket'], config['anomaly_state_key'], config['anomaly_state_path'])
+    return SpikeDetector(state, config['anomaly_alpha'], config['anomaly_z_threshold'],
+                         config['anomaly_min_delta'], config['anomaly_warmup'], config['anomaly_min_mentions'])
+
+def attach_spike_alerts(results, alerts):
+    """Add per-property spike alerts next to action_required"""
+    by_property = defaultdict(list)
+    for alert in alerts:
+        by_property[alert['property']].append(alert)
+    for result in results:
+        result['spike_alerts'] = by_property.get(result['topic'], [])
+        result['spike_detected'] = bool(result['spike_alerts'])
+
+def save_spike_alerts(s3_client, config, detector, alerts):
+    """Write this batch's alert records and the updated detector baselines"""
+    alerts_key = config['s3_output_key'].replace('.json', '-alerts.json')
+    s3_client.put_object(
+        Bucket=config['s3_bucket'],
+        Key=alerts_key,
+        Body=json.dumps(alerts, indent=2, ensure_ascii=False),
+        ContentType='application/json'
+    )
+    save_json_state(s3_client, config['s3_bucket'], config['anomaly_state_key'], detector.to_state(),
+                    config['anomaly_state_path'])
+    print(f"   🚨 Alerts ({len(alerts)}): s3://{config['s3_bucket']}/{alerts_key}")
+
 def save_results_to_s3(s3_client, results, config):
     """
     Enhanced S3 save with QuickSight optimization
@@ -594,6 +1878,7 @@ def save_results_to_s3(s3_client, results, config):
                     "confidence_score": r['confidence_score'],
                     "priority_level": r['priority_level'],
                     "action_required": r['action_required'],
+                    "spike_detected": r.get('spike_detected', False),
                     "ranking": r['ranking_by_mentions'],
                     "market_share": r['market_share_percentage'],
                     "analysis_date": timestamp.strftime('%Y-%m-%d'),
@@ -0,0 +1,101 @@
+"""
+Persistent Bloom filter over fixed-width content digests, shared by the data
+cleaner (cross-run record dedup) and the sentiment analyzer (incremental runs)
+"""
+import logging
+import math
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+class FingerprintIndex:
+    """Persistent Bloom filter over fixed-width record fingerprint digests.
+
+    Membership can return false positives at roughly the configured rate (while
+    the index holds no more than its capacity) but never false negatives.
+    """
+
+    HEADER = struct.Struct('>4sBQBQ')  # magic, version, num_bits, num_hashes, count
+    MAGIC = b'SGFP'
+    VERSION = 1
+
+    def __init__(self, num_bits, num_hashes, count=0, bits=None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.count = count
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.claimed = set()  # digests taken by files still in flight, not yet in the bit array
+
+    @classmethod
+    def for_capacity(cls, capacity, false_positive_rate, max_bytes):
+        """Size the filter for `capacity` digests at `false_positive_rate`, capped at `max_bytes`"""
+        num_bits = math.ceil(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2))
+        if num_bits > max_bytes * 8:
+            logger.warning(f"Fingerprint index capped at {max_bytes} bytes; false-positive rate will exceed {false_positive_rate}")
+            num_bits = max_bytes * 8
+        num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        return cls(num_bits, num_hashes)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Restore an index written by to_bytes"""
+        magic, version, num_bits, num_hashes, count = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError("Unrecognized fingerprint index format")
+        return cls(num_bits, num_hashes, count, bytearray(data[cls.HEADER.size:]))
+
+    def to_bytes(self):
+        """Serialize the index header and bit array"""
+        with self.lock:
+            return self.HEADER.pack(self.MAGIC, self.VERSION, self.num_bits, self.num_hashes, self.count) + bytes(self.bits)
+
+    def _positions(self, digest):
+        h1, h2 = struct.unpack_from('>QQ', digest)
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, digest):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(digest))
+
+    def claim(self, digest, own=False):
+        """Atomically check a digest against the index and in-flight files, taking it if new.
+
+        An `own` digest, kept by the same source file in an earlier run, is already
+        in the index because of that file, so it only conflicts with files in flight.
+        """
+        with self.lock:
+            if digest in self.claimed or (not own and digest in self):
+                return False
+            self.claimed.add(digest)
+            return True
+
+    def commit(self, digests):
+        """Move a finished file's claims into the index"""
+        with self.lock:
+            self.claimed.difference_update(digests)
+        self.add_all(digests)
+
+    def release(self, digests):
+        """Drop a failed file's claims so a retry (or another file) can keep those records"""
+        with self.lock:
+            self.claimed.difference_update(digests)
+
+    def add(self, digest):
+        """Add one digest, so the index can stand in for a set of seen digests"""
+        self.add_all((digest,))
+
+    def add_all(self, digests):
+        """Add digests to the index, counting only those not already present"""
+        with self.lock:
+            bits = self.bits
+            for digest in digests:
+                added = False
+                for pos in self._positions(digest):
+                    if not bits[pos >> 3] & (1 << (pos & 7)):
+                        bits[pos >> 3] |= 1 << (pos & 7)
+                        added = True
+                self.count += added
+            self.dirty = True
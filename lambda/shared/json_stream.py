@@ -0,0 +1,172 @@
+"""
+Incremental JSON reading over byte streams, shared by the data cleaner (raw
+Socialgist files) and the sentiment analyzer (cleaned JSON outputs)
+"""
+import codecs
+import json
+import re
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024  # bytes read per stream read
+DEFAULT_MAX_VALUE_SIZE = 64 * 1024 * 1024  # characters one value may span before it is rejected
+
+_json_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+_structural = re.compile(r'["\[\]{}]')
+_string_special = re.compile(r'["\\]')
+_scalar_end = re.compile(r'[ \t\n\r,\]}]')
+
+class JsonStreamReader:
+    """Incremental reader over a byte stream holding a single JSON document.
+
+    Only the unconsumed tail of the document is kept in memory, so values can be
+    decoded one at a time without loading the whole file. A single value larger
+    than `max_value_size` characters is rejected rather than buffered.
+    """
+
+    def __init__(self, stream, chunk_size=DEFAULT_CHUNK_SIZE, max_value_size=DEFAULT_MAX_VALUE_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.max_value_size = max_value_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Read the next chunk from the stream, dropping already consumed text"""
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            text = self.decoder.decode(b'', final=True)
+        else:
+            text = self.decoder.decode(chunk)
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it ('' at end of stream)"""
+        while True:
+            self.pos = _whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        """Consume the next non-whitespace character, which must be `char`"""
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Malformed JSON: expected '{char}' but found '{found or 'end of file'}'")
+        self.pos += 1
+
+    def read_value(self):
+        """Decode and consume the next complete JSON value"""
+        self.peek()
+        try:
+            value, end = _json_decoder.raw_decode(self.buffer, self.pos)
+        except json.JSONDecodeError:
+            if self.eof:
+                raise
+            end = None
+        # Other values end on their own closing character, but a number cut at the buffer
+        # boundary (after a digit, '.' or exponent) still decodes, so it needs a delimiter after it
+        if end is not None:
+            number = isinstance(value, (int, float)) and not isinstance(value, bool)
+            if self.eof or not number or _scalar_end.match(self.buffer, end):
+                self.pos = end
+                return value
+        
+        # The value runs past the buffered text: find its end first, then decode it once
+        self.scan_value_end()
+        value, self.pos = _json_decoder.raw_decode(self.buffer, self.pos)
+        return value
+
+    def read_more(self):
+        """Read another chunk into a value still being scanned, enforcing the size limit"""
+        if len(self.buffer) - self.pos > self.max_value_size:
+            raise ValueError(f"Malformed JSON: value exceeds {self.max_value_size} characters")
+        if not self.fill():
+            raise ValueError("Malformed JSON: value truncated at end of file")
+
+    def scan_value_end(self):
+        """Return the buffer index just past the value at the current position.
+
+        Reads chunks until the value is complete, tracking nesting depth and string
+        state so each new chunk is scanned once, where the previous scan stopped.
+        """
+        if self.buffer[self.pos] not in '[{"':
+            # Bare scalar: ends at the next delimiter or at end of file
+            scanned = 0
+            while True:
+                match = _scalar_end.search(self.buffer, self.pos + scanned)
+                if match is not None:
+                    return match.start()
+                if self.eof:
+                    return len(self.buffer)
+                scanned = len(self.buffer) - self.pos
+                self.read_more()
+        
+        depth, in_string = 0, False
+        scanned = 0  # relative to the value start, which fill() may move
+        while True:
+            buffer, index = self.buffer, self.pos + scanned
+            while True:
+                match = (_string_special if in_string else _structural).search(buffer, index)
+                if match is None:
+                    index = len(buffer)
+                    break
+                char, index = match.group(), match.end()
+                if char == '\\':
+                    if index == len(buffer):
+                        index -= 1  # the escaped character is in the next chunk
+                        break
+                    index += 1
+                elif char == '"':
+                    in_string = not in_string
+                    if not in_string and depth == 0:
+                        return index
+                elif char in '[{':
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        return index
+            scanned = index - self.pos
+            self.read_more()
+
+    def find_path(self, path):
+        """Advance to the value stored under the nested object keys in `path`.
+
+        Sibling values are decoded and discarded along the way. Returns False if
+        the path does not exist or an intermediate value is not an object.
+        """
+        if self.peek() != '{':
+            return False
+        self.pos += 1
+        while self.peek() != '}':
+            key = self.read_value()
+            self.expect(':')
+            if key == path[0]:
+                return len(path) == 1 or self.find_path(path[1:])
+            self.read_value()
+            if self.peek() == ',':
+                self.pos += 1
+        return False
+
+    def iter_array(self, label='array'):
+        """Decode and consume the JSON array at the current position one item at a time"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.read_value()
+            separator = self.peek()
+            self.pos += 1
+            if separator == ']':
+                return
+            if separator != ',':
+                raise ValueError(f"Malformed JSON: unexpected '{separator or 'end of file'}' in {label}")
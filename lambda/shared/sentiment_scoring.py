@@ -0,0 +1,400 @@
+"""
+Keyword sentiment scoring and the mergeable partial-aggregate format, shared by
+the sentiment analyzer and the data cleaner's inline scoring stage
+"""
+import datetime
+import re
+import struct
+from collections import namedtuple
+
+try:
+    import ahocorasick
+except ImportError:  # optional: falls back to one combined regex
+    ahocorasick = None
+
+# Layout version of partial aggregates (worker results and the data cleaner's per-file partials)
+PARTIAL_AGGREGATE_VERSION = 1
+# Binary partial layout: header (magic, version, records, matched, property count), then per property
+# its name, counters and theme counts; strings are u16-length-prefixed UTF-8
+PARTIAL_AGGREGATE_MAGIC = b'SPAG'
+_PARTIAL_HEADER = struct.Struct('<4sHQQI')
+_PARTIAL_COUNTERS = struct.Struct('<QQQQdH')  # positive, negative, neutral, total, confidence_sum, theme count
+_PARTIAL_THEME_COUNT = struct.Struct('<Q')
+
+# Additive fields of a per-property aggregate
+AGGREGATE_COUNTERS = ('positive', 'negative', 'neutral', 'total', 'confidence_sum')
+
+# Refined sentiment keywords with weights
+SENTIMENT_KEYWORDS = {
+    'positive': {
+        # High confidence positive (weight 2)
+        'love': 2, 'amazing': 2, 'excellent': 2, 'fantastic': 2, 'perfect': 2,
+        'best': 2, 'outstanding': 2, 'brilliant': 2, 'incredible': 2,
+        
+        # Medium confidence positive (weight 1.5)
+        'great': 1.5, 'good': 1.5, 'awesome': 1.5, 'wonderful': 1.5,
+        'recommend': 1.5, 'favorite': 1.5, 'satisfied': 1.5,
+        
+        # Streaming-specific positive (weight 1.5)
+        'binge watch': 1.5, 'addicted': 1.5, 'must watch': 1.5,
+        'quality content': 1.5, 'worth it': 1.5, 'impressed': 1.5,
+        
+        # Basic positive (weight 1)
+        'like': 1, 'enjoy': 1, 'fine': 1, 'decent': 1, 'okay': 1
+    },
+    
+    'negative': {
+        # High confidence negative (weight 2)
+        'hate': 2, 'terrible': 2, 'awful': 2, 'horrible': 2, 'worst': 2,
+        'pathetic': 2, 'garbage': 2, 'sucks': 2, 'disappointing': 2,
+        
+        # Medium confidence negative (weight 1.5)
+        'frustrating': 1.5, 'annoying': 1.5, 'bad': 1.5, 'poor': 1.5,
+        'waste of money': 1.5, 'overpriced': 1.5, 'cancel': 1.5,
+        
+        # Technical issues (weight 1.5)
+        'buffering': 1.5, 'crashes': 1.5, 'slow': 1.5, 'broken': 1.5,
+        'error': 1.5, 'glitchy': 1.5, 'loading problems': 1.5,
+        
+        # Basic negative (weight 1)
+        'dislike': 1, 'meh': 1, 'boring': 1, 'limited': 1
+    }
+}
+
+
+# Generic streaming properties mapping (no specific brand names)
+STREAMING_PROPERTIES = {
+    # Tier 1: Major Streaming Categories
+    'Premium Streaming Service': ['premium streaming', 'subscription service', 'streaming platform', 'video service'],
+    'Movie Streaming Platform': ['movie streaming', 'film streaming', 'cinema streaming', 'movie platform'],
+    'TV Streaming Service': ['tv streaming', 'television streaming', 'tv shows online', 'series streaming'],
+    
+    # Tier 2: Content Categories
+    'Sports Streaming': ['sports streaming', 'live sports', 'sports content', 'athletic events streaming'],
+    'News Streaming': ['news streaming', 'live news', 'news content', 'breaking news streaming'],
+    'Kids Content Streaming': ['kids streaming', 'children shows', 'family content', 'cartoon streaming'],
+    'Documentary Streaming': ['documentary streaming', 'educational content', 'documentary platform'],
+    
+    # Tier 3: Specialized Services
+    'Live TV Streaming': ['live tv streaming', 'live television', 'broadcast streaming', 'tv channels online'],
+    'Music Streaming': ['music streaming', 'audio streaming', 'music platform', 'song streaming'],
+    'Gaming Streaming': ['game streaming', 'gaming content', 'esports streaming', 'gaming platform'],
+    
+    # Tier 4: Technical Categories
+    'Mobile Streaming': ['mobile streaming', 'smartphone streaming', 'tablet streaming', 'mobile app'],
+    'Smart TV Streaming': ['smart tv streaming', 'tv app', 'television app', 'streaming on tv'],
+    'Free Streaming Service': ['free streaming', 'ad-supported streaming', 'free content platform'],
+    
+    # Tier 5: Generic Categories
+    'International Content': ['international streaming', 'foreign content', 'global streaming', 'international shows'],
+    'Original Content Platform': ['original content', 'exclusive shows', 'original series', 'platform originals']
+}
+
+# Generic streaming fallback with stricter criteria
+GENERAL_STREAMING = 'General Streaming'
+GENERAL_STREAMING_TERMS = ['streaming service', 'video platform', 'subscription service']
+
+# Theme keywords for streaming service context
+THEME_PATTERNS = {
+    'content_quality': ['content quality', 'show quality', 'programming', 'originals', 'exclusive content'],
+    'pricing_value': ['price', 'cost', 'expensive', 'value', 'subscription', 'worth it', 'money'],
+    'user_experience': ['app experience', 'interface', 'navigation', 'search function', 'ease of use'],
+    'technical_performance': ['streaming quality', 'buffering', 'video quality', 'loading speed', 'connectivity'],
+    'content_variety': ['content selection', 'variety', 'catalog size', 'library', 'options'],
+    'customer_service': ['customer support', 'help', 'service', 'response time'],
+    'competitor_comparison': ['vs netflix', 'compared to disney', 'better than hulu', 'amazon prime'],
+    'advertising': ['ads', 'commercials', 'interruptions', 'ad-free'],
+    'device_compatibility': ['roku', 'apple tv', 'smart tv', 'mobile app', 'casting'],
+    'content_discovery': ['recommendations', 'finding shows', 'browse', 'categories']
+}
+
+
+def _trie_pattern(words):
+    """
+    One alternation over ``words`` shaped as a prefix trie, so the regex engine
+    walks shared prefixes once instead of trying every keyword in turn; a node
+    that ends a keyword makes its continuation an optional greedy group, so the
+    longest keyword at a position wins.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return f'(?:{body})?' if '' in node else body
+
+    return build(trie)
+
+
+class KeywordMatcher:
+    """
+    Weighted keyword scorer compiled once per container.
+
+    Uses an Aho-Corasick automaton (single pass, overlapping matches) when
+    pyahocorasick is installed, otherwise one combined regex over every keyword.
+    Either way each distinct keyword found in the text counts once, matching
+    the original ``word in text_lower`` semantics.
+    """
+
+    def __init__(self, keyword_tables):
+        self.categories = tuple(keyword_tables)
+        self.entries = {}
+        for category in self.categories:
+            for word, weight in keyword_tables[category].items():
+                self.entries.setdefault(word.lower(), []).append((category, weight))
+        self.automaton = None
+        self.pattern = None
+        if ahocorasick is not None:
+            self.automaton = ahocorasick.Automaton()
+            for word in self.entries:
+                self.automaton.add_word(word, word)
+            self.automaton.make_automaton()
+        elif self.entries:
+            self.pattern = re.compile(_trie_pattern(self.entries))
+            # The regex reports the longest keyword at each position; shorter ones inside it come along
+            self.contained = {word: {other for other in self.entries if other in word} for word in self.entries}
+
+    def find(self, text_lower):
+        """Return the set of distinct keywords occurring in ``text_lower``."""
+        if self.automaton is not None:
+            return {word for _, word in self.automaton.iter(text_lower)}
+        found = set()
+        if self.pattern is None:
+            return found
+        search = self.pattern.search
+        match = search(text_lower)
+        while match is not None:
+            # Resume one past the match start so keywords overlapping its tail are seen too
+            found.update(self.contained[match.group()])
+            match = search(text_lower, match.start() + 1)
+        return found
+
+    def hits(self, text_lower):
+        """Return the summed weight of every category with at least one match."""
+        totals = {}
+        for word in self.find(text_lower):
+            for category, weight in self.entries[word]:
+                totals[category] = totals.get(category, 0) + weight
+        return totals
+
+    def score(self, text_lower):
+        """Return the summed weight per category, in table order."""
+        totals = self.hits(text_lower)
+        return [totals.get(category, 0) for category in self.categories]
+
+
+# Per-text analysis record: matched properties, weighted sentiment scores and themes
+TextAnalysis = namedtuple('TextAnalysis', ['properties', 'positive_score', 'negative_score', 'themes'])
+
+# One matcher over every table so each text is scanned once
+TEXT_MATCHER = KeywordMatcher({
+    ('sentiment', 'positive'): SENTIMENT_KEYWORDS['positive'],
+    ('sentiment', 'negative'): SENTIMENT_KEYWORDS['negative'],
+    **{('property', name): dict.fromkeys(variations, 1) for name, variations in STREAMING_PROPERTIES.items()},
+    ('property', GENERAL_STREAMING): dict.fromkeys(GENERAL_STREAMING_TERMS, 1),
+    **{('theme', theme): dict.fromkeys(keywords, 1) for theme, keywords in THEME_PATTERNS.items()}
+})
+
+def analyze_text(text):
+    """
+    Scan one feedback text for properties, sentiment and themes in a single pass
+    """
+    hits = TEXT_MATCHER.hits(text.lower())
+    properties = tuple(name for name in STREAMING_PROPERTIES if ('property', name) in hits)
+    if not properties and ('property', GENERAL_STREAMING) in hits:
+        properties = (GENERAL_STREAMING,)
+    themes = tuple(theme.replace('_', ' ') for theme in THEME_PATTERNS if ('theme', theme) in hits)
+    return TextAnalysis(
+        properties,
+        hits.get(('sentiment', 'positive'), 0),
+        hits.get(('sentiment', 'negative'), 0),
+        themes
+    )
+
+def new_property_aggregate(property_name):
+    """Empty mergeable per-property aggregate"""
+    return {'property': property_name, 'positive': 0, 'negative': 0, 'neutral': 0, 'total': 0,
+            'confidence_sum': 0, 'theme_mentions': {}}
+
+def fold_text_analysis(aggregate, record):
+    """Fold one TextAnalysis record into a per-property aggregate"""
+    text_pos_score = record.positive_score
+    text_neg_score = record.negative_score
+    
+    # Classify with confidence
+    if text_pos_score > text_neg_score:
+        aggregate['positive'] += 1
+        aggregate['confidence_sum'] += text_pos_score / (text_pos_score + text_neg_score + 0.1)
+    elif text_neg_score > text_pos_score:
+        aggregate['negative'] += 1
+        aggregate['confidence_sum'] += text_neg_score / (text_pos_score + text_neg_score + 0.1)
+    else:
+        aggregate['neutral'] += 1
+        aggregate['confidence_sum'] += 0.1  # Low confidence for neutral
+    
+    aggregate['total'] += 1
+    theme_mentions = aggregate['theme_mentions']
+    for theme in record.themes:
+        theme_mentions[theme] = theme_mentions.get(theme, 0) + 1
+
+def aggregate_property_records(property_name, feedback_records):
+    """
+    Fold TextAnalysis records (or raw texts) into a mergeable per-property aggregate
+    """
+    aggregate = new_property_aggregate(property_name)
+    for record in feedback_records:
+        if isinstance(record, str):
+            record = analyze_text(record)
+        fold_text_analysis(aggregate, record)
+    return aggregate
+
+class StreamingAggregator:
+    """
+    Fold texts one at a time into per-property aggregates, in first-seen
+    property order, without holding the texts. Used by producers that score
+    records as they emit them, e.g. the data cleaner's inline scoring stage.
+    """
+
+    def __init__(self):
+        self.aggregates = {}
+        self.matched = 0
+        self.count = 0
+
+    def add(self, text):
+        record = analyze_text(text)
+        self.count += 1
+        if record.properties and record.properties != (GENERAL_STREAMING,):
+            self.matched += 1
+        for prop in record.properties:
+            aggregate = self.aggregates.get(prop)
+            if aggregate is None:
+                aggregate = self.aggregates[prop] = new_property_aggregate(prop)
+            fold_text_analysis(aggregate, record)
+
+    def to_partial(self, source_file, processed_at=None):
+        """Partial aggregate document for one source file, merged by the analyzer's aggregates source"""
+        return make_partial(list(self.aggregates.values()), self.count, self.matched, source_file,
+                            processed_at or datetime.datetime.now().isoformat())
+
+def make_partial(aggregates, records, matched, source_file=None, processed_at=None):
+    """
+    Partial aggregate: per-property counters and exact theme counts plus the
+    number of texts behind them. The unit passed between workers and persisted
+    per file; combine with merge_partials, finalize with results_from_aggregates.
+    """
+    return {
+        'format_version': PARTIAL_AGGREGATE_VERSION,
+        'source_file': source_file,
+        'processed_at': processed_at,
+        'records': records,
+        'matched': matched,
+        'aggregates': aggregates
+    }
+
+def merge_partials(first, second):
+    """
+    Associative merge of two partials. Counts and theme counts add exactly and
+    first-seen property/theme order is kept, so any grouping of a left-to-right
+    reduction gives the same result; source metadata survives only if shared.
+    """
+    processed = [p['processed_at'] for p in (first, second) if p.get('processed_at')]
+    return make_partial(merge_property_aggregates(first['aggregates'], second['aggregates']),
+                        first['records'] + second['records'], first['matched'] + second['matched'],
+                        first.get('source_file') if first.get('source_file') == second.get('source_file') else None,
+                        max(processed) if processed else None)
+
+def _pack_string(value):
+    data = (value or '').encode('utf-8')
+    return struct.pack('<H', len(data)) + data
+
+def _unpack_string(data, offset):
+    (length,) = struct.unpack_from('<H', data, offset)
+    offset += 2
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+def serialize_partial(partial):
+    """Compact binary encoding of a partial aggregate"""
+    parts = [_PARTIAL_HEADER.pack(PARTIAL_AGGREGATE_MAGIC, PARTIAL_AGGREGATE_VERSION, partial['records'],
+                                  partial['matched'], len(partial['aggregates'])),
+             _pack_string(partial.get('source_file')), _pack_string(partial.get('processed_at'))]
+    for aggregate in partial['aggregates']:
+        parts.append(_pack_string(aggregate['property']))
+        parts.append(_PARTIAL_COUNTERS.pack(aggregate['positive'], aggregate['negative'], aggregate['neutral'],
+                                            aggregate['total'], aggregate['confidence_sum'],
+                                            len(aggregate['theme_mentions'])))
+        for theme, count in aggregate['theme_mentions'].items():
+            parts.append(_pack_string(theme) + _PARTIAL_THEME_COUNT.pack(count))
+    return b''.join(parts)
+
+def deserialize_partial(data):
+    """Decode serialize_partial output, rejecting foreign data and newer layouts"""
+    magic, version, records, matched, property_count = _PARTIAL_HEADER.unpack_from(data, 0)
+    if magic != PARTIAL_AGGREGATE_MAGIC:
+        raise ValueError("not a partial aggregate")
+    if version > PARTIAL_AGGREGATE_VERSION:
+        raise ValueError(f"unsupported partial aggregate format_version {version}")
+    source_file, offset = _unpack_string(data, _PARTIAL_HEADER.size)
+    processed_at, offset = _unpack_string(data, offset)
+    
+    aggregates = []
+    for _ in range(property_count):
+        property_name, offset = _unpack_string(data, offset)
+        positive, negative, neutral, total, confidence_sum, theme_count = _PARTIAL_COUNTERS.unpack_from(data, offset)
+        offset += _PARTIAL_COUNTERS.size
+        theme_mentions = {}
+        for _ in range(theme_count):
+            theme, offset = _unpack_string(data, offset)
+            (theme_mentions[theme],) = _PARTIAL_THEME_COUNT.unpack_from(data, offset)
+            offset += _PARTIAL_THEME_COUNT.size
+        aggregates.append({'property': property_name, 'positive': positive, 'negative': negative,
+                           'neutral': neutral, 'total': total, 'confidence_sum': confidence_sum,
+                           'theme_mentions': theme_mentions})
+    return make_partial(aggregates, records, matched, source_file or None, processed_at or None)
+
+def merge_property_aggregates(stored, update):
+    """
+    Merge two aggregate lists by property. Stored order wins, new properties and
+    themes are appended in first-seen order, so merging stays deterministic.
+    """
+    merged = {aggregate['property']: dict(aggregate, theme_mentions=dict(aggregate['theme_mentions']))
+              for aggregate in stored}
+    for aggregate in update:
+        target = merged.get(aggregate['property'])
+        if target is None:
+            merged[aggregate['property']] = dict(aggregate, theme_mentions=dict(aggregate['theme_mentions']))
+            continue
+        for field in AGGREGATE_COUNTERS:
+            target[field] += aggregate[field]
+        for theme, count in aggregate['theme_mentions'].items():
+            target['theme_mentions'][theme] = target['theme_mentions'].get(theme, 0) + count
+    return list(merged.values())
+
+def subtract_property_aggregates(stored, retracted):
+    """
+    Remove an earlier contribution from an aggregate list, e.g. a source file
+    that was rewritten. Properties and themes whose counts reach zero are dropped.
+    """
+    retracted_by_property = {aggregate['property']: aggregate for aggregate in retracted}
+    remaining = []
+    for aggregate in stored:
+        removed = retracted_by_property.get(aggregate['property'])
+        if removed is None:
+            remaining.append(aggregate)
+            continue
+        target = dict(aggregate, theme_mentions={})
+        for field in AGGREGATE_COUNTERS:
+            target[field] = aggregate[field] - removed[field]
+        for theme, count in aggregate['theme_mentions'].items():
+            count -= removed['theme_mentions'].get(theme, 0)
+            if count:
+                target['theme_mentions'][theme] = count
+        if target['total'] or target['theme_mentions']:
+            remaining.append(target)
+    return remaining
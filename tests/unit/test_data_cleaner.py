@@ -1,9 +1,12 @@
 """
 Unit tests for data cleaner Lambda function
 """
+import gzip
+import io
 import json
 import pytest
 from unittest.mock import Mock, patch
+from botocore.exceptions import ClientError
 import sys
 import os
 
@@ -12,7 +15,8 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '../../lambda/data-clean
 
 # Mock boto3 before importing lambda function
 with patch('boto3.client'):
-    from lambda_function import lambda_handler, extract_base_filename
+    from lambda_function import lambda_handler, extract_base_filename, iter_match_records, iter_cleaned_records, process_files, process_single_file, iter_raw_files, FingerprintIndex, fingerprint_digest, NearDuplicateFilter, \
+        S3StreamWriter, JsonArrayWriter, JsonLinesWriter, create_record_writer, KBShardWriter
 
 def test_extract_base_filename():
     """Test filename extraction utility"""
@@ -57,5 +61,463 @@ def test_data_processing_logic(sample_raw_data):
     assert matches[0]["Title"] == "Test streaming service review"
     assert "excellent" in matches[0]["Data"]["Body"]
 
+def test_iter_match_records_streams_across_chunks(sample_raw_data):
+    """Test streaming parser yields the same records as json.loads regardless of chunk size"""
+    matches = sample_raw_data["response"]["Matches"]["Match"]
+    matches.append({"Title": "Caf\u00e9 \u2615 review", "Data": {"Body": "Works, mostly ]}"}})
+    document = {"request": {"q": [1, 2]}, "response": {"Count": 2, "Matches": {"Match": matches}}}
+    raw_bytes = json.dumps(document, ensure_ascii=False, indent=2).encode('utf-8')
+
+    for chunk_size in (1, 7, 1024):
+        records = list(iter_match_records(io.BytesIO(raw_bytes), chunk_size=chunk_size))
+        assert records == matches
+
+def test_json_stream_scans_large_values_once():
+    """A value spanning many chunks is decoded once, and truncated or oversized values fail clearly"""
+    import json_stream
+    records = [{"Title": "big", "Data": {"Body": 'x\\"' * 2000 + 'é'}}, {"Title": "n", "Data": {"Body": "small"}}]
+    data = json.dumps({"response": {"Matches": {"Match": records}}}).encode('utf-8')
+    decoder = Mock(wraps=json_stream._json_decoder)
+
+    with patch.object(json_stream, '_json_decoder', decoder):
+        assert list(iter_match_records(io.BytesIO(data), chunk_size=64)) == records
+    # Not once per chunk: the 6 KB record spans about 100 of them
+    assert decoder.raw_decode.call_count < 20
+
+    # Numbers cut after a digit, '.' or exponent are not decoded early
+    for chunk_size in range(1, 8):
+        reader = json_stream.JsonStreamReader(io.BytesIO(b'[12.5e10, -3.25, 700]'), chunk_size=chunk_size)
+        assert list(reader.iter_array()) == [12.5e10, -3.25, 700]
+
+    with pytest.raises(ValueError, match='truncated'):
+        list(iter_match_records(io.BytesIO(data[:3000]), chunk_size=64))
+    reader = json_stream.JsonStreamReader(io.BytesIO(json.dumps(records).encode('utf-8')), chunk_size=64, max_value_size=1024)
+    with pytest.raises(ValueError, match='exceeds 1024'):
+        list(reader.iter_array())
+
+def test_iter_match_records_missing_path():
+    """Test streaming parser yields nothing when the Match array is absent"""
+    assert list(iter_match_records(io.BytesIO(b'{"response": {"Matches": {}}}'))) == []
+    assert list(iter_match_records(io.BytesIO(b'{"response": {"Matches": {"Match": []}}}'))) == []
+
+def test_iter_cleaned_records_counts():
+    """Test validation and de-duplication counters"""
+    records = [
+        {"Title": "A", "Data": {"Body": "one"}},
+        {"Title": " A ", "Data": {"Body": "one "}},
+        {"Title": "", "Data": {"Body": "no title"}},
+        {"Title": "B", "Data": {}},
+    ]
+    stats = {'total_input_records': 0, 'duplicates_removed': 0, 'skipped_no_title': 0, 'skipped_no_body': 0,
+             'global_duplicates_removed': 0}
+
+    cleaned = list(iter_cleaned_records(iter(records), 'raw/file.json', stats))
+
+    assert [r['title'] for r in cleaned] == ['A']
+    assert stats == {'total_input_records': 4, 'duplicates_removed': 1, 'skipped_no_title': 1, 'skipped_no_body': 1,
+                     'global_duplicates_removed': 0}
+
+def test_fingerprint_index_dedups_across_files():
+    """Test the persistent index drops records seen in earlier files and survives serialization"""
+    index = FingerprintIndex.for_capacity(1000, 0.001, 1024 * 1024)
+    index.add_all({fingerprint_digest('A', 'one')})
+    restored = FingerprintIndex.from_bytes(index.to_bytes())
+
+    records = [{"Title": "A", "Data": {"Body": "one"}}, {"Title": "B", "Data": {"Body": "two"}}]
+    stats = {'total_input_records': 0, 'duplicates_removed': 0, 'skipped_no_title': 0, 'skipped_no_body': 0,
+             'global_duplicates_removed': 0}
+    seen = set()
+    cleaned = list(iter_cleaned_records(iter(records), 'raw/second.json', stats, restored, seen))
+
+    assert [r['title'] for r in cleaned] == ['B']
+    assert stats['global_duplicates_removed'] == 1
+    assert fingerprint_digest('B', 'two') in seen
+    assert restored.count == 1
+
+def test_global_dedup_across_concurrent_files():
+    """Test files processed in the same thread-pool chunk are deduplicated against each other"""
+    import threading
+    def raw(bodies):
+        return json.dumps({"response": {"Matches": {"Match": [{"Title": "T", "Data": {"Body": b}} for b in bodies]}}})
+    bodies = {'raw/a.json': raw([f'post {i}' for i in range(300)]),
+              'raw/b.json': raw([f'post {i}' for i in range(150, 450)]),
+              'raw/bad.json': raw([f'post {i}' for i in range(450, 500)])}
+    both_started = threading.Barrier(3)
+
+    def get_object(Bucket, Key):
+        if Key.startswith('socialgist-state/'):
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'missing'}}, 'GetObject')
+        both_started.wait(timeout=5)  # every file is in flight before any of them finishes
+        if Key == 'raw/bad.json':
+            return {'Body': io.BytesIO(bodies[Key].encode('utf-8')[:-10])}
+        return {'Body': io.BytesIO(bodies[Key].encode('utf-8'))}
+    mock_s3 = Mock()
+    mock_s3.get_object.side_effect = get_object
+    index = FingerprintIndex.for_capacity(10000, 0.0001, 1024 * 1024)
+
+    with patch('lambda_function.s3', mock_s3):
+        summaries, failed = process_files('bucket', list(bodies), mode='thread', max_workers=3, dedup_index=index)
+
+    assert sum(s['cleaned_records'] for s in summaries) == 450
+    assert sum(s['global_duplicates_removed'] for s in summaries) == 150
+    assert [f['file'] for f in failed] == ['raw/bad.json']
+    # The failed file's claims were released, so its records are kept when it is retried
+    assert index.claimed == set() and index.claim(fingerprint_digest('T', 'post 460'))
+
+def test_fingerprint_index_respects_memory_ceiling():
+    """Test index sizing honours the configured byte ceiling"""
+    index = FingerprintIndex.for_capacity(10_000_000, 0.001, 1024)
+    assert len(index.bits) == 1024
+
+@pytest.mark.parametrize('mode', ['sequential', 'thread'])
+def test_process_files_preserves_order_and_failures(mode):
+    """Test concurrent processing keeps per-file summaries ordered and reports failures"""
+    def fake_process(bucket, key, dedup_index=None, kb_shards=None):
+        if key == 'raw/bad.json':
+            raise ValueError('boom')
+        return {'input_file': f's3://{bucket}/{key}'}
+
+    keys = ['raw/a.json', 'raw/bad.json', 'raw/c.json', 'raw/d.json']
+    with patch('lambda_function.process_single_file', side_effect=fake_process):
+        summaries, failed = process_files('bucket', keys, mode=mode, max_workers=3)
+
+    assert [s['input_file'] for s in summaries] == ['s3://bucket/raw/a.json', 's3://bucket/raw/c.json', 's3://bucket/raw/d.json']
+    assert failed == [{'file': 'raw/bad.json', 'error': 'boom'}]
+
+def make_paginated_s3(pages):
+    """Mock S3 client whose list_objects_v2 paginator returns `pages`"""
+    mock_s3 = Mock()
+    mock_s3.get_paginator.return_value.paginate.return_value = [{'Contents': page} for page in pages]
+    return mock_s3
+
+def test_iter_raw_files_follows_pages():
+    """Test listing continues past the first page and keeps only JSON files"""
+    pages = [
+        [{'Key': 'raw/', 'ETag': '"0"'}, {'Key': 'raw/a.json', 'ETag': '"1"'}],
+        [{'Key': 'raw/notes.txt', 'ETag': '"2"'}, {'Key': 'raw/b.JSON', 'ETag': '"3"'}],
+    ]
+    with patch('lambda_function.s3', make_paginated_s3(pages)):
+        assert [obj['Key'] for obj in iter_raw_files('bucket', 'raw/')] == ['raw/a.json', 'raw/b.JSON']
+
+def test_lambda_handler_resumes_from_checkpoint(tmp_path):
+    """Test a timed-out batch saves progress and the next invocation skips completed keys"""
+    pages = [[{'Key': f'raw/{i}.json', 'ETag': f'"{i}"'} for i in range(4)]]
+    processed = []
+
+    def fake_process_files(bucket, keys, **kwargs):
+        processed.extend(keys)
+        return [{'total_input_records': 1, 'cleaned_records': 1} for _ in keys], []
+
+    context = Mock()
+    context.get_remaining_time_in_millis.side_effect = [600000, 0]
+
+    with patch('lambda_function.s3', make_paginated_s3(pages)), \
+         patch('lambda_function.process_files', side_effect=fake_process_files), \
+         patch('lambda_function.CHECKPOINT_PATH', str(tmp_path / 'checkpoint.json')), \
+         patch('lambda_function.CHECKPOINT_EVERY', 2):
+        first = json.loads(lambda_handler({}, context)['body'])
+        assert first['batch_complete'] is False
+        assert processed == ['raw/0.json', 'raw/1.json']
+
+        second = json.loads(lambda_handler({}, {})['body'])
+        assert second['batch_complete'] is True
+        assert second['batch_id'] == first['batch_id']
+        assert second['files_skipped_checkpoint'] == 2
+        assert processed == ['raw/0.json', 'raw/1.json', 'raw/2.json', 'raw/3.json']
+        assert not (tmp_path / 'checkpoint.json').exists()
+
+def test_lambda_handler_incremental_skips_unchanged(tmp_path):
+    """Test incremental mode only reprocesses new or modified raw files"""
+    def listing(etag_b):
+        return [[
+            {'Key': 'raw/a.json', 'ETag': '"a1"', 'Size': 10, 'LastModified': '2025-06-01T00:00:00'},
+            {'Key': 'raw/b.json', 'ETag': etag_b, 'Size': 10, 'LastModified': '2025-06-01T00:00:00'},
+        ]]
+    processed = []
+
+    def fake_process_files(bucket, keys, **kwargs):
+        processed.append(list(keys))
+        return [{'total_input_records': 1, 'cleaned_records': 1} for _ in keys], []
+
+    with patch('lambda_function.process_files', side_effect=fake_process_files), \
+         patch('lambda_function.CHECKPOINT_PATH', str(tmp_path / 'checkpoint.json')), \
+         patch('lambda_function.MANIFEST_PATH', str(tmp_path / 'manifest.json')), \
+         patch('lambda_function.INCREMENTAL', True):
+        with patch('lambda_function.s3', make_paginated_s3(listing('"b1"'))):
+            lambda_handler({}, {})
+        with patch('lambda_function.s3', make_paginated_s3(listing('"b2"'))):
+            body = json.loads(lambda_handler({}, {})['body'])
+
+    assert processed == [['raw/a.json', 'raw/b.json'], ['raw/b.json']]
+    assert body['files_skipped_unchanged'] == 1
+    assert body['files_processed'] == 1
+
+class InMemoryS3:
+    """Dict-backed S3 stand-in covering the calls a whole cleaner batch makes"""
+    def __init__(self, objects):
+        self.objects = dict(objects)
+
+    def get_paginator(self, name):
+        paginator = Mock()
+        paginator.paginate.side_effect = lambda Bucket, Prefix: [{'Contents': [
+            {'Key': key, 'ETag': f'"{len(body)}"', 'Size': len(body), 'LastModified': '2025-06-01T00:00:00'}
+            for key, body in sorted(self.objects.items()) if key.startswith(Prefix)]}]
+        return paginator
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'missing'}}, 'GetObject')
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        self.objects[Key] = Body if isinstance(Body, bytes) else Body.encode('utf-8')
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def kb_lines(self):
+        return sorted(line for key, body in self.objects.items() if key.startswith('socialgist-kb/')
+                      for line in body.decode('utf-8').splitlines())
+
+def raw_file(*titles):
+    return json.dumps({"response": {"Matches": {"Match": [{"Title": t, "Data": {"Body": f"{t} body"}} for t in titles]}}}).encode()
+
+@pytest.mark.parametrize('sharding', [False, True])
+def test_global_dedup_rerun_keeps_a_files_own_records(sharding):
+    """Reprocessing a file under GLOBAL_DEDUP is not deduped against its own earlier run"""
+    store = InMemoryS3({'YOUR S3 RAW FOLDER/a.json': raw_file('A', 'B', 'C'),
+                        'YOUR S3 RAW FOLDER/b.json': raw_file('C', 'D')})
+
+    def run():
+        with patch('lambda_function.s3', store), patch('lambda_function.GLOBAL_DEDUP', True), \
+                patch('lambda_function.KB_SHARDING', sharding), patch('lambda_function.EXECUTION_MODE', 'sequential'):
+            body = json.loads(lambda_handler({}, {})['body'])
+        assert body['files_failed'] == 0
+        cleaned = {key: [record['title'] for record in json.loads(value)] for key, value in store.objects.items()
+                   if key.startswith('socialgist-processed/clean-')}
+        return body['total_cleaned_records'], cleaned, store.kb_lines()
+
+    first = run()
+    assert first[0] == 4 and first[1]['socialgist-processed/clean-a.json'] == ['A', 'B', 'C']
+    assert run() == first
+
+def test_failed_file_keeps_previous_kb_shards():
+    """A batch with a failed file does not retire the shards still holding that file's records"""
+    store = InMemoryS3({'YOUR S3 RAW FOLDER/a.json': raw_file('A'), 'YOUR S3 RAW FOLDER/b.json': raw_file('B')})
+    batches = iter(['20250601T000000Z', '20250602T000000Z', '20250603T000000Z'])
+
+    def run():
+        checkpoint = {'batch_id': next(batches), 'started_at': '', 'completed': {}}
+        with patch('lambda_function.s3', store), patch('lambda_function.KB_SHARDING', True), \
+                patch('lambda_function.EXECUTION_MODE', 'sequential'), \
+                patch('lambda_function.load_checkpoint', return_value=checkpoint):
+            return json.loads(lambda_handler({}, {})['body'])
+
+    run()
+    first_shard = 'socialgist-kb/ready-20250601T000000Z-00000.jsonl'
+    store.objects['YOUR S3 RAW FOLDER/b.json'] = raw_file('B')[:-10]
+    assert run()['files_failed'] == 1
+    assert first_shard in store.objects and 'B body' in store.objects[first_shard].decode()
+
+    store.objects['YOUR S3 RAW FOLDER/b.json'] = raw_file('B')
+    assert run()['files_failed'] == 0
+    assert [key for key in store.objects if key.startswith('socialgist-kb/')] == [
+        'socialgist-kb/ready-20250603T000000Z-00000.jsonl']
+
+def test_near_duplicate_filter_drops_trivial_edits():
+    """Test MinHash/LSH stage removes reposts with whitespace or signature edits but keeps distinct posts"""
+    pytest.importorskip('numpy')
+    body = ("The new release finally fixed the buffering on my smart tv and the picture quality "
+            "is noticeably better than last month, although the app still takes a while to load.")
+    records = [
+        {'title': 'Streaming update', 'body': body},
+        {'title': 'Streaming  update', 'body': body.replace(' the app', '\n the  app') + ' Thanks!'},
+        {'title': 'Cancelled my plan', 'body': 'Too many price increases this year, switching to cable again.'},
+        {'title': 'Short', 'body': 'ok'},
+        {'title': 'short', 'body': 'OK'},
+    ]
+    stats = {'near_duplicates_removed': 0}
+
+    kept = list(NearDuplicateFilter(threshold=0.8, batch_size=2).filter(iter(records), stats))
+
+    assert [r['title'] for r in kept] == ['Streaming update', 'Cancelled my plan', 'Short']
+    assert stats['near_duplicates_removed'] == 2
+
+@pytest.mark.parametrize('indent', [2, None])
+@pytest.mark.parametrize('count', [0, 1, 3])
+def test_json_array_writer_matches_json_dumps(indent, count):
+    """Test streamed JSON array output is identical to json.dumps of the full list"""
+    records = [{'title': f't{i}', 'body': 'caf\u00e9', 'nested': {'n': i}} for i in range(count)]
+    out = io.StringIO()
+    writer = JsonArrayWriter(out, indent)
+    for record in records:
+        writer.write(record)
+    writer.close()
+
+    assert out.getvalue() == json.dumps(records, indent=indent)
+    assert writer.count == count
+
+def test_json_lines_writer_matches_join():
+    """Test streamed JSONL output matches newline-joined lines"""
+    out = io.BytesIO()
+    writer = JsonLinesWriter(out)
+    for i in range(3):
+        writer.write({'text': f'line {i}'})
+    assert out.getvalue().decode('utf-8') == "\n".join(json.dumps({'text': f'line {i}'}) for i in range(3))
+
+def read_back(output_format, data):
+    """Decode cleaned output bytes written in `output_format` back into records"""
+    if output_format == 'jsonl.gz':
+        return [json.loads(line) for line in gzip.decompress(data).decode('utf-8').split('\n')]
+    if output_format == 'jsonl.zst':
+        import zstandard
+        text = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)).read().decode('utf-8')
+        return [json.loads(line) for line in text.split('\n')]
+    import pyarrow.parquet as pq
+    table = pq.read_table(io.BytesIO(data))
+    assert table.schema.field('processed_at').type.unit == 'us'
+    rows = table.to_pylist()
+    for row in rows:
+        row['processed_at'] = row['processed_at'].isoformat()
+    return rows
+
+@pytest.mark.parametrize('output_format, module', [('jsonl.gz', 'gzip'), ('jsonl.zst', 'zstandard'), ('parquet', 'pyarrow')])
+def test_record_writer_formats_round_trip(output_format, module):
+    """Test compressed and columnar cleaned outputs decode back to the original records"""
+    pytest.importorskip(module)
+    records = [{'title': f't{i}', 'body': 'b\u00e9', 'source_file': 'raw/a.json',
+                'processed_at': f'2025-06-12T10:30:0{i}.123456'} for i in range(5)]
+    mock_s3 = Mock()
+    mock_s3.create_multipart_upload.return_value = {'UploadId': 'u1'}
+    mock_s3.upload_part.side_effect = lambda **kwargs: {'ETag': f"e{kwargs['PartNumber']}"}
+
+    with patch('lambda_function.s3', mock_s3), patch('lambda_function.PARQUET_ROW_GROUP_SIZE', 2):
+        with S3StreamWriter('bucket', 'key', part_size=64) as out:
+            writer = create_record_writer(out, output_format)
+            for record in records:
+                writer.write(record)
+            writer.close()
+
+    data = b''.join(call.kwargs['Body'] for call in mock_s3.upload_part.call_args_list)
+    data += b''.join(call.kwargs['Body'] for call in mock_s3.put_object.call_args_list)
+    assert read_back(output_format, data) == records
+    assert writer.count == 5
+
+def test_kb_shard_writer_packs_whole_files_into_shards():
+    """Test KB lines are packed into size-bounded shards without splitting a file, and claims commit on close"""
+    mock_s3 = Mock()
+    index = FingerprintIndex.for_capacity(1000, 0.001, 1024 * 1024)
+    da, db, dc = (fingerprint_digest(name, 'body') for name in 'abc')
+    for digest in (da, db, dc):
+        index.claim(digest)
+    with patch('lambda_function.s3', mock_s3):
+        shards = KBShardWriter('bucket', '20250612T103000Z', next_index=3, max_bytes=1024, max_records=3,
+                               dedup_index=index)
+        shards.append_file('raw/a.json', iter([b'{"text": "a1"}\n', b'{"text": "a2"}']), 29, 2, [da])
+        shards.append_file('raw/b.json', iter([b'{"text": "b1"}\n', b'{"text": "b2"}']), 29, 2, [db])
+        assert shards.take_durable() == ['raw/a.json'] and da in index and db not in index
+        shards.close()
+        assert shards.take_durable() == ['raw/b.json'] and db in index
+
+        def broken():
+            yield b'{"text": "c1"}'
+            raise IOError('spool read failed')
+        with pytest.raises(IOError):
+            shards.append_file('raw/c.json', broken(), 29, 2, [dc])
+
+    bodies = {call.kwargs['Key']: call.kwargs['Body'] for call in mock_s3.put_object.call_args_list}
+    assert bodies == {
+        'socialgist-kb/ready-20250612T103000Z-00003.jsonl': b'{"text": "a1"}\n{"text": "a2"}',
+        'socialgist-kb/ready-20250612T103000Z-00004.jsonl': b'{"text": "b1"}\n{"text": "b2"}'
+    }
+    assert shards.next_index == 6
+    assert shards.shards == [f's3://bucket/{key}' for key in sorted(bodies)]
+    # The failing file's own claims are still the caller's to release
+    assert shards.take_durable() == [] and index.claimed == {dc} and dc not in index
+
+def test_s3_stream_writer_small_object_uses_put():
+    """Test objects smaller than one part are written with a single put_object"""
+    mock_s3 = Mock()
+    with patch('lambda_function.s3', mock_s3):
+        with S3StreamWriter('bucket', 'key.json', part_size=100) as writer:
+            writer.write('small')
+
+    mock_s3.put_object.assert_called_once_with(Bucket='bucket', Key='key.json', Body=b'small', ContentType='application/json')
+    mock_s3.create_multipart_upload.assert_not_called()
+
+def test_s3_stream_writer_multipart_and_abort():
+    """Test large objects are uploaded in parts and failures abort the upload"""
+    mock_s3 = Mock()
+    mock_s3.create_multipart_upload.return_value = {'UploadId': 'u1'}
+    mock_s3.upload_part.side_effect = lambda **kwargs: {'ETag': f"e{kwargs['PartNumber']}"}
+    with patch('lambda_function.s3', mock_s3):
+        with S3StreamWriter('bucket', 'key.json', part_size=4) as writer:
+            writer.write('abcdef')
+            writer.write('gh')
+            writer.write('i')
+
+        bodies = [call.kwargs['Body'] for call in mock_s3.upload_part.call_args_list]
+        assert bodies == [b'abcdef', b'ghi']
+        mock_s3.complete_multipart_upload.assert_called_once_with(
+            Bucket='bucket', Key='key.json', UploadId='u1',
+            MultipartUpload={'Parts': [{'ETag': 'e1', 'PartNumber': 1}, {'ETag': 'e2', 'PartNumber': 2}]})
+
+        with pytest.raises(RuntimeError):
+            with S3StreamWriter('bucket', 'key.json', part_size=4) as writer:
+                writer.write('abcdef')
+                raise RuntimeError('parse failure')
+        mock_s3.abort_multipart_upload.assert_called_once_with(Bucket='bucket', Key='key.json', UploadId='u1')
+
+def test_process_single_file_writes_outputs(sample_raw_data):
+    """Test end-to-end processing of one raw file against a mocked S3"""
+    matches = sample_raw_data["response"]["Matches"]["Match"]
+    matches.append(dict(matches[0]))
+    mock_s3 = Mock()
+    mock_s3.get_object.return_value = {'Body': io.BytesIO(json.dumps(sample_raw_data).encode('utf-8'))}
+
+    with patch('lambda_function.s3', mock_s3):
+        summary = process_single_file('bucket', 'raw/sample.json')
+
+    bodies = {call.kwargs['Key']: call.kwargs['Body'] for call in mock_s3.put_object.call_args_list}
+    cleaned = json.loads(bodies['socialgist-processed/clean-sample.json'])
+    assert [r['title'] for r in cleaned] == ['Test streaming service review']
+    assert json.loads(bodies['socialgist-kb/ready-sample.jsonl'])['text'].startswith('Title: Test streaming')
+    assert summary['total_input_records'] == 2
+    assert summary['cleaned_records'] == 1
+    assert summary['duplicates_removed'] == 1
+    assert json.loads(bodies['socialgist-processed/summary-sample.json']) == summary
+
+def test_process_single_file_appends_to_kb_shards(sample_raw_data):
+    """Test sharded mode hands KB lines to the shard writer instead of a per-file ready file"""
+    mock_s3 = Mock()
+    mock_s3.get_object.return_value = {'Body': io.BytesIO(json.dumps(sample_raw_data).encode('utf-8'))}
+    kb_shards = Mock()
+    appended = []
+    kb_shards.append_file.side_effect = lambda key, lines, size, count, claimed: appended.extend(lines)
+
+    with patch('lambda_function.s3', mock_s3):
+        summary = process_single_file('bucket', 'raw/sample.json', kb_shards=kb_shards)
+
+    keys = [call.kwargs['Key'] for call in mock_s3.put_object.call_args_list]
+    assert 'socialgist-kb/ready-sample.jsonl' not in keys
+    assert len(appended) == 1 and json.loads(appended[0])['text'].startswith('Title: Test streaming')
+    assert kb_shards.append_file.call_args.args[0] == 'raw/sample.json'
+    assert summary['kb_jsonl_file'] is None and summary['kb_sharded'] is True
+
+def test_process_single_file_inline_scoring_writes_partial_aggregate(sample_raw_data):
+    """Test inline scoring writes a per-file partial aggregate next to the summary"""
+    import sentiment_scoring
+    mock_s3 = Mock()
+    mock_s3.get_object.return_value = {'Body': io.BytesIO(json.dumps(sample_raw_data).encode('utf-8'))}
+
+    with patch('lambda_function.s3', mock_s3), patch('lambda_function.INLINE_SCORING', True):
+        summary = process_single_file('bucket', 'raw/sample.json')
+
+    bodies = {call.kwargs['Key']: call.kwargs['Body'] for call in mock_s3.put_object.call_args_list}
+    partial = sentiment_scoring.deserialize_partial(bodies['socialgist-processed/aggregate-sample.bin'])
+    assert summary['partial_aggregate_file'] == 's3://bucket/socialgist-processed/aggregate-sample.bin'
+    assert partial['format_version'] == 1 and partial['records'] == summary['cleaned_records']
+    assert sum(a['total'] for a in partial['aggregates']) >= 1
+
 if __name__ == "__main__":
     pytest.main([__file__])
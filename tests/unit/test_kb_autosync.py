@@ -0,0 +1,206 @@
+"""
+Unit tests for KB auto-sync Lambda function
+"""
+import importlib.util
+import json
+import os
+import pytest
+from unittest.mock import Mock, patch
+
+# Load under a unique module name; every Lambda directory ships a lambda_function.py
+_spec = importlib.util.spec_from_file_location(
+    'kb_autosync_lambda',
+    os.path.join(os.path.dirname(__file__), '../../lambda/kb-autosync/lambda_function.py'))
+autosync = importlib.util.module_from_spec(_spec)
+with patch('boto3.client'):
+    _spec.loader.exec_module(autosync)
+
+def s3_event(*keys):
+    return {'Records': [{'s3': {'bucket': {'name': 'bucket'}, 'object': {'key': key}}, 'eventName': 'ObjectCreated:Put'}
+                        for key in keys]}
+
+@pytest.fixture
+def coalescing(tmp_path):
+    """Coalescing mode with local state, no debounce sleep and a mocked Bedrock client"""
+    bedrock = Mock()
+    bedrock.list_ingestion_jobs.return_value = {'ingestionJobSummaries': []}
+    bedrock.start_ingestion_job.return_value = {'ingestionJob': {'ingestionJobId': 'job-1'}}
+    state_path = str(tmp_path / 'state.json')
+    with patch.object(autosync, 'COALESCE_INGESTION', True), patch.object(autosync, 'STATE_PATH', state_path), \
+            patch.object(autosync, 'bedrock', bedrock), patch.object(autosync.time, 'sleep'):
+        yield bedrock, state_path
+
+def test_burst_inside_open_window_only_queues(coalescing):
+    """Events arriving while another invocation owns the window start no job"""
+    bedrock, state_path = coalescing
+    with open(state_path, 'w') as f:
+        json.dump({'window': {'owner': 'other', 'opened_at': autosync.time.time()}, 'pending_files': []}, f)
+
+    for index in range(5):
+        result = autosync.lambda_handler(s3_event(f'socialgist-kb/ready-{index}.jsonl'), None)
+        assert json.loads(result['body'])['processed_files'][0]['status'] == 'queued'
+
+    bedrock.start_ingestion_job.assert_not_called()
+    with open(state_path) as f:
+        assert len(json.load(f)['pending_files']) == 5
+
+def test_window_owner_starts_one_job_for_the_batch(coalescing):
+    """The invocation opening a window ingests everything queued during it in one job"""
+    bedrock, state_path = coalescing
+
+    def queue_more(seconds):
+        # Another burst lands while the owner waits out the window
+        autosync.lambda_handler(s3_event('socialgist-kb/ready-b.jsonl', 'socialgist-kb/ready-c.jsonl'), None)
+    with patch.object(autosync.time, 'sleep', side_effect=queue_more):
+        result = autosync.lambda_handler(s3_event('socialgist-kb/ready-a.jsonl', 'raw/ignored.json'), None)
+
+    body = json.loads(result['body'])
+    assert body['processed_files'] == [{'file': 'socialgist-kb/ready-a.jsonl', 'job_id': 'job-1',
+                                        'status': 'started', 'reason': None}]
+    assert body['skipped_files'] == ['raw/ignored.json']
+    bedrock.start_ingestion_job.assert_called_once()
+    with open(state_path) as f:
+        state = json.load(f)
+    assert state['window'] is None and state['pending_files'] == []
+    assert state['last_job']['job_id'] == 'job-1' and state['last_job']['files'] == 3
+
+class ConditionalS3:
+    """In-memory S3 object honouring IfMatch / IfNoneMatch, with a hook run before each put"""
+    def __init__(self):
+        self.body, self.version, self.before_put = None, 0, None
+
+    def get_object(self, Bucket, Key):
+        from botocore.exceptions import ClientError
+        if self.body is None:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'missing'}}, 'GetObject')
+        return {'Body': Mock(read=Mock(return_value=self.body)), 'ETag': f'"{self.version}"'}
+
+    def put_object(self, Bucket, Key, Body, ContentType, IfMatch=None, IfNoneMatch=None):
+        from botocore.exceptions import ClientError
+        if self.before_put:
+            hook, self.before_put = self.before_put, None
+            hook()
+        exists = self.body is not None
+        if (IfNoneMatch == '*' and exists) or (IfMatch is not None and IfMatch != f'"{self.version}"'):
+            raise ClientError({'Error': {'Code': 'PreconditionFailed', 'Message': 'changed'}}, 'PutObject')
+        self.body, self.version = Body.encode(), self.version + 1
+
+def test_state_updates_retry_instead_of_losing_concurrent_writes():
+    """A conditional write that loses re-reads, so neither a queued key nor the window owner is overwritten"""
+    store = ConditionalS3()
+    with patch.object(autosync, 's3', store), patch.object(autosync, 'STATE_PATH', None), \
+            patch.object(autosync.time, 'sleep'):
+        assert autosync.update_ingestion_state(
+            lambda state: state.update(window={'owner': 'first', 'opened_at': autosync.time.time()})) is None
+        # Another invocation queues a key between this read and write
+        store.before_put = lambda: autosync.update_ingestion_state(
+            lambda state: autosync.add_pending_files(state, ['socialgist-kb/ready-b.jsonl']))
+        result = autosync.coalesce_ingestion(['socialgist-kb/ready-a.jsonl'])
+        state = autosync.load_ingestion_state()
+
+    assert result['status'] == 'queued' and result['window_owner'] == 'first'
+    assert state['window']['owner'] == 'first'
+    assert state['pending_files'] == ['socialgist-kb/ready-b.jsonl', 'socialgist-kb/ready-a.jsonl']
+
+def test_handler_raises_when_state_writes_keep_conflicting(coalescing):
+    """A state update that never wins fails the invocation so Lambda retries the event"""
+    store = ConditionalS3()
+    store.put_object = Mock(side_effect=autosync.ClientError(
+        {'Error': {'Code': 'PreconditionFailed', 'Message': 'changed'}}, 'PutObject'))
+    with patch.object(autosync, 's3', store), patch.object(autosync, 'STATE_PATH', None), \
+            patch.object(autosync, 'STATE_WRITE_RETRIES', 3):
+        with pytest.raises(autosync.StateConflict):
+            autosync.lambda_handler(s3_event('socialgist-kb/ready-a.jsonl'), None)
+    assert store.put_object.call_count == 3
+
+def test_tracking_sweep_keeps_concurrent_updates():
+    """A sweep racing another writer neither drops completed jobs nor resurrects started keys"""
+    from datetime import datetime
+    store = ConditionalS3()
+    bedrock = Mock()
+    bedrock.list_ingestion_jobs.return_value = {'ingestionJobSummaries': []}
+    bedrock.get_ingestion_job.return_value = {'ingestionJob': {
+        'status': 'COMPLETE', 'startedAt': datetime(2025, 1, 1), 'updatedAt': datetime(2025, 1, 1, 0, 1)}}
+    bedrock.start_ingestion_job.return_value = {'ingestionJob': {'ingestionJobId': 'job-2'}}
+    with patch.object(autosync, 's3', store), patch.object(autosync, 'STATE_PATH', None), \
+            patch.object(autosync, 'bedrock', bedrock), patch.object(autosync.time, 'sleep'):
+        autosync.update_ingestion_state(lambda state: state['tracked_jobs'].append(
+            {'job_id': 'job-1', 'files': 1, 'queued_at': 0, 'started_at': 0, 'polls': 0, 'next_poll_at': 0}))
+        store.before_put = lambda: autosync.update_ingestion_state(
+            lambda state: autosync.add_pending_files(state, ['socialgist-kb/ready-b.jsonl']))
+        result = autosync.track_ingestion(['socialgist-kb/ready-a.jsonl'])
+        state = autosync.load_ingestion_state()
+
+    assert result['status'] == 'started' and result['job_id'] == 'job-2'
+    assert [job['job_id'] for job in state['completed_jobs']] == ['job-1']
+    assert [job['job_id'] for job in state['tracked_jobs']] == ['job-2']
+    assert state['tracked_jobs'][0]['files'] == 2 and state['pending_files'] == []
+
+def test_local_state_is_replaced_atomically(tmp_path):
+    """STATE_PATH saves go through a temp file, leaving only the state and its lock behind"""
+    state_path = tmp_path / 'state.json'
+    with patch.object(autosync, 'STATE_PATH', str(state_path)):
+        autosync.update_ingestion_state(lambda state: autosync.add_pending_files(state, ['socialgist-kb/a.jsonl']))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['state.json', 'state.json.lock']
+    assert json.loads(state_path.read_text())['pending_files'] == ['socialgist-kb/a.jsonl']
+
+def test_failed_batch_stays_pending_for_the_sweep(coalescing):
+    """A batch whose job cannot start stays queued and the scheduled sweep starts it"""
+    from botocore.exceptions import ClientError
+    bedrock, state_path = coalescing
+    bedrock.start_ingestion_job.side_effect = [
+        ClientError({'Error': {'Code': 'ConflictException', 'Message': 'busy'}}, 'StartIngestionJob')] * 3 + [
+        {'ingestionJob': {'ingestionJobId': 'job-2'}}]
+    clock = [1000.0]
+    with patch.object(autosync.time, 'time', lambda: clock[0]):
+        result = autosync.lambda_handler(s3_event('socialgist-kb/ready-a.jsonl'), None)
+        assert json.loads(result['body'])['processed_files'][0]['status'] == 'failed'
+        state = autosync.load_ingestion_state()
+        assert state['window'] is None and state['pending_files'] == ['socialgist-kb/ready-a.jsonl']
+
+        clock[0] += autosync.POLL_BASE_SECONDS
+        result = json.loads(autosync.lambda_handler({'sweep': True}, None)['body'])['result']
+
+    assert result['status'] == 'started' and result['pending_files'] == 0
+
+def test_async_tracking_never_sleeps_and_records_duration(tmp_path):
+    """Async mode starts and polls jobs across invocations with backoff, recording durations"""
+    from datetime import datetime
+    from botocore.exceptions import ClientError
+    bedrock = Mock()
+    bedrock.list_ingestion_jobs.return_value = {'ingestionJobSummaries': []}
+    bedrock.start_ingestion_job.side_effect = [
+        ClientError({'Error': {'Code': 'ConflictException', 'Message': 'busy'}}, 'StartIngestionJob'),
+        {'ingestionJob': {'ingestionJobId': 'job-1'}}]
+    bedrock.get_ingestion_job.side_effect = [
+        {'ingestionJob': {'status': 'IN_PROGRESS'}},
+        {'ingestionJob': {'status': 'COMPLETE', 'startedAt': datetime(2025, 1, 1, 0, 0, 0),
+                          'updatedAt': datetime(2025, 1, 1, 0, 2, 30)}}]
+    clock = [1000.0]
+    sleep = Mock()
+    with patch.object(autosync, 'ASYNC_JOB_TRACKING', True), patch.object(autosync, 'STATE_PATH', str(tmp_path / 's.json')), \
+            patch.object(autosync, 'bedrock', bedrock), patch.object(autosync.time, 'sleep', sleep), \
+            patch.object(autosync.time, 'time', lambda: clock[0]):
+        result = autosync.lambda_handler(s3_event('socialgist-kb/ready-a.jsonl'), None)
+        assert json.loads(result['body'])['processed_files'][0]['status'] == 'pending'
+
+        autosync.lambda_handler({'sweep': True}, None)  # backoff not elapsed yet
+        assert bedrock.start_ingestion_job.call_count == 1
+        clock[0] += autosync.POLL_BASE_SECONDS
+        autosync.lambda_handler(s3_event('socialgist-kb/ready-b.jsonl'), None)
+        assert bedrock.start_ingestion_job.call_count == 2
+
+        for _ in range(2):
+            clock[0] += autosync.POLL_MAX_SECONDS
+            autosync.lambda_handler({'source': 'aws.events'}, None)
+        state = autosync.load_ingestion_state()
+
+    sleep.assert_not_called()
+    assert state['tracked_jobs'] == [] and state['pending_files'] == []
+    [completed] = state['completed_jobs']
+    assert completed['job_id'] == 'job-1' and completed['files'] == 2
+    assert completed['duration_seconds'] == 150.0
+    assert completed['latency_seconds'] == autosync.POLL_BASE_SECONDS + 2 * autosync.POLL_MAX_SECONDS
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,657 @@
+"""
+Unit tests for sentiment analyzer Lambda function
+"""
+import importlib.util
+import json
+import os
+import threading
+import time
+import pytest
+from unittest.mock import Mock, patch
+
+from botocore.exceptions import ClientError
+
+# Load under a unique module name; every Lambda directory ships a lambda_function.py
+_spec = importlib.util.spec_from_file_location(
+    'sentiment_analyzer_lambda',
+    os.path.join(os.path.dirname(__file__), '../../lambda/sentiment-analyzer/lambda_function.py'))
+analyzer = importlib.util.module_from_spec(_spec)
+with patch('boto3.client'):
+    _spec.loader.exec_module(analyzer)
+import sentiment_scoring  # noqa: E402  (lambda/shared is on sys.path once the analyzer is loaded)
+
+def test_keyword_matcher_matches_substring_semantics():
+    """Compiled matcher scores like the per-keyword ``in`` loop, overlaps included"""
+    texts = [
+        "i dislike the buffering but love the shows",
+        "absolutely LOVE it, love love love",
+        "the waste of money is slowly getting better",
+        "nothing to see here",
+    ]
+    for backend in (sentiment_scoring.ahocorasick, None):
+        with patch.object(sentiment_scoring, 'ahocorasick', backend):
+            matcher = sentiment_scoring.KeywordMatcher(sentiment_scoring.SENTIMENT_KEYWORDS)
+        for text in texts:
+            text_lower = text.lower()
+            expected = [
+                sum(w for k, w in sentiment_scoring.SENTIMENT_KEYWORDS['positive'].items() if k in text_lower),
+                sum(w for k, w in sentiment_scoring.SENTIMENT_KEYWORDS['negative'].items() if k in text_lower),
+            ]
+            assert matcher.score(text_lower) == expected
+
+    # 'like' inside 'dislike' still counts, and repeats count once
+    matcher = sentiment_scoring.KeywordMatcher(sentiment_scoring.SENTIMENT_KEYWORDS)
+    assert matcher.find("i dislike it") == {'dislike', 'like'}
+    assert matcher.score("love love love") == [2, 0]
+
+    # The regex fallback finds prefixes, infixes and keywords overlapping a longer match
+    with patch.object(sentiment_scoring, 'ahocorasick', None):
+        matcher = sentiment_scoring.KeywordMatcher({'t': dict.fromkeys(['ab', 'abc', 'b', 'bcd', 'cd'], 1)})
+    assert matcher.find("xabcdx") == {'ab', 'abc', 'b', 'bcd', 'cd'}
+    assert matcher.find("xacx") == set()
+
+def test_analyze_text_single_pass():
+    """One scan yields properties, sentiment scores and themes"""
+    record = analyzer.analyze_text("Love the Live Sports on the mobile app, but buffering is terrible")
+    assert record.properties == ('Sports Streaming', 'Mobile Streaming')
+    assert record.positive_score == 2
+    assert record.negative_score == 3.5
+    assert record.themes == ('technical performance', 'device compatibility')
+
+    # General Streaming only applies when no specific property matched
+    assert analyzer.analyze_text("my video platform is great").properties == ('General Streaming',)
+    assert analyzer.analyze_text("nothing relevant").properties == ()
+
+def test_feedback_scoring_reuses_records_and_applies_threshold():
+    """Every group shares the same per-text record and the threshold still applies"""
+    feedback = [{'content': "live sports on the mobile app are great"} for _ in range(3)]
+    feedback.append({'content': "free streaming is fine"})
+    groups, matched, count = analyzer.group_feedback_texts(item['content'] for item in feedback)
+    assert groups['Sports Streaming'][0] is groups['Mobile Streaming'][0]
+    assert (matched, count) == (4, 4)
+    results = analyzer.results_from_aggregates(analyzer.score_feedback_aggregates(feedback), min_mentions_threshold=2)
+    assert [r['topic'] for r in results] == ['Sports Streaming', 'Mobile Streaming']
+    assert results[0]['positive_count'] == 3
+
+def test_grouping_helpers_wrap_the_fused_path():
+    """The grouping and theme helpers give the same results as the aggregate path"""
+    feedback = [{'content': "live sports on the mobile app are great"} for _ in range(3)]
+    feedback.append({'content': "free streaming is fine, no ads"})
+    groups = analyzer.group_by_streaming_properties(feedback, min_mentions_threshold=2)
+    assert list(groups) == ['Sports Streaming', 'Mobile Streaming']
+    results = [analyzer.analyze_streaming_property_sentiment(name, records) for name, records in groups.items()]
+    expected = analyzer.results_from_aggregates(analyzer.score_feedback_aggregates(feedback), min_mentions_threshold=2)
+    for result in results + expected:
+        result.pop('processed_at')
+    assert results == expected
+    assert analyzer.extract_themes_from_text("buffering again, and the ads") == ['technical performance', 'advertising']
+
+    records = analyzer.get_streaming_feedback_data(_paged_client(), _retrieve_config())
+    streamed = analyzer.iter_streaming_feedback(_paged_client(), _retrieve_config())
+    assert [r['content_digest'] for r in records] == [r['content_digest'] for r in streamed]
+
+def test_analyze_property_sentiment():
+    """Property analysis classifies each text and reports counts"""
+    result = analyzer.analyze_streaming_property_sentiment('Netflix', [
+        "love the new season, amazing",
+        "terrible buffering, crashes constantly",
+        "excellent content and great value",
+        "it exists",
+    ])
+    assert result['topic'] == 'Netflix'
+    assert result['positive_count'] == 2
+    assert result['negative_count'] == 1
+    assert result['neutral_count'] == 1
+    assert result['total_mentions'] == 4
+
+def test_matrix_engine_matches_record_path():
+    """Hit-matrix batch engine produces the same per-property results"""
+    pytest.importorskip('scipy')
+    feedback = [{'content': text} for text in [
+        "Love the live sports, great value for the price",
+        "Live sports keep buffering, terrible and slow",
+        "live sports on the mobile app are okay",
+        "The mobile app crashes, worst app, cancel",
+        "mobile app library and variety are excellent",
+        "my video platform is decent but the ads are annoying",
+        "the video platform has commercials",
+        "video platform: good recommendations",
+        "nothing relevant here",
+    ]]
+    expected = analyzer.results_from_aggregates(analyzer.score_feedback_aggregates(feedback, 'records'), 3)
+    actual = analyzer.results_from_aggregates(analyzer.score_feedback_aggregates(feedback, 'matrix'), 3)
+
+    for result in expected + actual:
+        result.pop('processed_at')
+    assert [r['topic'] for r in actual] == ['Sports Streaming', 'Mobile Streaming', 'General Streaming']
+    assert actual == expected
+
+def test_parallel_scoring_matches_serial():
+    """Chunked worker-process scoring merges to the serial aggregates"""
+    texts = ["Love the live sports, great value", "Live sports keep buffering, terrible",
+             "The mobile app crashes, worst app", "mobile app library is excellent",
+             "the video platform has commercials", "nothing relevant here"] * 7
+    feedback = [{'content': text} for text in texts]
+    engines = ['records'] + (['matrix'] if analyzer.sparse is not None else [])
+    strip = lambda aggs: [{k: v for k, v in a.items() if k != 'confidence_sum'} for a in aggs]
+    for engine in engines:
+        serial = analyzer.score_feedback_aggregates(feedback, engine)
+        started = []
+        start_workers = analyzer.start_scoring_workers
+        with patch.object(analyzer, 'start_scoring_workers', lambda *args: started.extend(start_workers(*args)) or started):
+            parallel = analyzer.score_feedback_aggregates(iter(feedback), engine, workers=2, chunk_size=5)
+        assert len(started) == 2 and not any(process.is_alive() for process, _ in started)
+        assert strip(parallel) == strip(serial)
+        for p, s in zip(parallel, serial):
+            assert p['confidence_sum'] == pytest.approx(s['confidence_sum'])
+
+    # Never fork while another thread runs: scoring stays in-process and gives the same result
+    release = threading.Event()
+    busy = threading.Thread(target=release.wait)
+    busy.start()
+    try:
+        with patch.object(analyzer.multiprocessing, 'get_context') as get_context:
+            fallback = analyzer.score_feedback_aggregates(iter(feedback), 'records', workers=2, chunk_size=5)
+    finally:
+        release.set()
+        busy.join()
+    get_context.assert_not_called()
+    assert strip(fallback) == strip(analyzer.score_feedback_aggregates(feedback, 'records'))
+
+def test_handler_forks_workers_on_warm_container_and_reports_fallback():
+    """Retrieval threads are gone after each run, so a repeat run still forks; a fallback is reported"""
+    env = {'ANALYSIS_WORKERS': '2', 'ANALYSIS_CHUNK_SIZE': '5', 'RETRIEVE_CACHE_SIZE': '0'}
+
+    def run():
+        with patch.dict(os.environ, env), patch.object(analyzer, 'create_bedrock_agent_client', return_value=client), \
+                patch.object(analyzer.boto3, 'client'):
+            return json.loads(analyzer.lambda_handler({}, None)['body'])
+
+    client = _paged_client(pages_per_term=2)
+    for _ in range(2):
+        body = run()
+        assert body['scoring_workers'] == {'requested': 2, 'started': 2, 'fallback': None}
+        assert threading.active_count() == 1
+
+    release = threading.Event()
+    busy = threading.Thread(target=release.wait)
+    busy.start()
+    try:
+        body = run()
+    finally:
+        release.set()
+        busy.join()
+    assert body['scoring_workers']['started'] == 0
+    assert 'other threads running' in body['scoring_workers']['fallback']
+    assert body['total_feedback_entries'] > 0
+
+def test_iter_source_feedback_reads_cleaned_files(tmp_path):
+    """Batch source decodes clean-*.json and ready-*.jsonl(.gz), in order, deduplicated"""
+    import gzip
+    (tmp_path / 'socialgist-processed').mkdir()
+    (tmp_path / 'socialgist-processed' / 'clean-a.json').write_text(json.dumps([
+        {'title': 'Live sports', 'body': 'great value', 'source_file': 'a', 'processed_at': 'x'},
+        {'title': 'Mobile app', 'body': 'crashes', 'source_file': 'a', 'processed_at': 'x'}]))
+    (tmp_path / 'ready-b.jsonl.gz').write_bytes(gzip.compress(
+        b'{"text": "Title: Live sports\\nBody: great value"}\n{"text": "Title: Ads\\nBody: too many"}'))
+    (tmp_path / 'summary-a.json').write_text('{}')
+    config = {'source_path': str(tmp_path), 'source_concurrency': 2, 'source_prefetch_bytes': 1024 * 1024}
+    stats = {}
+
+    records = list(analyzer.iter_source_feedback(None, config, stats))
+
+    assert [r['content'] for r in records] == [
+        "Title: Live sports\nBody: great value", "Title: Ads\nBody: too many", "Title: Mobile app\nBody: crashes"]
+    assert stats == {'source_files': 2, 'failed_files': 0, 'retrieved': 4, 'unique': 3}
+
+def test_source_prefetch_is_bounded_by_bytes(tmp_path):
+    """Prefetched bytes stay within the budget; a file over it is streamed from its source instead"""
+    import zstandard
+    small = [{'title': f'Live sports {i}', 'body': 'great value'} for i in range(20)]
+    for index in range(4):
+        (tmp_path / f'clean-{index}.json').write_text(json.dumps(small[index * 5:index * 5 + 5]))
+    big = b'\n'.join(json.dumps({'title': f'Mobile app {i}', 'body': 'crashes'}).encode('utf-8') for i in range(2000))
+    (tmp_path / 'clean-9.jsonl.zst').write_bytes(zstandard.ZstdCompressor().compress(big))
+    files = analyzer.list_source_files(None, {'source_path': str(tmp_path)})
+    budget = files[0].size * 2 + 1
+    config = {'source_path': str(tmp_path), 'source_concurrency': 8, 'source_prefetch_bytes': budget}
+    assert files[-1].size > budget
+
+    lock = threading.Lock()
+    in_flight = {'bytes': 0, 'peak': 0, 'read': []}
+    read_file = analyzer.read_source_file
+    def tracked_read(s3_client, config, name):
+        with lock:
+            in_flight['read'].append(name)
+            in_flight['bytes'] += os.path.getsize(name)
+            in_flight['peak'] = max(in_flight['peak'], in_flight['bytes'])
+        return read_file(s3_client, config, name)
+    with patch.object(analyzer, 'read_source_file', tracked_read):
+        for name, stream, error in analyzer.iter_source_streams(None, config, files):
+            if name.endswith('.json'):
+                with lock:
+                    in_flight['bytes'] -= os.path.getsize(name)
+    assert in_flight['peak'] <= budget
+    assert len(in_flight['read']) == 4 and files[-1].name not in in_flight['read']
+
+    stats = {}
+    records = list(analyzer.iter_source_feedback(None, config, stats))
+    assert stats == {'source_files': 5, 'failed_files': 0, 'retrieved': 2020, 'unique': 2020}
+    assert records[-1]['content'] == "Title: Mobile app 1999\nBody: crashes"
+
+def test_partial_aggregates_merge_to_serial_result(tmp_path):
+    """Per-file partials merge to the single-pass aggregates; rewritten files replace their contribution"""
+    def write_partial(index, texts):
+        aggregator = sentiment_scoring.StreamingAggregator()
+        for text in texts:
+            aggregator.add(text)
+        path = tmp_path / f'aggregate-{index}.json'
+        path.write_text(json.dumps(aggregator.to_partial(f'raw/{index}.json')))
+        os.utime(path, ns=(index, index + len(texts)))
+
+    files = [["Love the live sports, great value", "The mobile app crashes, worst app"],
+             ["Live sports keep buffering, terrible", "nothing relevant here"]]
+    for index, texts in enumerate(files):
+        write_partial(index, texts)
+    config = {'source_path': str(tmp_path), 'source_concurrency': 2, 'source_prefetch_bytes': 1024 * 1024,
+              'aggregate_prefixes': []}
+    folded, stats = {}, {}
+
+    merged, retractions = analyzer.load_partial_aggregates(None, config, stats, set(), folded, '2024-01-01')
+    expected, _, _ = analyzer.aggregate_feedback_texts([text for texts in files for text in texts])
+
+    assert merged == expected and retractions == []
+    assert stats['unique'] == 4
+    assert analyzer.load_partial_aggregates(None, config, stats, set(), folded, '2024-01-02') == ([], [])
+    assert stats['retrieved'] == 4 and stats['source_files'] == 0
+
+    # A rewritten file is read again and its earlier contribution handed back for retraction
+    write_partial(1, ["Live sports are excellent"])
+    merged, retractions = analyzer.load_partial_aggregates(None, config, stats, set(), folded, '2024-01-03')
+    assert [date for date, _, _ in retractions] == ['2024-01-01']
+    assert stats['unique'] == -1
+    cumulative = analyzer.subtract_property_aggregates(expected, retractions[0][1])
+    cumulative = analyzer.merge_property_aggregates(cumulative, merged)
+    rewritten, _, _ = analyzer.aggregate_feedback_texts(files[0] + ["Live sports are excellent"])
+    assert sorted(cumulative, key=lambda a: a['property']) == sorted(rewritten, key=lambda a: a['property'])
+
+    # Files folded under the old name-digest scheme are adopted, not counted twice
+    legacy = {analyzer.content_digest(f"partial-aggregate:{tmp_path / 'aggregate-0.json'}")}
+    folded = {}
+    merged, _ = analyzer.load_partial_aggregates(None, config, stats, legacy, folded, '2024-01-04')
+    assert folded[str(tmp_path / 'aggregate-0.json')]['date'] is None
+    assert stats['unique'] == 1
+
+def test_partial_merge_is_associative_and_round_trips():
+    """Binary round trip is lossless and any grouping of merges gives the same partial"""
+    texts = ["Love the live sports, great value", "The mobile app crashes, worst app, too expensive",
+             "Live sports keep buffering, terrible", "mobile app library is excellent", "nothing relevant"]
+    a, b, c = (analyzer.score_texts_partial(chunk) for chunk in (texts[:2], texts[2:4], texts[4:]))
+
+    assert analyzer.deserialize_partial(analyzer.serialize_partial(a)) == a
+    left = analyzer.merge_partials(analyzer.merge_partials(a, b), c)
+    right = analyzer.merge_partials(a, analyzer.merge_partials(b, c))
+    assert left == right
+    assert left['aggregates'] == analyzer.score_texts_partial(texts)['aggregates']
+    with pytest.raises(ValueError):
+        analyzer.deserialize_partial(b'JSON' + analyzer.serialize_partial(a)[4:])
+
+def _retrieve_config(**overrides):
+    config = {'knowledge_base_id': 'kb', 'max_results_per_search': 5, 'retrieve_concurrency': 4,
+              'retrieve_timeout': 1, 'retrieve_max_retries': 2, 'retrieve_buffer_pages': 2,
+              'term_budgets': {'high': 12, 'medium': 7, 'low': 3}, 'max_total_documents': 10000}
+    config.update(overrides)
+    return config
+
+def test_iter_streaming_feedback_concurrent_and_ordered():
+    """Search terms run concurrently up to the limit; results merge in term order"""
+    lock = threading.Lock()
+    state = {'active': 0, 'peak': 0}
+
+    def retrieve(**kwargs):
+        with lock:
+            state['active'] += 1
+            state['peak'] = max(state['peak'], state['active'])
+        time.sleep(0.01)
+        with lock:
+            state['active'] -= 1
+        term = kwargs['retrievalQuery']['text']
+        if term == 'app crashes':
+            raise ClientError({'Error': {'Code': 'AccessDeniedException', 'Message': 'no'}}, 'Retrieve')
+        return {'retrievalResults': [{'content': {'text': f"about {term}"}, 'score': 0.5}]}
+
+    client = Mock()
+    client.retrieve.side_effect = retrieve
+    data = list(analyzer.iter_streaming_feedback(client, _retrieve_config()))
+
+    expected_terms = [t for t in analyzer.STREAMING_SEARCH_TERMS if t != 'app crashes']
+    assert [item['search_term'] for item in data] == expected_terms
+    assert 1 < state['peak'] <= 4
+    assert client.retrieve.call_count == len(analyzer.STREAMING_SEARCH_TERMS)
+
+def test_retrieve_search_term_retries_throttling():
+    """Throttles back off and retry; other errors fail immediately"""
+    throttle = ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'slow down'}}, 'Retrieve')
+    client = Mock()
+    client.retrieve.side_effect = [throttle, throttle, {'retrievalResults': [{'content': {'text': 'ok'}}]}]
+    backoff = analyzer.AdaptiveBackoff(base_delay=0.001, max_delay=0.004)
+    with patch.object(analyzer.time, 'sleep') as sleep:
+        results, next_token = analyzer.retrieve_search_term(client, _retrieve_config(), 'term', backoff)
+    assert results == [{'content': {'text': 'ok'}}]
+    assert next_token is None
+    assert sleep.call_count == 2
+
+    client.retrieve.side_effect = [throttle] * 3
+    with patch.object(analyzer.time, 'sleep'), pytest.raises(ClientError):
+        analyzer.retrieve_search_term(client, _retrieve_config(), 'term', backoff)
+    assert client.retrieve.call_count == 6
+
+def _paged_client(pages_per_term=10, page_delay=0):
+    """Fake retrieve that pages through unique documents per term with nextToken"""
+    def retrieve(**kwargs):
+        time.sleep(page_delay)
+        term = kwargs['retrievalQuery']['text']
+        size = kwargs['retrievalConfiguration']['vectorSearchConfiguration']['numberOfResults']
+        page = int(kwargs.get('nextToken', 0))
+        results = [{'content': {'text': f"{term} doc {page * 100 + i}"}} for i in range(size)]
+        response = {'retrievalResults': results}
+        if page + 1 < pages_per_term:
+            response['nextToken'] = str(page + 1)
+        return response
+
+    client = Mock()
+    client.retrieve.side_effect = retrieve
+    return client
+
+def test_iter_streaming_feedback_paginates_within_tier_budgets():
+    """Each term pages with nextToken until its tier budget, in term order"""
+    client = _paged_client()
+    stats = {}
+    records = list(analyzer.iter_streaming_feedback(client, _retrieve_config(), stats))
+
+    per_term = {}
+    for record in records:
+        per_term[record['search_term']] = per_term.get(record['search_term'], 0) + 1
+    budgets = _retrieve_config()['term_budgets']
+    for tier, terms in analyzer.SEARCH_TERM_TIERS.items():
+        for term in terms:
+            assert per_term[term] == budgets[tier]
+    assert list(per_term) == analyzer.STREAMING_SEARCH_TERMS
+    assert stats['successful_searches'] == len(analyzer.STREAMING_SEARCH_TERMS)
+    assert stats['unique'] == len(records)
+
+    # Pages are capped to the remaining budget: 12 = 5 + 5 + 2
+    high_term = analyzer.SEARCH_TERM_TIERS['high'][0]
+    calls = [c.kwargs for c in client.retrieve.call_args_list if c.kwargs['retrievalQuery']['text'] == high_term]
+    assert [c['retrievalConfiguration']['vectorSearchConfiguration']['numberOfResults'] for c in calls] == [5, 5, 2]
+    assert [c.get('nextToken') for c in calls] == [None, '1', '2']
+
+def test_iter_streaming_feedback_overall_budget_stops_early():
+    """The overall budget ends the stream and stops outstanding workers"""
+    client = _paged_client(page_delay=0.001)
+    stats = {}
+    records = list(analyzer.iter_streaming_feedback(client, _retrieve_config(max_total_documents=20), stats))
+    assert len(records) == 20
+    assert stats['unique'] == 20
+    assert [r['search_term'] for r in records] == [analyzer.SEARCH_TERM_TIERS['high'][0]] * 12 + \
+        [analyzer.SEARCH_TERM_TIERS['high'][1]] * 8
+
+def test_score_feedback_aggregates_consumes_generator():
+    """Scoring works on a one-shot stream of feedback items"""
+    stream = ({'content': "live sports are great"} for _ in range(3))
+    [aggregate] = analyzer.score_feedback_aggregates(stream)
+    assert aggregate['property'] == 'Sports Streaming' and aggregate['total'] == 3
+
+def test_retrieval_cache_lru_and_ttl():
+    """Entries expire after the TTL and the least recently used entry is evicted"""
+    cache = analyzer.RetrievalCache(max_entries=2, ttl_seconds=60)
+    cache.put('a', [1])
+    cache.put('b', [2])
+    assert cache.get('a') == [1]
+    cache.put('c', [3])
+    assert cache.get('b') is None
+    assert cache.get('a') == [1] and cache.get('c') == [3]
+
+    cache.put('old', [4], stored_at=time.time() - 120)
+    assert cache.get('old') is None
+    assert cache.stats() == {'hits': 3, 'misses': 2, 'entries': 1}
+
+def test_repeat_retrieval_served_from_cache(tmp_path):
+    """A second run with the same ingestion version makes no Bedrock calls and survives a cold start"""
+    config = _retrieve_config(ingestion_version='job-1', retrieve_cache_key='', s3_bucket='bucket',
+                              retrieve_cache_path=str(tmp_path / 'cache.json'))
+    cache = analyzer.RetrievalCache()
+    client = _paged_client()
+    first = list(analyzer.iter_streaming_feedback(client, config, cache=cache))
+    calls = client.retrieve.call_count
+    second = list(analyzer.iter_streaming_feedback(client, config, cache=cache))
+    assert client.retrieve.call_count == calls
+    assert [r['content'] for r in second] == [r['content'] for r in first]
+    assert cache.hits == len(analyzer.STREAMING_SEARCH_TERMS)
+
+    # Persist, then reload into a fresh cache as a cold container would
+    analyzer.save_retrieval_cache(None, cache, config)
+    cold = analyzer.RetrievalCache()
+    cold.load_state(analyzer.load_json_state(None, 'bucket', '', config['retrieve_cache_path']))
+    list(analyzer.iter_streaming_feedback(client, config, cache=cold))
+    assert client.retrieve.call_count == calls
+
+    # A new ingestion version misses
+    list(analyzer.iter_streaming_feedback(client, dict(config, ingestion_version='job-2'), cache=cold))
+    assert client.retrieve.call_count > calls
+
+def test_content_digest_is_stable_and_normalized():
+    """Digest ignores case and whitespace runs but covers the whole text"""
+    digest = analyzer.content_digest("Love  the\nNew Season")
+    assert digest == analyzer.content_digest("love the new season")
+    assert len(digest) == 16
+    assert digest.hex() == analyzer.hashlib.blake2b(b"love the new season", digest_size=16).hexdigest()
+    prefix = "x" * 600
+    assert analyzer.content_digest(prefix + " a") != analyzer.content_digest(prefix + " b")
+
+def test_merged_aggregates_match_single_pass():
+    """Scoring two batches and merging equals scoring everything at once"""
+    texts = ["love live sports", "live sports buffering is terrible", "mobile app ads are annoying",
+             "live sports price is fine", "mobile app is great value", "live sports on the mobile app"]
+    first = analyzer.score_feedback_aggregates({'content': t} for t in texts[:3])
+    second = analyzer.score_feedback_aggregates({'content': t} for t in texts[3:])
+    merged = analyzer.merge_property_aggregates(first, second)
+    expected = analyzer.score_feedback_aggregates({'content': t} for t in texts)
+    assert merged == expected
+
+def test_incremental_handler_scores_only_new_documents(tmp_path):
+    """Second incremental run skips seen documents and reproduces the same results from stored aggregates"""
+    env = {'INCREMENTAL_ANALYSIS': 'true', 'ANALYZER_STATE_PATH': str(tmp_path / 'state.json'),
+           'RETRIEVE_CACHE_SIZE': '0', 'MAX_TOTAL_DOCUMENTS': '100000'}
+
+    def run():
+        with patch.dict(os.environ, env), patch.object(analyzer, 'create_bedrock_agent_client', return_value=client), \
+                patch.object(analyzer.boto3, 'client') as s3_factory:
+            response = analyzer.lambda_handler({}, None)
+        output = json.loads(s3_factory.return_value.put_object.call_args_list[0].kwargs['Body'])
+        for result in output['results']:
+            result.pop('processed_at')
+        return json.loads(response['body']), output['results']
+
+    client = _paged_client(pages_per_term=2)
+    first_body, first_results = run()
+    second_body, second_results = run()
+    assert first_body['total_feedback_entries'] > 0
+    assert second_body['total_feedback_entries'] == 0
+    assert second_results == first_results
+
+    # New documents are scored once and merged: counts match a full non-incremental run
+    client = _paged_client(pages_per_term=3)
+    third_body, third_results = run()
+    env['INCREMENTAL_ANALYSIS'] = 'false'
+    _, full_results = run()
+    assert 0 < third_body['total_feedback_entries'] < first_body['total_feedback_entries']
+    counts = lambda results: {r['topic']: (r['positive_count'], r['negative_count'], r['total_mentions']) for r in results}
+    assert counts(third_results) == counts(full_results)
+
+def test_retrieval_cache_needs_ingestion_version():
+    """Without a data source the cache is off by default, and an unreadable ingestion version disables it"""
+    def cache_used(env, version):
+        client = _paged_client(pages_per_term=1)
+        with patch.dict(os.environ, env), patch.object(analyzer, 'RETRIEVAL_CACHE', None), \
+                patch.object(analyzer, 'create_bedrock_agent_client', return_value=client), \
+                patch.object(analyzer, 'get_ingestion_version', return_value=version) as get_version, \
+                patch.object(analyzer.boto3, 'client'), patch.object(analyzer, 'iter_streaming_feedback',
+                                                                   return_value=iter([])) as stream:
+            analyzer.lambda_handler({}, None)
+        return get_version.called, stream.call_args.args[3] is not None
+
+    with patch.dict(os.environ):
+        os.environ.pop('DATA_SOURCE_ID', None)
+        os.environ.pop('RETRIEVE_CACHE_SIZE', None)
+        assert cache_used({}, 'job-1') == (False, False)
+        assert cache_used({'DATA_SOURCE_ID': 'ds'}, None) == (True, False)
+        assert cache_used({'DATA_SOURCE_ID': 'ds'}, 'job-1') == (True, True)
+
+def test_fold_daily_aggregates_keeps_dates_and_cumulative_totals():
+    """Runs fold into their analysis date; cumulative totals span every date"""
+    day_one = analyzer.score_feedback_aggregates({'content': t} for t in ["love live sports", "live sports is bad"])
+    day_two = analyzer.score_feedback_aggregates({'content': t} for t in ["live sports is fine", "mobile app okay"])
+    daily, cumulative = analyzer.fold_daily_aggregates({}, '2026-01-01', day_one)
+    daily, cumulative = analyzer.fold_daily_aggregates(daily, '2026-01-02', day_two)
+    daily, cumulative = analyzer.fold_daily_aggregates(daily, '2026-01-02', day_two)
+
+    assert sorted(daily) == ['2026-01-01', '2026-01-02']
+    sports = {a['property']: a for a in cumulative}['Sports Streaming']
+    assert (sports['positive'], sports['negative'], sports['neutral'], sports['total']) == (3, 1, 0, 4)
+
+    rows = analyzer.build_daily_rows(daily)
+    assert [(r['analysis_date'], r['property_name'], r['total_mentions']) for r in rows] == [
+        ('2026-01-01', 'Sports Streaming', 2),
+        ('2026-01-02', 'Sports Streaming', 2),
+        ('2026-01-02', 'Mobile Streaming', 2),
+    ]
+
+def test_load_incremental_state_migrates_v1(tmp_path):
+    """A v1 cumulative state is filed under the date it was written and its digests move into the Bloom filter"""
+    path = tmp_path / 'state.json'
+    aggregate = {'property': 'Sports Streaming', 'positive': 2, 'negative': 1, 'total': 4,
+                 'confidence_sum': 1.5, 'theme_mentions': {}}
+    digests = [analyzer.content_digest(f"doc {i}") for i in range(4)]
+    path.write_text(json.dumps({'version': 1, 'updated_at': '2026-03-04T10:00:00', 'documents': 4,
+                                'seen_digests': analyzer.base64.b64encode(b''.join(digests)).decode('ascii'),
+                                'aggregates': [aggregate]}))
+    config = {'s3_bucket': 'b', 'state_key': '', 'state_path': str(path), 'seen_capacity': 1000,
+              'seen_false_positive_rate': 0.001, 'seen_max_bytes': 1024 * 1024}
+    state = analyzer.load_incremental_state(None, config)
+    assert list(state['daily_aggregates']) == ['2026-03-04']
+    assert state['daily_aggregates']['2026-03-04'][0]['neutral'] == 1
+    assert all(digest in state['seen_digests'] for digest in digests)
+
+    # The filter keeps a fixed size however many documents it holds
+    size = len(state['seen_digests'].to_bytes())
+    state['seen_digests'].add_all(analyzer.content_digest(f"new {i}") for i in range(500))
+    analyzer.save_incremental_state(None, config, state['seen_digests'], state['daily_aggregates'], 504)
+    reloaded = analyzer.load_incremental_state(None, config)
+    assert len(reloaded['seen_digests'].to_bytes()) == size and reloaded['seen_digests'].count == 504
+    assert analyzer.content_digest("new 7") in reloaded['seen_digests']
+
+def test_trend_buckets():
+    """Hour/day/week bucket ids and the last-N range"""
+    ts = analyzer.datetime.datetime(2026, 10, 15, 13, 45)  # a Thursday
+    assert analyzer.trend_bucket_id(analyzer.trend_bucket_start(ts, 'hour'), 'hour') == '2026-10-15T13'
+    assert analyzer.trend_bucket_id(analyzer.trend_bucket_start(ts, 'week'), 'week') == '2026-10-12'
+    assert analyzer.last_trend_buckets(ts, 'day', 3) == ['2026-10-13', '2026-10-14', '2026-10-15']
+    assert analyzer.last_trend_buckets(ts, 'hour', 2) == ['2026-10-15T12', '2026-10-15T13']
+
+def test_trend_series_append_and_range_query(tmp_path):
+    """Runs append to their bucket; a range query merges runs per bucket and derives rolling values and deltas"""
+    config = {'trend_path': str(tmp_path), 'trend_prefix': '', 'trend_granularities': ['day'],
+              's3_bucket': 'b', 'retrieve_concurrency': 4, 'trend_compact_grace': 900}
+    day = analyzer.datetime.datetime(2026, 10, 15, 9)
+    runs = [
+        (day - analyzer.datetime.timedelta(days=1), ["live sports are great", "live sports are bad"]),
+        (day, ["live sports are great", "live sports love"]),
+        (day.replace(hour=17), ["live sports are terrible", "live sports are great"]),
+    ]
+    for i, (timestamp, texts) in enumerate(runs):
+        aggregates = analyzer.score_feedback_aggregates({'content': t} for t in texts)
+        analyzer.append_trend_run(None, config, timestamp, f"run-{i}", aggregates, len(texts))
+
+    assert len(os.listdir(tmp_path / 'day' / '2026-10-15')) == 2
+    series = analyzer.load_trend_series(None, config, 'day', day, 3)
+    assert [bucket for bucket, _ in series] == ['2026-10-13', '2026-10-14', '2026-10-15']
+    assert series[0][1] == [] and series[2][1][0]['total'] == 4
+
+    rows = analyzer.build_trend_series_rows(series, rolling_window=2)
+    assert [(r['bucket'], r['total_mentions'], r['positive_percentage']) for r in rows] == [
+        ('2026-10-13', 0, 0), ('2026-10-14', 2, 50.0), ('2026-10-15', 4, 75.0)]
+    assert rows[2]['delta_mentions'] == 2
+    assert rows[2]['delta_positive_percentage'] == 25.0
+    assert rows[2]['rolling_total_mentions'] == 6
+    assert rows[2]['rolling_positive_percentage'] == 66.7
+
+    # Closed buckets were compacted; later queries read only the compacted object and the open bucket's runs
+    assert json.loads((tmp_path / 'day' / '2026-10-14' / '_compacted.json').read_text())['runs'] == 1
+    assert not (tmp_path / 'day' / '2026-10-15' / '_compacted.json').exists()
+    with patch.object(analyzer, 'load_trend_runs', wraps=analyzer.load_trend_runs) as load_runs:
+        assert analyzer.load_trend_series(None, config, 'day', day, 3) == series
+    assert [c.args[2:] for c in load_runs.call_args_list] == [('day', '2026-10-15')]
+
+def test_trend_series_retracts_rewritten_files(tmp_path):
+    """A rewritten file's earlier contribution leaves the bucket it was counted in, even once compacted"""
+    source, trends = tmp_path / 'source', tmp_path / 'trends'
+    source.mkdir()
+    config = {'source_path': str(source), 'source_concurrency': 2, 'source_prefetch_bytes': 1024 * 1024,
+              'aggregate_prefixes': [], 'trend_path': str(trends), 'trend_prefix': '', 'trend_granularities': ['day'],
+              's3_bucket': 'b', 'retrieve_concurrency': 4, 'trend_compact_grace': 900}
+
+    def write_partial(texts, mtime):
+        aggregator = sentiment_scoring.StreamingAggregator()
+        for text in texts:
+            aggregator.add(text)
+        path = source / 'aggregate-0.json'
+        path.write_text(json.dumps(aggregator.to_partial('raw/0.json')))
+        os.utime(path, ns=(mtime, mtime))
+
+    def run(timestamp, run_id):
+        merged, retractions = analyzer.load_partial_aggregates(None, config, {}, set(), folded, timestamp.strftime('%Y-%m-%d'),
+                                                               timestamp.isoformat())
+        analyzer.append_trend_run(None, config, timestamp, run_id, merged, 0)
+        analyzer.append_trend_retractions(None, config, timestamp, run_id, retractions)
+        return analyzer.load_trend_series(None, config, 'day', timestamp, 3)
+
+    folded = {}
+    day = analyzer.datetime.datetime(2026, 10, 13, 9)
+    write_partial(["live sports are great", "live sports are bad", "mobile app is great"], 1)
+    run(day, 'run-0')
+    later = day + analyzer.datetime.timedelta(days=2)
+    assert analyzer.load_trend_series(None, config, 'day', later, 3)[0][1][0]['total'] == 2
+    write_partial(["live sports are terrible"], 2)
+    series = run(later, 'run-1')
+
+    # The compacted first day is rebuilt without the retracted contribution
+    assert [(bucket, [(a['property'], a['total']) for a in aggregates]) for bucket, aggregates in series] == [
+        ('2026-10-13', []), ('2026-10-14', []), ('2026-10-15', [('Sports Streaming', 1)])]
+    assert json.loads((trends / 'day' / '2026-10-13' / '_compacted.json').read_text())['aggregates'] == []
+
+def test_spike_detector_flags_negative_and_theme_spikes():
+    """Steady batches build a baseline; a buffering outage batch raises alerts"""
+    detector = analyzer.SpikeDetector(alpha=0.3, z_threshold=3, min_delta=10, warmup=3, min_mentions=5)
+    steady = ["live sports are great"] * 8 + ["live sports are bad"] * 2
+    outage = ["live sports keep buffering, terrible"] * 7 + ["live sports are great"] * 3
+    now = analyzer.datetime.datetime(2026, 10, 15, 9)
+
+    for _ in range(4):
+        aggregates = analyzer.score_feedback_aggregates({'content': t} for t in steady)
+        assert detector.observe(aggregates, now) == []
+
+    aggregates = analyzer.score_feedback_aggregates({'content': t} for t in outage)
+    alerts = detector.observe(aggregates, now)
+    assert {a['metric'] for a in alerts} == {'negative_percentage', 'theme:technical performance'}
+    negative = next(a for a in alerts if a['metric'] == 'negative_percentage')
+    assert negative['property'] == 'Sports Streaming'
+    assert (negative['value'], negative['baseline']) == (70.0, 20.0)
+
+    # Baselines round-trip through persisted state
+    restored = analyzer.SpikeDetector(json.loads(json.dumps(detector.to_state())))
+    assert restored.baselines == detector.baselines
+
+    results = [{'topic': 'Sports Streaming'}, {'topic': 'Mobile Streaming'}]
+    analyzer.attach_spike_alerts(results, alerts)
+    assert results[0]['spike_detected'] and not results[1]['spike_detected']